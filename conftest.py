@@ -12,7 +12,7 @@ from tests.NotebookMetadata import NotebookMetadata
 
 def cleanup_output_folder():
     """Remove all .md and .pdf files from the tests/out folder."""
-    for file_pattern in ['tests/out/*.md', 'tests/out/*.pdf']:
+    for file_pattern in ['tests/out/*.md', 'tests/out/*.pdf', 'tests/out/perf/*.md', 'tests/out/perf/*.pdf']:
         for file in glob.glob(file_pattern):
             os.remove(file)
 
@@ -27,6 +27,41 @@ def pytest_addoption(parser):
         default=False,
         help="run interactive tests that require developer verification"
     )
+    parser.addoption(
+        "--perf",
+        action="store_true",
+        default=False,
+        help="run the performance regression tests (marker: perf)"
+    )
+    parser.addoption(
+        "--perf-runs",
+        type=int,
+        default=3,
+        help="how often each notebook is converted per performance test, the fastest run counts"
+    )
+    parser.addoption(
+        "--perf-tolerance",
+        type=float,
+        default=0.25,
+        help="fraction a stage may become slower or use more memory than its baseline before the test fails"
+    )
+    parser.addoption(
+        "--perf-update-baseline",
+        action="store_true",
+        default=False,
+        help="record the measured timings and memory as the new performance baseline"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    """Performance tests take a while and depend on the machine, they only run when asked for"""
+    if config.getoption("--perf") or config.getoption("--perf-update-baseline"):
+        return
+
+    skip_perf = pytest.mark.skip(reason="performance tests only run with --perf")
+    for item in items:
+        if "perf" in item.keywords:
+            item.add_marker(skip_perf)
 
 
 def with_remarks(metadata: NotebookMetadata):
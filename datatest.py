@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
 
-import os
+import argparse
+import contextlib
 import glob
-import time
+import io
+import multiprocessing
+import os
+import signal
 import sqlite3
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from tqdm import tqdm
 import subprocess
+import time
+import traceback
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 import atexit
 
+from tqdm import tqdm
+
+DATA_DIR = "tests/data-tests"
+OUTPUT_DIR = "tests/out/data-out"
+
+
 class ProcessingLogger:
     def __init__(self, db_path="processing_log.db"):
         self.db_path = db_path
@@ -43,140 +56,414 @@ class ProcessingLogger:
                 FOREIGN KEY (run_id) REFERENCES processing_runs(id)
             )
         """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS stage_timings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_log_id INTEGER,
+                stage TEXT,
+                duration REAL,
+                peak_memory INTEGER,
+                FOREIGN KEY (file_log_id) REFERENCES file_logs(id)
+            )
+        """)
+        # Databases created by earlier versions of this script lack these columns
+        self.add_missing_columns("processing_runs", {
+            "remarks_version": "TEXT",
+            "git_revision": "TEXT",
+            "total_pages": "INTEGER",
+        })
+        self.add_missing_columns("file_logs", {
+            "pages": "INTEGER",
+            "peak_memory": "INTEGER",
+        })
         self.conn.commit()
 
-    def start_run(self, total_files):
+    def add_missing_columns(self, table, columns):
+        existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+        for name, column_type in columns.items():
+            if name not in existing:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+    def start_run(self, total_files, remarks_version=None, git_revision=None):
         cursor = self.conn.execute(
-            "INSERT INTO processing_runs (start_time, total_files) VALUES (?, ?)",
-            (datetime.now(), total_files)
+            "INSERT INTO processing_runs (start_time, total_files, remarks_version, git_revision) VALUES (?, ?, ?, ?)",
+            (datetime.now(), total_files, remarks_version, git_revision)
         )
         self.current_run_id = cursor.lastrowid
         self.conn.commit()
         return self.current_run_id
 
-    def log_file(self, file_path, status, stdout, stderr, error_message, processing_time):
-        self.conn.execute("""
-            INSERT INTO file_logs 
-            (run_id, file_path, status, stdout, stderr, error_message, processing_time, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (self.current_run_id, file_path, status, stdout, stderr, error_message, 
-              processing_time, datetime.now()))
+    def log_file(self, file_path, status, stdout, stderr, error_message, processing_time,
+                 pages=None, peak_memory=None, stage_timings=None, stage_peak_memory=None):
+        cursor = self.conn.execute("""
+            INSERT INTO file_logs
+            (run_id, file_path, status, stdout, stderr, error_message, processing_time, timestamp, pages, peak_memory)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (self.current_run_id, file_path, status, stdout, stderr, error_message,
+              processing_time, datetime.now(), pages, peak_memory))
+        stage_peak_memory = stage_peak_memory or {}
+        self.conn.executemany("""
+            INSERT INTO stage_timings (file_log_id, stage, duration, peak_memory)
+            VALUES (?, ?, ?, ?)
+        """, [(cursor.lastrowid, stage, duration, stage_peak_memory.get(stage))
+              for stage, duration in (stage_timings or {}).items()])
         self.conn.commit()
 
-    def end_run(self, successful, failed, duration):
+    def end_run(self, successful, failed, duration, total_pages=None):
         self.conn.execute("""
-            UPDATE processing_runs 
-            SET end_time = ?, successful_files = ?, failed_files = ?, 
-                total_duration = ?
+            UPDATE processing_runs
+            SET end_time = ?, successful_files = ?, failed_files = ?,
+                total_duration = ?, total_pages = ?
             WHERE id = ?
-        """, (datetime.now(), successful, failed, duration, self.current_run_id))
+        """, (datetime.now(), successful, failed, duration, total_pages, self.current_run_id))
         self.conn.commit()
 
+    def previous_run_id(self):
+        """The most recent finished run before the current one, if any"""
+        row = self.conn.execute("""
+            SELECT id FROM processing_runs
+            WHERE id < ? AND end_time IS NOT NULL
+            ORDER BY id DESC LIMIT 1
+        """, (self.current_run_id,)).fetchone()
+        return row[0] if row else None
+
+    def run_totals(self, run_id):
+        return self.conn.execute("""
+            SELECT remarks_version, git_revision, total_files, successful_files, total_pages, total_duration
+            FROM processing_runs WHERE id = ?
+        """, (run_id,)).fetchone()
+
+    def stage_totals(self, run_id):
+        """Seconds spent per stage over all successfully processed files of a run"""
+        return dict(self.conn.execute("""
+            SELECT stage_timings.stage, SUM(stage_timings.duration)
+            FROM stage_timings JOIN file_logs ON stage_timings.file_log_id = file_logs.id
+            WHERE file_logs.run_id = ? AND file_logs.status = 'success'
+            GROUP BY stage_timings.stage
+        """, (run_id,)).fetchall())
+
+    def file_times(self, run_id):
+        return dict(self.conn.execute("""
+            SELECT file_path, processing_time FROM file_logs
+            WHERE run_id = ? AND status = 'success'
+        """, (run_id,)).fetchall())
+
+    def history(self, limit):
+        return self.conn.execute("""
+            SELECT id, start_time, remarks_version, git_revision, successful_files, failed_files,
+                   total_pages, total_duration
+            FROM processing_runs WHERE end_time IS NOT NULL
+            ORDER BY id DESC LIMIT ?
+        """, (limit,)).fetchall()
+
     def close(self):
         if hasattr(self, 'conn'):
             self.conn.close()
 
-def process_file(file_path):
-    """Process a single file using remarks command"""
-    start_time = time.time()
 
+def get_remarks_version():
     try:
-        result = subprocess.run(
-            ['python', '-m', 'remarks', file_path, "tests/out/data-out"],
-            capture_output=True, 
-            check=True, 
-            text=True,
-            timeout=180,
-            env={
-                **os.environ,
-                # remarks depends on rmc, rmc depends on inkscape, inkscape can crash in parallel
-                # https://gitlab.com/inkscape/inkscape/-/issues/4716#note_1898150983
-                "SELF_CALL": "anything"
-            }
-        )
-        duration = time.time() - start_time
-        return True, file_path, result.stdout, result.stderr, None, duration
-    except subprocess.TimeoutExpired as e:
-        duration = time.time() - start_time
-        return False, file_path, e.stdout, e.stderr, str(e), duration
-    except subprocess.CalledProcessError as e:
-        duration = time.time() - start_time
-        return False, file_path, e.stdout, e.stderr, str(e), duration
+        from importlib.metadata import version
+        return version("remarks")
+    except Exception:
+        from remarks.__main__ import __version__
+        return __version__
+
+
+def get_git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, check=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class FileTimeoutError(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise FileTimeoutError()
+
+
+def warm_worker(in_progress):
+    """Runs once in every pool worker, so the import cost isn't paid per file"""
+    global files_in_progress
+    # remarks depends on rmc, rmc depends on inkscape, inkscape can crash in parallel
+    # https://gitlab.com/inkscape/inkscape/-/issues/4716#note_1898150983
+    os.environ["SELF_CALL"] = "anything"
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    # the file every worker is busy with, to tell which files a crashed worker took down, see `process_files`
+    files_in_progress = in_progress
+
+    import fitz  # noqa: F401
+    import rmc.exporters.svg  # noqa: F401
+    import remarks  # noqa: F401
+
+
+def kill_child_processes(pid=None):
+    """Kill what `pid`, this process by default, started and didn't get to stop: the Inkscape of a file that timed
+    out, and whatever that started in turn"""
+    pid = os.getpid() if pid is None else pid
+    try:
+        children = subprocess.run(["pgrep", "-P", str(pid)], capture_output=True, text=True).stdout.split()
+    except OSError:
+        return
+    for child in map(int, children):
+        kill_child_processes(child)
+        try:
+            os.kill(child, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        if pid == os.getpid():
+            try:
+                os.waitpid(child, 0)
+            except ChildProcessError:
+                pass
+
+
+def process_file(file_path, output_dir, timeout, trace_memory=False):
+    """Process a single file in-process, inside a pre-warmed pool worker.
+
+    With `trace_memory` the peak memory of the file and its stages is traced with tracemalloc, which makes every
+    stage slower. Leave it off for timings that are compared between runs."""
+    import remarks
+
+    files_in_progress[os.getpid()] = file_path
+    stdout, stderr = io.StringIO(), io.StringIO()
+    result = {
+        "file_path": file_path,
+        "success": False,
+        "error": None,
+        "pages": None,
+        "peak_memory": None,
+        "stage_timings": {},
+        "stage_peak_memory": {},
+    }
+
+    start_time = time.time()
+    if trace_memory:
+        tracemalloc.start()
+    signal.alarm(timeout)
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            summary = remarks.run_remarks(file_path, output_dir)
+        result["success"] = True
+        result["pages"] = summary.pages
+        result["stage_timings"] = summary.stage_timings
+        result["stage_peak_memory"] = summary.stage_peak_memory
+    except FileTimeoutError:
+        result["error"] = f"Timed out after {timeout} seconds"
+        kill_child_processes()
+    except (Exception, SystemExit):
+        result["error"] = traceback.format_exc()
+    finally:
+        signal.alarm(0)
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result["peak_memory"] = max([peak, *result["stage_peak_memory"].values()])
+
+    result["duration"] = time.time() - start_time
+    result["stdout"] = stdout.getvalue()
+    result["stderr"] = stderr.getvalue()
+    del files_in_progress[os.getpid()]
+    return result
+
+
+def crashed_result(file_path):
+    return {
+        "file_path": file_path,
+        "success": False,
+        "error": "The worker process crashed",
+        "pages": None,
+        "peak_memory": None,
+        "stage_timings": {},
+        "stage_peak_memory": {},
+        "duration": None,
+        "stdout": "",
+        "stderr": "",
+    }
+
+
+def process_files(files, workers, output_dir, timeout, trace_memory=False):
+    """
+    Yields the result of `process_file` for every file, in the order they finish.
+
+    A worker that crashes, a segfault in MuPDF or Inkscape or the OOM killer, takes the whole pool down. The files
+    that were being processed at the time are converted again with a worker of their own, one at a time, to find the
+    one that crashed it. It is reported as failed. The pool is started again for the files that were still waiting.
+    """
+    with multiprocessing.Manager() as manager:
+        pending = list(files)
+        while pending:
+            in_progress = manager.dict()
+            broken = []
+            with ProcessPoolExecutor(max_workers=workers, initializer=warm_worker, initargs=(in_progress,)) as executor:
+                future_to_file = {executor.submit(process_file, file, output_dir, timeout, trace_memory): file
+                                  for file in pending}
+                for future in as_completed(future_to_file):
+                    try:
+                        yield future.result()
+                    except BrokenProcessPool:
+                        broken.append(future_to_file[future])
+
+            suspects = set(in_progress.values())
+            if broken and not suspects:
+                # the workers crashed before they got to any file, starting them again won't help
+                for file in broken:
+                    yield crashed_result(file)
+                return
+            pending = [file for file in broken if file not in suspects]
+            for file in broken:
+                if file not in suspects:
+                    continue
+                in_progress = manager.dict()
+                with ProcessPoolExecutor(max_workers=1, initializer=warm_worker, initargs=(in_progress,)) as executor:
+                    try:
+                        yield executor.submit(process_file, file, output_dir, timeout, trace_memory).result()
+                    except BrokenProcessPool:
+                        yield crashed_result(file)
+
+
+def print_comparison(logger):
+    """Compare the run that just finished with the one before it"""
+    previous_run_id = logger.previous_run_id()
+    if previous_run_id is None:
+        print("\nNo previous run to compare with")
+        return
+
+    def throughput(totals):
+        _, _, _, successful, pages, duration = totals
+        if not duration:
+            return 0, 0
+        return (successful or 0) / duration, (pages or 0) / duration
+
+    current, previous = logger.run_totals(logger.current_run_id), logger.run_totals(previous_run_id)
+    current_files_s, current_pages_s = throughput(current)
+    previous_files_s, previous_pages_s = throughput(previous)
+
+    print(f"\nCompared to run {previous_run_id} (remarks {previous[0]}, {previous[1]}):")
+    print(f"Files/s: {previous_files_s:.2f} -> {current_files_s:.2f}")
+    print(f"Pages/s: {previous_pages_s:.2f} -> {current_pages_s:.2f}")
+
+    current_stages, previous_stages = logger.stage_totals(logger.current_run_id), logger.stage_totals(previous_run_id)
+    for stage in sorted(set(current_stages) | set(previous_stages)):
+        print(f"- {stage}: {previous_stages.get(stage, 0):.2f}s -> {current_stages.get(stage, 0):.2f}s")
+
+    # Only files that succeeded in both runs can be compared fairly
+    current_times, previous_times = logger.file_times(logger.current_run_id), logger.file_times(previous_run_id)
+    changed = []
+    for file_path in current_times.keys() & previous_times.keys():
+        before, after = previous_times[file_path], current_times[file_path]
+        if before > 0 and abs(after - before) / before > 0.25 and abs(after - before) > 1:
+            changed.append((after - before, file_path, before, after))
+    for _, file_path, before, after in sorted(changed, reverse=True):
+        print(f"  {file_path}: {before:.2f}s -> {after:.2f}s")
+
+
+def print_history(logger, limit):
+    print(f"\nLast {limit} runs:")
+    for run_id, start_time, version, revision, successful, failed, pages, duration in logger.history(limit):
+        pages_s = (pages or 0) / duration if duration else 0
+        print(f"{run_id:>5} {start_time[:19]} {version or '?':>8} {revision or '?':>9} "
+              f"ok={successful} failed={failed} {duration:.1f}s {pages_s:.2f} pages/s")
+
 
 def main():
-    # Create output directory
-    os.makedirs("test/out/data-out", exist_ok=True)
-    
+    parser = argparse.ArgumentParser("datatest", description="Run remarks over a corpus of .rmn files")
+    parser.add_argument("--data_dir", default=DATA_DIR, help="Directory with the .rmn corpus")
+    parser.add_argument("--output_dir", default=OUTPUT_DIR, help="Where remarks writes its output")
+    parser.add_argument("--db", default="processing_log.db", help="SQLite database that keeps every run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of pool workers")
+    parser.add_argument("--timeout", type=int, default=180, help="Seconds a single file may take")
+    parser.add_argument("--history", type=int, default=0, metavar="N", help="Print the last N runs and exit")
+    parser.add_argument("--trace_memory", action="store_true",
+                        help="Record the peak memory of every file and stage with tracemalloc, slows down every stage")
+    args = parser.parse_args()
+
     # Initialize logger
-    logger = ProcessingLogger()
-    
-    # Find all .rm files
-    files = glob.glob("tests/data-tests/*.rmn")
+    logger = ProcessingLogger(args.db)
+
+    if args.history:
+        print_history(logger, args.history)
+        return
+
+    # Create output directory
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Find all .rmn files
+    files = glob.glob(f"{args.data_dir}/*.rmn")
     total_files = len(files)
     print(f"Found {total_files} files to process")
-    
+
     # Start run in logger
-    logger.start_run(total_files)
-    
+    logger.start_run(total_files, get_remarks_version(), get_git_revision())
+
     # Track timing
     start_time = time.time()
-    
+
     # Process files in parallel with progress bar
     successful = 0
     failed = 0
-    
-    # Use number of CPU cores for parallel processing
-    max_workers = os.cpu_count()
-    
+    total_pages = 0
+
     try:
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            # Submit all tasks
-            future_to_file = {executor.submit(process_file, file): file 
-                             for file in files}
-            
-                # Process as they complete with progress bar
-            with tqdm(total=total_files, desc="Processing files") as pbar:
-                for future in as_completed(future_to_file):
-                    success, file_path, stdout, stderr, error, duration = future.result()
-                    
-                    # Log the result
-                    logger.log_file(
-                        file_path,
-                        "success" if success else "failed",
-                        stdout,
-                        stderr,
-                        error,
-                        duration
-                    )
-                    
-                    # If there's any stderr output, print it even for successful runs
-                    if not success:
-                        tqdm.write(f"\nError processing {file_path}:")
-                        tqdm.write(f"Error: {error}")
-                    elif stderr:
-                        tqdm.write(f"\nWarning in {file_path}:")
-                        tqdm.write(stderr)
-
-                    if success:
-                        successful += 1
-                    else:
-                        failed += 1
-                    
-                    pbar.update(1)
+        # Process as they complete with progress bar
+        with tqdm(total=total_files, desc="Processing files") as pbar:
+            for result in process_files(files, args.workers, args.output_dir, args.timeout, args.trace_memory):
+                success = result["success"]
+                file_path = result["file_path"]
+
+                # Log the result
+                logger.log_file(
+                    file_path,
+                    "success" if success else "failed",
+                    result["stdout"],
+                    result["stderr"],
+                    result["error"],
+                    result["duration"],
+                    pages=result["pages"],
+                    peak_memory=result["peak_memory"],
+                    stage_timings=result["stage_timings"],
+                    stage_peak_memory=result["stage_peak_memory"],
+                )
+
+                # If there's any stderr output, print it even for successful runs
+                if not success:
+                    tqdm.write(f"\nError processing {file_path}:")
+                    tqdm.write(f"Error: {result['error']}")
+                elif result["stderr"]:
+                    tqdm.write(f"\nWarning in {file_path}:")
+                    tqdm.write(result["stderr"])
+
+                if success:
+                    successful += 1
+                    total_pages += result["pages"]
+                else:
+                    failed += 1
+
+                pbar.update(1)
     except KeyboardInterrupt:
         print("Bye! :)")
-    
+
     # Record final statistics
     end_time = time.time()
     total_duration = end_time - start_time
-    logger.end_run(successful, failed, total_duration)
-    
+    logger.end_run(successful, failed, total_duration, total_pages)
+
     # Print summary
     print("\nProcessing complete!")
     print(f"Total time: {total_duration:.2f} seconds")
     print(f"Files processed: {successful}")
     print(f"Files failed: {failed}")
+    print(f"Pages processed: {total_pages}")
     print(f"Results logged to {logger.db_path}")
 
+    print_comparison(logger)
+
+
 if __name__ == "__main__":
     main()
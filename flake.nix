@@ -27,7 +27,7 @@
               buildInputs = (old.buildInputs or [ ]) ++ [ prev.poetry-core ];
             });
           });
-          extras = [ "server" ];
+          extras = [ "server" "watch" ];
 
           propagatedBuildInputs = [ pkgs.inkscape ];
           nativeCheckInputs = [ pkgs.inkscape ];
@@ -1,5 +1,5 @@
 import math
-from typing import List
+from typing import List, Optional, Set
 
 import fitz
 
@@ -12,6 +12,7 @@ from remarks.utils import (
     list_hl_json_files,
     is_inserted_page,
     get_pages_data,
+    get_page_templates,
     list_ann_rm_files,
     get_visible_name,
 )
@@ -21,6 +22,7 @@ class Document:
     def __init__(self, metadata_path):
         self.metadata_path = metadata_path
         self.pages_list, self.pages_map = get_pages_data(metadata_path)
+        self.page_templates = get_page_templates(metadata_path)
         self.doc_type = get_document_filetype(metadata_path)
         self.name = get_visible_name(metadata_path)
 
@@ -83,20 +85,30 @@ class Document:
     def pages_magnitude(self):
         return math.floor(math.log10(len(self.pages_list))) + 1
 
-    def pages(self):
+    def pages(self, selection: Optional[Set[int]] = None):
+        """Yields every page that has annotations or smart highlights, in document order.
+
+        If `selection` is given, only pages with those 0-based indices are yielded. See `parse_page_selection`"""
         page_uuids = set(
             [f.stem for f in self.rm_annotation_files]
             + [f.stem for f in self.rm_highlight_files]
         )
 
-        for page_uuid in page_uuids:
+        page_indices = {page_uuid: i for i, page_uuid in enumerate(self.pages_list)}
+        # Files of deleted pages can linger around, they are not part of the document anymore
+        page_uuids = [page_uuid for page_uuid in page_uuids if page_uuid in page_indices]
+        if selection is not None:
+            page_uuids = [page_uuid for page_uuid in page_uuids if page_indices[page_uuid] in selection]
+
+        # Yield pages in document order, outputs that are built page by page rely on it
+        for page_uuid in sorted(page_uuids, key=page_indices.get):
             has_annotations = False
             rm_annotation_file = None
 
             rm_highlights_file = None
             has_smart_highlights = False
 
-            page_idx = self.pages_list.index(f"{page_uuid}")
+            page_idx = page_indices[page_uuid]
 
             for f in self.rm_annotation_files:
                 if page_uuid == f.stem and check_rm_file_version(f):
@@ -0,0 +1,338 @@
+import logging
+import pathlib
+import sys
+import tempfile
+import zipfile
+from typing import Dict, Set
+
+from .conversion.erasers import Erasers
+from .output.InkscapePool import InkscapePool
+from .output.MarkdownCache import MarkdownCache
+from .output.OutputHashes import OutputHashes
+from .output.OutputMode import OutputMode
+from .output.PageTemplates import PageTemplates
+from .output.Renderer import Renderer
+from .output.SaveProfile import DEFAULT_SAVE_PROFILE, get_save_profile
+from .remarks import process_document
+from .summary import RunSummary
+from .utils import (
+    MetadataIndex,
+    conversion_warnings,
+    fitz_lock,
+    get_document_filetype,
+    get_parent_uuids,
+    get_ui_path,
+    get_visible_name,
+    is_document,
+    read_meta_file,
+    split_page_selection,
+    use_metadata_index,
+)
+from .watch import start_watcher, watch_documents
+
+
+class Session:
+    """
+    A configuration of remarks, and everything worth keeping from one conversion to the next: the metadata and smart
+    highlights of the documents it has read, the markdown cache of every document, the page templates, the Inkscape
+    processes and the hashes of the files it wrote. `close` lets go of all of it.
+
+    Convert as many libraries as needed with `run`, or single documents with `process_document`, then `close` it.
+    The options are those of `run_remarks`.
+
+    A session converts one thing at a time. To convert in several threads at once, give every thread a session of its
+    own, what a conversion keeps track of lives in the session and in context variables of the thread. The threads
+    take turns with PyMuPDF, see `fitz_lock`, and parse, render SVG, run Inkscape and write markdown in parallel.
+    Page timeouts only apply in the main thread, see `time_limit`. Sessions can share a `cache_dir`, and a
+    `converter`, which is left running when a session is closed.
+    """
+
+    def __init__(
+            self,
+            output_mode: str = OutputMode.FULL,
+            pages=None,
+            only_selected_pages: bool = False,
+            stream_chunk_size: int = None,
+            save_profile=DEFAULT_SAVE_PROFILE,
+            linearize: bool = False,
+            templates_dir=None,
+            simplify_tolerance: float = None,
+            coordinate_decimals: int = None,
+            renderer: str = Renderer.SVG,
+            erasers: str = Erasers.KEEP,
+            native_highlights: bool = False,
+            converter_workers: int = None,
+            page_timeout: float = None,
+            cache_dir=None,
+            converter: InkscapePool = None,
+    ):
+        self.output_mode = output_mode
+        # a selection that can't apply to any document fails here, not half way through a library
+        self.pages = None if pages is None else split_page_selection(pages)
+        self.only_selected_pages = only_selected_pages
+        self.stream_chunk_size = stream_chunk_size
+        self.save_profile = get_save_profile(save_profile, linearize)
+        self.simplify_tolerance = simplify_tolerance
+        self.coordinate_decimals = coordinate_decimals
+        self.renderer = renderer
+        self.erasers = erasers
+        self.native_highlights = native_highlights
+        self.page_timeout = page_timeout
+        self.cache_dir = cache_dir
+
+        # every template is rendered once per session
+        self.templates = PageTemplates(templates_dir) if templates_dir else None
+        # Inkscape starts once per session instead of once per page
+        self.owns_converter = converter is None
+        if converter is None and converter_workers and renderer == Renderer.SVG:
+            converter = InkscapePool(converter_workers)
+        self.converter = converter
+        self.output_hashes = OutputHashes(f"{cache_dir}/output_hashes.json" if cache_dir else None)
+        self.metadata = MetadataIndex()
+        # the `MarkdownCache` of every document converted so far, by its path in `cache_dir`
+        self.markdown_caches: Dict[str, MarkdownCache] = {}
+
+    def document_options(self) -> dict:
+        """The options and state that `process_document` takes"""
+        return dict(
+            output_mode=self.output_mode,
+            pages=self.pages,
+            only_selected_pages=self.only_selected_pages,
+            stream_chunk_size=self.stream_chunk_size,
+            save_profile=self.save_profile,
+            templates=self.templates,
+            simplify_tolerance=self.simplify_tolerance,
+            coordinate_decimals=self.coordinate_decimals,
+            renderer=self.renderer,
+            erasers=self.erasers,
+            native_highlights=self.native_highlights,
+            converter=self.converter,
+            page_timeout=self.page_timeout,
+            cache_dir=self.cache_dir,
+            output_hashes=self.output_hashes,
+            markdown_caches=self.markdown_caches,
+        )
+
+    def run(self, input_dir, output_dir, watch: bool = False, watch_debounce: float = 2.0) -> RunSummary:
+        """Convert every document in `input_dir`, a xochitl-like directory or a .rmn file, into `output_dir`.
+
+        `watch` keeps running after all documents are converted, see `watch`."""
+        if input_dir.endswith(".rmn"):
+            temp_dir = tempfile.mkdtemp()
+            with zipfile.ZipFile(input_dir, 'r') as zip_ref:
+                zip_ref.extractall(temp_dir)
+            input_dir = temp_dir
+
+        num_docs = sum(1 for _ in pathlib.Path(f"{input_dir}/").glob("*.metadata"))
+
+        if num_docs == 0:
+            logging.warning(
+                f'No .metadata files found in "{input_dir}". Are you sure you\'re running remarks on a valid xochitl-like directory? See: https://github.com/lucasrla/remarks#1-copy-remarkables-raw-document-files-to-your-computer'
+            )
+            sys.exit(1)
+
+        logging.info(
+            f'\nFound {num_docs} documents in "{input_dir}", will process them now',
+        )
+
+        summary = RunSummary()
+
+        # files that are synced while the documents are converted the first time are converted again after
+        watcher = start_watcher(input_dir) if watch else None
+
+        # warnings that show up on every page are logged once per run
+        with conversion_warnings():
+            try:
+                for metadata_path in pathlib.Path(f"{input_dir}/").glob("*.metadata"):
+                    self.convert_document(metadata_path, output_dir, summary)
+
+                if watch:
+                    self.output_hashes.save()
+                    summary.log()
+                    self.watch(input_dir, output_dir, summary, watch_debounce, watcher)
+            finally:
+                if watcher is not None:
+                    watcher.close()
+                self.output_hashes.save()
+
+        logging.info(
+            f'\nDone processing "{input_dir}"',
+        )
+        summary.log()
+
+        return summary
+
+    def convert_document(self, metadata_path, output_dir, summary: RunSummary):
+        """Convert the document of `metadata_path` into its folder in `output_dir`, if it is a document remarks
+        supports"""
+        with use_metadata_index(self.metadata):
+            if not is_document(metadata_path):
+                return
+
+            doc_type = get_document_filetype(metadata_path)
+            # Both "Quick Sheets" and "Notebooks" have doc_type="notebook"
+            supported_types = ["pdf", "epub", "notebook"]
+
+            doc_name = get_visible_name(metadata_path)
+
+            if not doc_name:
+                return
+
+            if doc_type in supported_types:
+                logging.info(f'\nFile: "{doc_name}.{doc_type}" ({metadata_path.stem})')
+
+                in_device_dir = get_ui_path(metadata_path)
+                out_path = pathlib.Path(f"{output_dir}/{in_device_dir}/{doc_name}/")
+
+                self.process_document(metadata_path, out_path, summary)
+            else:
+                logging.info(
+                    f'\nFile skipped: "{doc_name}" ({metadata_path.stem}) due to unsupported filetype: {doc_type}. remarks only supports: {", ".join(supported_types)}'
+                )
+
+    def process_document(self, metadata_path, out_path, summary: RunSummary = None):
+        """Convert the document of `metadata_path` to `out_path`, see `process_document`"""
+        with use_metadata_index(self.metadata):
+            process_document(metadata_path, out_path, summary, **self.document_options())
+
+    def watch(self, input_dir, output_dir, summary: RunSummary, debounce: float = 2.0, watcher=None):
+        """Convert the documents of `input_dir` again whenever their files change, until interrupted with Ctrl+C.
+
+        Changes are collected until nothing changed for `debounce` seconds, then only the documents that changed are
+        converted, see `watch_documents`. A folder that was renamed or moved converts every document inside it, their
+        output goes to a folder of the new name. `watcher`, see `start_watcher`, brings the changes it saw so far."""
+        logging.info(f'\nWatching "{input_dir}" for changes, press Ctrl+C to stop')
+        try:
+            for changed_uuids in watch_documents(input_dir, debounce, watcher=watcher):
+                for document_uuid in sorted(self.changed_documents(input_dir, changed_uuids)):
+                    metadata_path = pathlib.Path(f"{input_dir}/{document_uuid}.metadata")
+                    # deleted, or one of the other files of a document that is being synced
+                    if not metadata_path.exists():
+                        continue
+                    try:
+                        self.convert_document(metadata_path, output_dir, summary)
+                    except Exception:
+                        # one broken document doesn't stop the watcher
+                        logging.exception(f'- Failed to convert "{metadata_path}"')
+                self.output_hashes.save()
+                summary.log()
+        except KeyboardInterrupt:
+            logging.info("\nStopped watching")
+
+    def changed_documents(self, input_dir, uuids) -> Set[str]:
+        """The UUIDs of `uuids` with the folders among them replaced by the documents inside them, at any depth"""
+        with use_metadata_index(self.metadata):
+            folders = set()
+            for uuid in uuids:
+                metadata = read_meta_file(pathlib.Path(f"{input_dir}/{uuid}.metadata"))
+                if metadata is not None and metadata["type"] == "CollectionType":
+                    folders.add(uuid)
+            if not folders:
+                return set(uuids)
+            documents = set(uuids) - folders
+            for metadata_path in pathlib.Path(f"{input_dir}/").glob("*.metadata"):
+                if is_document(metadata_path) and folders.intersection(get_parent_uuids(metadata_path)):
+                    documents.add(metadata_path.stem)
+            return documents
+
+    def close(self):
+        if self.converter is not None and self.owns_converter:
+            self.converter.close()
+        if self.templates is not None:
+            with fitz_lock:
+                self.templates.close()
+        self.output_hashes.save()
+        self.metadata = MetadataIndex()
+        self.markdown_caches = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def run_remarks(
+        input_dir,
+        output_dir,
+        output_mode: str = OutputMode.FULL,
+        pages=None,
+        only_selected_pages: bool = False,
+        stream_chunk_size: int = None,
+        save_profile=DEFAULT_SAVE_PROFILE,
+        linearize: bool = False,
+        templates_dir=None,
+        simplify_tolerance: float = None,
+        coordinate_decimals: int = None,
+        renderer: str = Renderer.SVG,
+        erasers: str = Erasers.KEEP,
+        native_highlights: bool = False,
+        converter_workers: int = None,
+        page_timeout: float = None,
+        cache_dir=None,
+        watch: bool = False,
+        watch_debounce: float = 2.0,
+) -> RunSummary:
+    """Convert every document in `input_dir`, a xochitl-like directory or a .rmn file, into `output_dir`, with a
+    `Session` that lasts for this call.
+
+    `pages` restricts parsing, rendering and Markdown to a selection of pages of every document, see
+    `parse_page_selection`. A malformed selection raises a ValueError before any document is converted. With
+    `only_selected_pages` the output PDF holds nothing but the selected pages.
+
+    `stream_chunk_size` writes the full output PDF while pages are processed and flushes it to disk every that many
+    pages, see `StreamingPdfWriter`.
+
+    `save_profile` is one of the presets in `SAVE_PROFILES` or a `SaveProfile`, `linearize` switches on linearization
+    on top of it.
+
+    `templates_dir` is a copy of the device's template directory, /usr/share/remarkable/templates. Blank pages are
+    given the template they have on the device, see `PageTemplates`.
+
+    `simplify_tolerance` drops stroke points that lie closer than that many points to the simplified stroke,
+    `coordinate_decimals` rounds stroke coordinates to that many decimals of a point. Both trade fidelity for smaller
+    and faster output, see `simplify_scene_tree`.
+
+    `renderer` picks how strokes are drawn, see `Renderer`.
+
+    `erasers` removes eraser strokes before pages are drawn, and with `Erasers.SUBTRACT` what they erased too, see
+    `remove_erasers`.
+
+    `native_highlights` adds the highlights of v6 pages as PDF highlight annotations, see
+    `add_highlight_annotations`.
+
+    `converter_workers` keeps that many Inkscape processes running to convert the SVG of every page, instead of
+    starting Inkscape once per page, see `InkscapePool`.
+
+    `page_timeout` gives rendering every page that many seconds. A page that takes longer is left as the source page
+    with a warning on it, and the run moves on. It only applies in the main thread of a process, see `time_limit`.
+
+    `cache_dir` keeps the markdown of every page between runs. Pages whose .rm file and smart highlights didn't
+    change are not parsed again, see `MarkdownCache`.
+
+    Output files that come out the same as the file already there are left alone, see `OutputHashes`. With
+    `cache_dir`, their hashes are kept there too.
+
+    `watch` keeps running after all documents are converted, and converts documents again when their files change.
+    Changes are collected until nothing changed for `watch_debounce` seconds, see `Session.watch`.
+
+    To convert several libraries with the same options, use a `Session` of your own instead. Everything it sets up is
+    kept from one conversion to the next."""
+    with Session(
+            output_mode=output_mode,
+            pages=pages,
+            only_selected_pages=only_selected_pages,
+            stream_chunk_size=stream_chunk_size,
+            save_profile=save_profile,
+            linearize=linearize,
+            templates_dir=templates_dir,
+            simplify_tolerance=simplify_tolerance,
+            coordinate_decimals=coordinate_decimals,
+            renderer=renderer,
+            erasers=erasers,
+            native_highlights=native_highlights,
+            converter_workers=converter_workers,
+            page_timeout=page_timeout,
+            cache_dir=cache_dir,
+    ) as session:
+        return session.run(input_dir, output_dir, watch, watch_debounce)
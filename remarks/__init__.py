@@ -1,6 +1,11 @@
 from . import conversion
 
-from .remarks import run_remarks
+from .Session import Session, run_remarks
+from .summary import RunSummary
+from .output.OutputMode import OutputMode
+from .conversion.erasers import Erasers
+from .output.Renderer import Renderer
+from .output.SaveProfile import SaveProfile, SAVE_PROFILES
 
 from .utils import (
     get_visible_name,
@@ -8,6 +13,8 @@ from .utils import (
     get_pages_data,
     list_ann_rm_files,
     load_json_file,
+    parse_page_selection,
+    split_page_selection,
     prepare_subdir,
     rescale_given_device_aspect_ratio,
     RM_WIDTH,
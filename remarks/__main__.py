@@ -3,6 +3,11 @@ import pathlib
 import argparse
 
 from remarks import run_remarks
+from remarks.utils import split_page_selection
+from remarks.output.OutputMode import OutputMode
+from remarks.conversion.erasers import Erasers
+from remarks.output.Renderer import Renderer
+from remarks.output.SaveProfile import SAVE_PROFILES, DEFAULT_SAVE_PROFILE
 
 __prog_name__ = "remarks"
 __version__ = "0.3.1"
@@ -21,6 +26,108 @@ def main():
         help="Base directory for all files created (*.pdf, *.png, *.md, and/or *.svg)",
         metavar="OUTPUT_DIRECTORY",
     )
+    parser.add_argument(
+        "--output_mode",
+        help="Which files to write for every document. 'full' writes the annotated PDF and the Obsidian markdown, 'markdown' only extracts highlights and text to markdown without opening or rendering any PDF. 'annotated' writes only the annotated pages and 'overlay' only their annotation layer on transparent pages, each page records its source page index. Defaults to 'full'",
+        default=OutputMode.FULL,
+        choices=OutputMode.ALL,
+        metavar="OUTPUT_MODE",
+    )
+    parser.add_argument(
+        "--pages",
+        help="Only parse, render and extract Markdown for these pages. A comma separated list of page numbers (counted from 1), ranges like 120-125 and page UUIDs. Pages that aren't selected are copied from the source document untouched",
+        default=None,
+        metavar="PAGES",
+    )
+    parser.add_argument(
+        "--only_selected_pages",
+        help="Together with --pages, leave every page that wasn't selected out of the output PDF",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream_chunk_size",
+        help="Write the output PDF while pages are processed and flush it to disk every N annotated pages. Bounds memory use on very large documents, at the cost of a somewhat larger file",
+        type=int,
+        default=None,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--save_profile",
+        help="How output PDFs are saved. 'fast' writes objects as they are, 'compact' removes unused and duplicate objects and compresses streams, 'smallest' also recompresses images and fonts. Defaults to 'fast'",
+        default=DEFAULT_SAVE_PROFILE,
+        choices=list(SAVE_PROFILES),
+        metavar="SAVE_PROFILE",
+    )
+    parser.add_argument(
+        "--linearize",
+        help="Linearize output PDFs, so viewers can show the first pages while the rest is still downloading",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--templates_dir",
+        help="A copy of the page templates of your reMarkable, found in /usr/share/remarkable/templates on the device. Blank notebook pages get the template they have on the device, each template is stored once per PDF",
+        metavar="TEMPLATES_DIR",
+    )
+    parser.add_argument(
+        "--simplify_tolerance",
+        help="Simplify strokes before drawing them, dropping points that lie closer than SIMPLIFY_TOLERANCE points (1/72 inch) to the simplified stroke. Try 0.1 to 0.5 for smaller PDFs that look the same",
+        type=float,
+        metavar="SIMPLIFY_TOLERANCE",
+    )
+    parser.add_argument(
+        "--coordinate_decimals",
+        help="Round stroke coordinates to COORDINATE_DECIMALS decimals of a point (1/72 inch)",
+        type=int,
+        metavar="COORDINATE_DECIMALS",
+    )
+    parser.add_argument(
+        "--renderer",
+        help="How strokes are drawn. 'svg' converts rmc's SVG with Inkscape, 'batched' draws them into the PDF directly and combines strokes of the same style into a single path, which is faster, smaller and doesn't need Inkscape. Defaults to 'svg'",
+        default=Renderer.SVG,
+        choices=Renderer.ALL,
+        metavar="RENDERER",
+    )
+    parser.add_argument(
+        "--erasers",
+        help="What happens to eraser strokes. 'keep' draws them like the device's export, 'drop' removes them, 'subtract' also removes the parts of earlier strokes they cover, so erased ink never reaches the PDF. Defaults to 'keep'",
+        default=Erasers.KEEP,
+        choices=Erasers.ALL,
+        metavar="ERASERS",
+    )
+    parser.add_argument(
+        "--converter_workers",
+        help="Keep CONVERTER_WORKERS Inkscape processes running to convert the pages drawn by the 'svg' renderer, instead of starting Inkscape for every page. Every process gets a profile directory of its own and is restarted when it crashes or hangs",
+        type=int,
+        metavar="CONVERTER_WORKERS",
+    )
+    parser.add_argument(
+        "--page_timeout",
+        help="Give up on pages that take longer than PAGE_TIMEOUT seconds to render. They are left as they are, with a warning on them, and the rest of the document is processed as usual",
+        type=float,
+        metavar="PAGE_TIMEOUT",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Keep the markdown of every page in CACHE_DIR between runs. Pages whose annotations and smart highlights didn't change since the last run are not parsed again",
+        metavar="CACHE_DIR",
+    )
+    parser.add_argument(
+        "--watch",
+        help="Keep running after converting INPUT_DIRECTORY, and convert documents again as soon as their files change. Uses inotify when remarks is installed with the 'watch' extra, which adds watchdog, and checks for changes every second otherwise",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--watch_debounce",
+        help="With --watch, wait until no file changed for WATCH_DEBOUNCE seconds before converting, so a sync that writes many files converts every document once. Defaults to 2",
+        default=2.0,
+        type=float,
+        metavar="WATCH_DEBOUNCE",
+    )
+    parser.add_argument(
+        "--native_highlights",
+        help="Add the highlights of v6 pages as PDF highlight annotations in their original color. The highlighted text stays selectable and PDF viewers list them with the other annotations",
+        action="store_true",
+    )
     parser.add_argument(
         "-v",
         "--version",
@@ -56,6 +163,15 @@ def main():
     if not pathlib.Path(input_dir).exists():
         parser.error(f'Directory "{input_dir}" does not exist')
 
+    if args_dict["watch"] and input_dir.endswith(".rmn"):
+        parser.error("--watch needs a xochitl-like directory, not a .rmn file")
+
+    if args_dict["pages"] is not None:
+        try:
+            split_page_selection(args_dict["pages"])
+        except ValueError as e:
+            parser.error(str(e))
+
     if not pathlib.Path(output_dir).is_dir():
         pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
 
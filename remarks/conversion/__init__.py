@@ -10,4 +10,6 @@ from .text import (
     extract_groups_from_pdf_ann_hl,
     extract_groups_from_smart_hl,
     prepare_md_from_hl_groups,
+    prepare_md_from_page,
+    get_textpage,
 )
@@ -0,0 +1,130 @@
+import dataclasses
+from typing import List, Tuple
+
+import numpy as np
+import shapely
+import shapely.geometry as geom  # Shapely
+from rmscene import CrdtId, SceneTree
+from rmscene import scene_items as si
+from rmscene.crdt_sequence import CrdtSequence, CrdtSequenceItem, END_MARKER
+
+ERASER_TOOLS = (si.Pen.ERASER, si.Pen.ERASER_AREA)
+
+
+class Erasers:
+    """What happens to eraser strokes before a page is drawn"""
+
+    # Draw them like rmc does: the eraser as a wide white stroke, the area eraser invisible
+    KEEP = "keep"
+    # Remove eraser strokes, for pages where the eraser never touched anything that is still there
+    DROP = "drop"
+    # Remove eraser strokes, and the points of earlier strokes that they cover
+    SUBTRACT = "subtract"
+
+    ALL = [KEEP, DROP, SUBTRACT]
+
+
+def eraser_region(line: si.Line):
+    """The area `line` erases, in .rm coordinates"""
+    points = [(point.x, point.y) for point in line.points]
+    if line.tool == si.Pen.ERASER_AREA and len(points) >= 3:
+        # buffer(0) repairs the self intersections a hand drawn outline is full of
+        return geom.Polygon(points).buffer(0)
+    # rmc draws the eraser twice as wide as its thickness
+    radius = line.thickness_scale
+    if len(points) == 1:
+        return geom.Point(points[0]).buffer(radius)
+    return geom.LineString(points).buffer(radius)
+
+
+def split_at_erased_points(line: si.Line, erased: np.ndarray) -> List[si.Line]:
+    """The runs of points of `line` that were not erased, as lines of their own. Single points are dropped, they
+    don't draw anything"""
+    pieces = []
+    start = None
+    for i, is_erased in enumerate(np.append(erased, True)):
+        if not is_erased and start is None:
+            start = i
+        elif is_erased and start is not None:
+            if i - start > 1:
+                pieces.append(dataclasses.replace(line, points=line.points[start:i]))
+            start = None
+    return pieces
+
+
+def as_group(lines: List[si.Line], node_id: CrdtId) -> si.Group:
+    """`lines` as a group without an anchor, so they are drawn where they are"""
+    items = []
+    left_id = END_MARKER
+    for i, line in enumerate(lines):
+        item_id = CrdtId(0, i + 1)
+        items.append(CrdtSequenceItem(item_id, left_id, END_MARKER, 0, line))
+        left_id = item_id
+    return si.Group(node_id, children=CrdtSequence(items))
+
+
+def remove_erasers(tree: SceneTree, erasers: str = Erasers.DROP) -> Tuple[int, int]:
+    """
+    Remove the eraser strokes of `tree` in place, see `Erasers`.
+
+    With `Erasers.SUBTRACT`, every eraser also removes the points it covers from the strokes drawn before it. A stroke
+    that is erased in the middle falls apart in a group of the pieces that are left.
+
+    Returns:
+        The number of eraser strokes and the number of erased points
+    """
+    # every line in drawing order, with the sequence item that holds it
+    lines: List[Tuple[CrdtSequenceItem, si.Line]] = []
+
+    def collect(group: si.Group):
+        items = {item.item_id: item for item in group.children.sequence_items()}
+        for item_id in group.children:
+            value = items[item_id].value
+            if isinstance(value, si.Group):
+                collect(value)
+            elif isinstance(value, si.Line) and value.points:
+                lines.append((items[item_id], value))
+
+    collect(tree.root)
+
+    erased = [np.zeros(len(line.points), dtype=bool) for _, line in lines]
+    bounds = [
+        (min(p.x for p in line.points), min(p.y for p in line.points),
+         max(p.x for p in line.points), max(p.y for p in line.points))
+        for _, line in lines
+    ]
+    eraser_count = 0
+
+    for index, (item, line) in enumerate(lines):
+        if line.tool not in ERASER_TOOLS:
+            continue
+        eraser_count += 1
+        item.value = None
+
+        if erasers != Erasers.SUBTRACT:
+            continue
+        region = eraser_region(line)
+        x0, y0, x1, y1 = region.bounds
+        for covered in range(index):
+            other_item, other = lines[covered]
+            bx0, by0, bx1, by1 = bounds[covered]
+            if other_item.value is None or bx0 > x1 or bx1 < x0 or by0 > y1 or by1 < y0:
+                continue
+            xs = np.fromiter((p.x for p in other.points), dtype=float, count=len(other.points))
+            ys = np.fromiter((p.y for p in other.points), dtype=float, count=len(other.points))
+            erased[covered] |= shapely.contains_xy(region, xs, ys)
+
+    erased_points = 0
+    for (item, line), line_erased in zip(lines, erased):
+        if item.value is None or not line_erased.any():
+            continue
+        erased_points += int(line_erased.sum())
+        pieces = split_at_erased_points(line, line_erased)
+        if not pieces:
+            item.value = None
+        elif len(pieces) == 1:
+            item.value = pieces[0]
+        else:
+            item.value = as_group(pieces, item.item_id)
+
+    return eraser_count, erased_points
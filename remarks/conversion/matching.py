@@ -0,0 +1,52 @@
+from collections import deque
+from typing import Dict, Iterator, List, Tuple
+
+
+class AhoCorasick:
+    """
+    Finds every occurrence of many patterns in a text in a single pass over the text, however many patterns there
+    are. Build it once, then `find` in as many texts as needed.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        # a trie of the patterns, state 0 is the root
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # the patterns that end in every state, by index into `patterns`
+        self.output: List[List[int]] = [[]]
+
+        for index, pattern in enumerate(patterns):
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(index)
+
+        # breadth first, so the failure state of every parent is known before its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text: str) -> Iterator[Tuple[int, int]]:
+        """Every occurrence of every pattern in `text`, as (start, pattern index), ordered by where they end"""
+        state = 0
+        for end, char in enumerate(text, start=1):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for index in self.output[state]:
+                yield end - len(self.patterns[index]), index
@@ -7,13 +7,14 @@ from typing import Dict, List, Any, TypedDict, Tuple
 
 import shapely.geometry as geom  # Shapely
 from rmscene import read_blocks, SceneTree, build_tree, RootTextBlock, LwwValue
-from rmscene.scene_items import Line, GlyphRange, Rectangle, ParagraphStyle, END_MARKER
+from rmscene.scene_items import Line, GlyphRange, Pen, Rectangle, ParagraphStyle, END_MARKER
 from rmscene.text import TextDocument
 
 from ..metadata import ReMarkableAnnotationsFileHeaderVersion
 from ..utils import (
     RM_WIDTH,
     RM_HEIGHT,
+    warn_once,
 )
 
 from ..dimensions import ReMarkableDimensions, REMARKABLE_DOCUMENT
@@ -200,7 +201,7 @@ def parse_v6(file_path: str) -> Tuple[TLayers, bool]:
                         layer["strokes"] = update_stroke_dict(layer["strokes"], tool)
                     layer["strokes"][tool]["segments"].append(segment)
         except AssertionError:
-            print("ReMarkable broken data")
+            logging.warning("ReMarkable broken data")
 
     return output, False
 
@@ -260,7 +261,7 @@ def determine_document_dimensions(file_path) -> ReMarkableDimensions:
                     for p in el.points:
                         update_boundaries_from_point(p.x, p.y, dims)
         except AssertionError:
-            print("ReMarkable broken data")
+            logging.warning("ReMarkable broken data")
 
     return ReMarkableDimensions(
         dims["x_max"] - dims["x_min"], dims["y_max"] - dims["y_min"]
@@ -290,6 +291,24 @@ def read_rm_file_version(file_path: str) -> ReMarkableAnnotationsFileHeaderVersi
 
 
 
+def has_visible_content(tree: SceneTree, highlights: bool = False) -> bool:
+    """Whether drawing `tree` puts anything on the page: a stroke or text, and with `highlights=True` a highlight.
+    The renderers don't draw highlights, only native highlights put them on the page.
+
+    Pages where everything was erased, or that were only opened and got an empty layer, have none.
+    Area eraser strokes are drawn fully transparent and don't count."""
+    if tree.root_text is not None and any(
+            isinstance(value, str) and value.strip() for value in tree.root_text.items.values()
+    ):
+        return True
+    for item in tree.walk():
+        if isinstance(item, GlyphRange) and highlights:
+            return True
+        if isinstance(item, Line) and item.points and item.tool != Pen.ERASER_AREA:
+            return True
+    return False
+
+
 def check_rm_file_version(file_path):
     with open(file_path, "rb") as f:
         data = f.read()
@@ -442,13 +461,7 @@ def rescale_parsed_data(
     return parsed_data
 
 
-# The line segment will pop up hundreds or thousands of times in notebooks where it is relevant.
-# this flag ensures it will print at most once.
-_line_segment_warning_has_been_shown = False
-
-
 def get_ann_max_bound(parsed_data):
-    global _line_segment_warning_has_been_shown
     # https://shapely.readthedocs.io/en/stable/manual.html#LineString
     # https://shapely.readthedocs.io/en/stable/manual.html#MultiLineString
     # https://shapely.readthedocs.io/en/stable/manual.html#object.bounds
@@ -461,12 +474,11 @@ def get_ann_max_bound(parsed_data):
                 for points in sg_value["points"]:
                     if len(points) <= 1:
                         # line needs at least two points, see testcase v2_notebook_complex
-                        if not _line_segment_warning_has_been_shown:
-                            logging.warning(
-                                "- Found a segment with a single point, will ignore it. Please report this "
-                                "issue at: https://github.com/lucasrla/remarks/issues/64 "
-                            )
-                            _line_segment_warning_has_been_shown = True
+                        # The line segment will pop up hundreds or thousands of times in notebooks where it is relevant
+                        warn_once(
+                            "- Found a segment with a single point, will ignore it. Please report this "
+                            "issue at: https://github.com/lucasrla/remarks/issues/64 "
+                        )
                         continue
                     line = geom.LineString([(float(p[0]), float(p[1])) for p in points])
                     collection.append(line)
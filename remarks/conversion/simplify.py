@@ -0,0 +1,131 @@
+from typing import List, Tuple
+
+import numpy as np
+from rmc.exporters.svg import SCALE
+from rmscene import SceneTree
+from rmscene.scene_items import Line
+
+
+def ramer_douglas_peucker(points: np.ndarray, offsets: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Ramer–Douglas–Peucker over many strokes at once.
+
+    Args:
+        points: The points of all strokes one after another, shape (n, 2)
+        offsets: Where each stroke starts in `points`, followed by `len(points)`
+        tolerance: Points closer than this to the simplified stroke are dropped, in the unit of `points`
+
+    Returns:
+        A boolean mask over `points`, true for the points to keep. The first and last point of a stroke are always kept
+
+    Every round splits all open intervals of all strokes at their farthest point, so the number of numpy calls depends
+    on how deep the splitting goes, not on the number of strokes or points.
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    starts, ends = offsets[:-1], offsets[1:] - 1
+    non_empty = ends >= starts
+    starts, ends = starts[non_empty], ends[non_empty]
+    keep[starts] = True
+    keep[ends] = True
+
+    while True:
+        has_inner_points = ends - starts > 1
+        starts, ends = starts[has_inner_points], ends[has_inner_points]
+        if len(starts) == 0:
+            return keep
+
+        # every inner point of every interval, and the interval it belongs to
+        counts = ends - starts - 1
+        group_starts = np.cumsum(counts) - counts
+        interval = np.repeat(np.arange(len(starts)), counts)
+        indices = np.arange(counts.sum()) - group_starts[interval] + starts[interval] + 1
+
+        a, b, p = points[starts][interval], points[ends][interval], points[indices]
+        chord = b - a
+        chord_length = np.hypot(chord[:, 0], chord[:, 1])
+        to_point = p - a
+        cross = np.abs(chord[:, 0] * to_point[:, 1] - chord[:, 1] * to_point[:, 0])
+        # a stroke that ends where it started has no chord, measure from the start instead
+        distance = np.where(
+            chord_length > 0,
+            cross / np.where(chord_length > 0, chord_length, 1),
+            np.hypot(to_point[:, 0], to_point[:, 1]),
+        )
+
+        # the farthest point of every interval comes first when sorted by interval, then by distance descending
+        farthest = indices[np.lexsort((-distance, interval))[group_starts]]
+        split = distance[farthest - starts - 1 + group_starts] > tolerance
+
+        starts, ends, farthest = starts[split], ends[split], farthest[split]
+        keep[farthest] = True
+        starts, ends = np.concatenate([starts, farthest]), np.concatenate([farthest, ends])
+
+
+def quantize(points: np.ndarray, offsets: np.ndarray, step: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Round `points` to multiples of `step`. Returns the rounded points and a mask that drops the points that became
+    equal to the point before them in the same stroke"""
+    points = np.round(points / step) * step
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+    keep[offsets[:-1][offsets[:-1] < len(points)]] = True
+    return points, keep
+
+
+def simplify_strokes(
+        strokes: List[np.ndarray], tolerance: float = None, decimals: int = None
+) -> List[np.ndarray]:
+    """
+    Simplify strokes given as arrays of shape (n, 2).
+
+    Returns the indices of the points to keep for every stroke. Coordinates are changed in place when `decimals` is set.
+    """
+    offsets = np.cumsum([0] + [len(stroke) for stroke in strokes])
+    if offsets[-1] == 0:
+        return [np.arange(0) for _ in strokes]
+    points = np.concatenate(strokes).astype(float)
+
+    keep = np.ones(len(points), dtype=bool)
+    if tolerance:
+        keep = ramer_douglas_peucker(points, offsets, tolerance)
+    if decimals is not None:
+        kept_offsets = np.cumsum([0] + [keep[start:end].sum() for start, end in zip(offsets[:-1], offsets[1:])])
+        rounded, distinct = quantize(points[keep], kept_offsets, 10.0 ** -decimals)
+        points[keep] = rounded
+        keep[np.flatnonzero(keep)[~distinct]] = False
+
+    indices = []
+    for stroke, start, end in zip(strokes, offsets[:-1], offsets[1:]):
+        stroke[:] = points[start:end]
+        indices.append(np.flatnonzero(keep[start:end]))
+    return indices
+
+
+def simplify_scene_tree(tree: SceneTree, tolerance: float = None, decimals: int = None) -> Tuple[int, int]:
+    """
+    Simplify every stroke of `tree` in place before it is drawn.
+
+    Args:
+        tree: A scene tree, as read from a v6 .rm file
+        tolerance: The Ramer–Douglas–Peucker tolerance, in points of the output PDF
+        decimals: Round coordinates to this many decimals, in points of the output PDF
+
+    Returns:
+        The number of points before and after
+    """
+    lines = [item for item in tree.walk() if isinstance(item, Line) and item.points]
+    strokes = [np.array([(point.x, point.y) for point in line.points], dtype=float) * SCALE for line in lines]
+    points_before = sum(len(line.points) for line in lines)
+
+    indices = simplify_strokes(strokes, tolerance, decimals)
+
+    points_after = 0
+    for line, stroke, kept in zip(lines, strokes, indices):
+        points = []
+        for i in kept:
+            point = line.points[i]
+            point.x, point.y = (float(c) for c in stroke[i] / SCALE)
+            points.append(point)
+        line.points = points
+        points_after += len(points)
+
+    return points_before, points_after
@@ -2,11 +2,30 @@ from itertools import groupby
 import operator
 
 import fitz
+import numpy as np
+
+from .matching import AhoCorasick
+
+
+# The helpers that work on a page's text layer, `prepare_md_from_page` and what it calls, are library functions.
+# `process_document` doesn't use them, its markdown comes from the .rm files and smart highlights, see
+# `ObsidianMarkdownFile`. Only `group_smart_highlights` is part of a conversion.
+
+# See `get_page_text_tuples` for what they mean
+TEXT_FLAGS = 1 + 2 + 16 + 64
+
+
+def get_textpage(page, flags=TEXT_FLAGS):
+    """
+    Extract the text of `page` once, for all of `check_if_text_extractable`, `extract_groups_from_pdf_ann_hl` and
+    `prepare_md_from_hl_groups`. Without a `textpage`, each of them makes PyMuPDF extract the whole page again.
+    """
+    return page.get_textpage(flags=flags)
 
 
 # TODO: improve this check, it is still very rudimentary
-def check_if_text_extractable(page):
-    text_encoded = page.get_text("text").encode("utf-8")
+def check_if_text_extractable(page, textpage=None):
+    text_encoded = page.get_text("text", textpage=textpage).encode("utf-8")
     # print(text_encoded)
 
     if len(text_encoded) == 0:  # empty, likely a scanned page
@@ -63,8 +82,60 @@ def get_highlight_rects(page, sort=True):
     return hl_rects
 
 
+def intersecting_rects_mask(rects, others) -> np.ndarray:
+    """
+    For every rect in `rects`, whether it intersects any rect in `others`, like `fitz.Rect.intersects` does: they
+    have to overlap by more than an edge, and empty rects intersect nothing.
+
+    Both are sequences of (x0, y0, x1, y1). `others` are indexed in horizontal bands about as high as an average
+    one, so every rect is only tested against the few `others` that share a band with it. A page of words against
+    many highlights takes linear time instead of words × highlights.
+    """
+    rects = np.asarray(rects, dtype=float).reshape(-1, 4)
+    others = np.asarray(others, dtype=float).reshape(-1, 4)
+    mask = np.zeros(len(rects), dtype=bool)
+
+    others = others[(others[:, 0] < others[:, 2]) & (others[:, 1] < others[:, 3])]
+    valid = np.flatnonzero((rects[:, 0] < rects[:, 2]) & (rects[:, 1] < rects[:, 3]))
+    if len(others) == 0 or len(valid) == 0:
+        return mask
+
+    band_height = max(float(np.median(others[:, 3] - others[:, 1])), 1.0)
+    origin = others[:, 1].min()
+
+    def bands(boxes):
+        """Every (band, box index) pair, sorted by band"""
+        first = np.floor((boxes[:, 1] - origin) / band_height).astype(np.int64)
+        last = np.floor((boxes[:, 3] - origin) / band_height).astype(np.int64)
+        counts = last - first + 1
+        index = np.repeat(np.arange(len(boxes)), counts)
+        band = first[index] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        order = np.argsort(band, kind="stable")
+        return band[order], index[order]
+
+    other_bands, other_index = bands(others)
+    rect_bands, rect_index = bands(rects[valid])
+
+    # every rect against the others in the same band
+    lo = np.searchsorted(other_bands, rect_bands, side="left")
+    hi = np.searchsorted(other_bands, rect_bands, side="right")
+    counts = hi - lo
+    pair_rect = np.repeat(rect_index, counts)
+    pair_other = other_index[
+        np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    ]
+
+    a, b = rects[valid][pair_rect], others[pair_other]
+    hits = (
+        (np.maximum(a[:, 0], b[:, 0]) < np.minimum(a[:, 2], b[:, 2]))
+        & (np.maximum(a[:, 1], b[:, 1]) < np.minimum(a[:, 3], b[:, 3]))
+    )
+    mask[valid[pair_rect[hits]]] = True
+    return mask
+
+
 def get_page_text_tuples(
-    page, option="words", flags=(1 + 2 + 16 + 64), sort=True, text_only=False
+    page, option="words", flags=TEXT_FLAGS, sort=True, text_only=False, textpage=None
 ):
     # https://pymupdf.readthedocs.io/en/latest/app1.html#text-extraction-flags-defaults
     # https://pymupdf.readthedocs.io/en/latest/vars.html#textpreserve
@@ -85,7 +156,8 @@ def get_page_text_tuples(
 
     # For "blocks" is basically the same!
 
-    tuples_list = page.get_text(option, flags=flags, sort=sort)
+    # A `textpage` from `get_textpage` was extracted already, `flags` are ignored then
+    tuples_list = page.get_text(option, flags=flags, sort=sort, textpage=textpage)
 
     # https://pymupdf.readthedocs.io/en/latest/textpage.html#TextPage.extractWORDS
     # example of a word tuple:
@@ -101,7 +173,7 @@ def get_page_text_tuples(
         return tuples_list
 
 
-def extract_groups_from_pdf_ann_hl(page, malformed=False):
+def extract_groups_from_pdf_ann_hl(page, malformed=False, textpage=None):
     # https://pymupdf.readthedocs.io/en/latest/recipes-text.html#how-to-extract-text-from-within-a-rectangle
     # https://github.com/pymupdf/PyMuPDF-Utilities/tree/master/textbox-extraction
     # https://github.com/benlongo/remarkable-highlights/blob/0608dea6ba1f5ce46c540e623c55649f8f918b5c/remarkable_highlights/extract.py#L131
@@ -110,7 +182,7 @@ def extract_groups_from_pdf_ann_hl(page, malformed=False):
     is_sort_needed = malformed
 
     # Get all words (highlighted or not) from a PDF page
-    words_tuples_list = get_page_text_tuples(page, sort=is_sort_needed)
+    words_tuples_list = get_page_text_tuples(page, sort=is_sort_needed, textpage=textpage)
     # print("words_tuples_list:", words_tuples_list)
 
     # Get all rectangles of highlight annotations that exist on PDF page
@@ -122,16 +194,14 @@ def extract_groups_from_pdf_ann_hl(page, malformed=False):
     # An alternative for the method below would be to use word numbers
     # and order words within each "block"
 
+    # Create a boolean mask for each word, depending on whether it was
+    # highlighted (or not)
+    #
+    # w[:4] for the bbbox coordinates of a word tuple: (x0, y0, x1, y1)
+    hl_words_mask = intersecting_rects_mask([w[:4] for w in words_tuples_list], hl_rects)
+
     # If "wellformed"
     if not malformed:
-        # Create a boolean mask for each word, depending on whether it was
-        # highlighted (or not)
-        #
-        # w[:4] for the bbbox coordinates of a word tuple: (x0, y0, x1, y1)
-        hl_words_mask = [
-            any([fitz.Rect(w[:4]).intersects(r) for r in hl_rects])
-            for w in words_tuples_list
-        ]
 
         # Join each sequence of consecutively highlighted words into a group
         curr_group = []
@@ -159,17 +229,11 @@ def extract_groups_from_pdf_ann_hl(page, malformed=False):
         # limitations. For instance: (1) we won't "merge" highlighted words
         # that are separated by line breaks; (2) we might "merge" words that
         # are in the same line but were highlighted separately
-        hl_word_tuples = []
-        for word_tuple in words_tuples_list:
-            already_highlighted = False
-            for hl_rect in hl_rects:
-                if (
-                    fitz.Rect(word_tuple[:4]).intersects(hl_rect)
-                    and not already_highlighted
-                ):
-                    # print("hl_rect + word_tuple:", hl_rect, word_tuple)
-                    hl_word_tuples.append(word_tuple)
-                    already_highlighted = True
+        hl_word_tuples = [
+            word_tuple
+            for word_tuple, is_highlighted in zip(words_tuples_list, hl_words_mask)
+            if is_highlighted
+        ]
 
         # print("hl_word_tuples:", hl_word_tuples)
 
@@ -184,47 +248,35 @@ def extract_groups_from_pdf_ann_hl(page, malformed=False):
 
 
 def extract_groups_from_smart_hl(hl_data):
-    hl_list = hl_data["highlights"][0]
+    return group_smart_highlights(hl_data["highlights"][0])
 
+
+def group_smart_highlights(hl_list, gap=2):
+    """
+    Join smart highlights that follow each other into groups of their texts, in a single pass over them in text
+    order. `hl_list` is left as it is.
+
+    `start` and `length` seem to be character-based counts. A highlight starts a new group when it begins more than
+    `gap` characters after the one before it ends, or when the one before it fully contains it.
+    """
     # Sorting is needed because highlights are added to list according to
     # "timestamp", not necessarily natural order
     sorted_hl_list = sorted(hl_list, key=operator.itemgetter("start"))
 
-    # Create a new key for easier iteration over highlights.
-    # `start` and `length` seem to be character-based counts
-    for hl in sorted_hl_list:
-        hl["end"] = hl["start"] + hl["length"]
-
-    curr_group = []
     hl_word_groups = []
+    curr_group = []
+    prev_end = None
 
-    for i, hl in enumerate(sorted_hl_list):
+    for hl in sorted_hl_list:
+        end = hl["start"] + hl["length"]
+        if prev_end is not None and (prev_end + gap < hl["start"] or (prev_end > hl["start"] and prev_end > end)):
+            hl_word_groups.append(curr_group)
+            curr_group = []
         curr_group.append(hl["text"])
-        # print("curr_group:", curr_group)
-
-        # Number of characters to act as a tolerance between groups
-        gap = 2
-
-        # This is not the last item
-        if (i + 1) < len(sorted_hl_list):
-            hl_next = sorted_hl_list[i + 1]
-
-            # Is the next highlight fully "contained" within the current one?
-            curr_contains_next = (
-                hl["end"] > hl_next["start"] and hl["end"] > hl_next["end"]
-            )
+        prev_end = end
 
-            # Start a new group to split highlights apart if either the
-            # (current highlight + gap) ends before the next one OR the current
-            # highlight fully contains the next one
-            if hl["end"] + gap < hl_next["start"] or curr_contains_next:
-                hl_word_groups.append(curr_group)
-                curr_group = []
-                # print("smart_hl_word_groups:", hl_word_groups)
-
-        # For the last one
-        else:
-            hl_word_groups.append(curr_group)
+    if curr_group:
+        hl_word_groups.append(curr_group)
 
     # print("smart_hl_word_groups:", hl_word_groups)
     return hl_word_groups
@@ -235,6 +287,7 @@ def prepare_md_from_hl_groups(
     ann_hl_groups,
     smart_hl_groups,
     presentation="whole_block",
+    textpage=None,
 ):
     hl_word_groups = ann_hl_groups + smart_hl_groups
     # print("hl_word_groups", hl_word_groups)
@@ -243,12 +296,16 @@ def prepare_md_from_hl_groups(
         # TODO: Should we avoid sorting here if PDF is well-formed? Need some
         # ugly documents to dig deeper and test this out...
         text_blocks_list = get_page_text_tuples(
-            page, option="blocks", sort=True, text_only=True
+            page, option="blocks", sort=True, text_only=True, textpage=textpage
         )
         # print("text_blocks_list:", text_blocks_list)
 
         md_blocks_with_marks = []
-        already_matched = []
+
+        # Every distinct highlight, in the order they were made. All of them are looked for in a block at once
+        hl_group_strs = list(dict.fromkeys(" ".join(hl_group) for hl_group in hl_word_groups))
+        matcher = AhoCorasick(hl_group_strs)
+        already_matched = set()
 
         for text_block in text_blocks_list:
             # Remove any \n \t double/triple/multiple spaces inside a block
@@ -256,33 +313,38 @@ def prepare_md_from_hl_groups(
             text_block_str = " ".join(text_block.split())
             # print(f"text_block_str: {text_block_str}")
 
-            has_highlight = False
-            md_str = text_block_str
-
-            for hl_group in hl_word_groups:
-                hl_group_str = " ".join(hl_group)
-                # print(f"hl_group_str: {hl_group_str}")
-                if hl_group_str in text_block_str and hl_group not in already_matched:
-                    md_str = md_str.replace(
-                        hl_group_str, f"<mark>{hl_group_str}</mark>"
-                    )
-                    has_highlight = True
-                    already_matched.append(hl_group)
-
-            # TODO: Are these quick fixes for consecutive mark still necessary?
-            if has_highlight:
-                md_str = md_str.replace("</mark>\n<mark>", " ")
-                md_str = md_str.replace("</mark> <mark>", " ")
-                md_blocks_with_marks.append(md_str)
+            occurrences = list(matcher.find(text_block_str))
+            # A highlight is marked in the first block that contains it
+            found = {index for _, index in occurrences} - already_matched
+            if not found:
+                continue
+            already_matched |= found
+
+            # Highlights that overlap, or that only a space separates, become a single mark
+            spans = sorted(
+                (start, start + len(hl_group_strs[index])) for start, index in occurrences if index in found
+            )
+            marks = []
+            for start, end in spans:
+                if marks and (start <= marks[-1][1] or start == marks[-1][1] + 1 and text_block_str[start - 1] == " "):
+                    marks[-1][1] = max(marks[-1][1], end)
+                else:
+                    marks.append([start, end])
+
+            md_parts = []
+            position = 0
+            for start, end in marks:
+                md_parts.append(text_block_str[position:start])
+                md_parts.append(f"<mark>{text_block_str[start:end]}</mark>")
+                position = end
+            md_parts.append(text_block_str[position:])
+            md_blocks_with_marks.append("".join(md_parts))
 
         # In case any `hl_group_str` is not contained in any text_block_str,
         # something which actually happens -- PDFs are crazy things!
-        if len(hl_word_groups) > len(already_matched):
-            for hl_group in hl_word_groups:
-                if hl_group not in already_matched:
-                    hl_group_str = " ".join(hl_group)
-                    md_str = f"<mark>{hl_group_str}</mark>"
-                    md_blocks_with_marks.append(md_str)
+        for index, hl_group_str in enumerate(hl_group_strs):
+            if index not in already_matched:
+                md_blocks_with_marks.append(f"<mark>{hl_group_str}</mark>")
 
         # print("md_blocks_with_marks:", md_blocks_with_marks)
 
@@ -297,3 +359,14 @@ def prepare_md_from_hl_groups(
         raise ValueError(
             "Invalid formatting for Markdown. Check your `--hl_md_format` flag"
         )
+
+
+def prepare_md_from_page(page, smart_hl_groups=(), presentation="whole_block"):
+    """The Markdown for the highlight annotations of `page` and its `smart_hl_groups`, extracting the page's text
+    a single time for all steps"""
+    textpage = get_textpage(page)
+    malformed = not check_if_text_extractable(page, textpage=textpage)
+    ann_hl_groups = extract_groups_from_pdf_ann_hl(page, malformed=malformed, textpage=textpage)
+    return prepare_md_from_hl_groups(
+        page, ann_hl_groups, list(smart_hl_groups), presentation=presentation, textpage=textpage
+    )
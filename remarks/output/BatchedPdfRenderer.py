@@ -0,0 +1,199 @@
+import math
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import fitz
+from rmc.exporters.svg import LINE_HEIGHTS, TEXT_TOP_Y, build_anchor_pos, get_anchor, get_bounding_box, xx, yy
+from rmc.exporters.writing_tools import Pen
+from rmscene import SceneTree
+from rmscene import scene_items as si
+from rmscene.text import TextDocument
+
+# Inkscape reads the unitless size of rmc's SVG as CSS pixels, 3/4 of a point. Pages are drawn at that same size, so
+# both renderers produce pages that can take each other's place.
+SVG_PX_TO_PT = 0.75
+
+# Pressure sensitive pens give every segment a slightly different width. Widths are rounded to this many points,
+# finer than anyone can see, so that segments batch together.
+WIDTH_STEP = 0.05
+
+RGB_PATTERN = re.compile(r"\d+")
+
+# Mirrors the CSS that rmc puts in its SVG, by paragraph style. The font size is in points already
+TEXT_STYLES = {
+    "heading": ("tiro", 14),
+    "bold": ("hebo", 8),
+}
+DEFAULT_TEXT_STYLE = ("helv", 7)
+
+LINE_CAPS = {"butt": 0, "round": 1, "square": 2}
+
+# color, width, opacity, line cap
+StrokeStyle = Tuple[Tuple[float, float, float], float, float, int]
+
+
+# Plain tuples instead of fitz.Point and fitz.Rect, pages easily hold tens of thousands of points
+Point = Tuple[float, float]
+# x0, y0, x1, y1
+Bounds = Tuple[float, float, float, float]
+
+
+def intersects(a: Bounds, b: Bounds) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def paint_order_irrelevant(a: StrokeStyle, b: StrokeStyle) -> bool:
+    """Whether overlapping segments of these styles look the same whichever is painted first"""
+    return a[0] == b[0] and a[2] == 1 and b[2] == 1
+
+
+@dataclass
+class StrokeBatch:
+    """Segments that share their style, drawn as one path with one graphics state"""
+
+    style: StrokeStyle
+    polylines: List[List[Point]] = field(default_factory=list)
+    bounds: Bounds = (math.inf, math.inf, -math.inf, -math.inf)
+
+    def add(self, polyline: List[Point], bounds: Bounds):
+        self.polylines.append(polyline)
+        self.bounds = (
+            min(self.bounds[0], bounds[0]),
+            min(self.bounds[1], bounds[1]),
+            max(self.bounds[2], bounds[2]),
+            max(self.bounds[3], bounds[3]),
+        )
+
+
+class StrokeBatcher:
+    """
+    Groups stroke segments by style without changing what the page looks like.
+
+    A segment joins the open batch of its style, unless it overlaps a batch that was started after that one. Batches are
+    drawn in the order they were started, a segment that joins an older batch is drawn before those newer batches.
+    That is invisible when they don't overlap, or when both are opaque and of the same color, like the segments of a
+    pressure sensitive stroke that only differ in width. Otherwise the segment starts a new batch.
+    """
+
+    def __init__(self):
+        self.batches: List[StrokeBatch] = []
+        self.open_batches: Dict[StrokeStyle, int] = {}
+
+    def add(self, style: StrokeStyle, polyline: List[Point]):
+        xs = [x for x, _ in polyline]
+        ys = [y for _, y in polyline]
+        # a stroke paints up to half its width beyond its points, square caps reach a little further
+        margin = style[1]
+        bounds = (min(xs) - margin, min(ys) - margin, max(xs) + margin, max(ys) + margin)
+
+        index = self.open_batches.get(style)
+        if index is None or any(
+                intersects(batch.bounds, bounds) and not paint_order_irrelevant(batch.style, style)
+                for batch in self.batches[index + 1:]
+        ):
+            index = len(self.batches)
+            self.batches.append(StrokeBatch(style))
+            self.open_batches[style] = index
+        self.batches[index].add(polyline, bounds)
+
+
+def rgb(color: str) -> Tuple[float, float, float]:
+    """rmc's pens return colors as "rgb(r, g, b)" strings"""
+    r, g, b = (int(c) / 255 for c in RGB_PATTERN.findall(color))
+    return r, g, b
+
+
+def stroke_segments(line: si.Line, to_page) -> Iterator[Tuple[StrokeStyle, List[Point]]]:
+    """The polylines rmc's `draw_stroke` writes for `line`, with their style"""
+    pen = Pen.create(line.tool.value, line.color.value, line.thickness_scale)
+    line_cap = LINE_CAPS.get(pen.stroke_linecap, 1)
+
+    style: Optional[StrokeStyle] = None
+    polyline: List[Point] = []
+    last_segment_width = 0
+    for point_id, point in enumerate(line.points):
+        if point_id % pen.segment_length == 0:
+            if style is not None:
+                yield style, polyline
+            args = point.speed, point.direction, point.width, point.pressure, last_segment_width
+            segment_width = pen.get_segment_width(*args)
+            width = round(xx(segment_width) * SVG_PX_TO_PT / WIDTH_STEP) * WIDTH_STEP
+            opacity = round(min(max(pen.get_segment_opacity(*args), 0), 1), 2)
+            style = (rgb(pen.get_segment_color(*args)), width, opacity, line_cap)
+            # join to the previous segment
+            polyline = polyline[-1:]
+            last_segment_width = segment_width
+        polyline.append(to_page(xx(point.x), yy(point.y)))
+    if style is not None:
+        yield style, polyline
+
+
+def tree_to_pdf(tree: SceneTree) -> Tuple[fitz.Document, Tuple[float, float, float, float]]:
+    """
+    Draw `tree` on a single page PDF, like rmc's `tree_to_svg` followed by Inkscape would.
+
+    Returns the document and the SVG viewBox rmc would have written: x, y, width and height in SVG units.
+    """
+    anchor_pos = build_anchor_pos(tree.root_text)
+    x_min, x_max, y_min, y_max = get_bounding_box(tree.root, anchor_pos)
+    width, height = xx(x_max - x_min + 1), yy(y_max - y_min + 1)
+    viewbox = (xx(x_min), yy(y_min), width, height)
+
+    doc = fitz.open()
+    page = doc.new_page(width=width * SVG_PX_TO_PT, height=height * SVG_PX_TO_PT)
+
+    batcher = StrokeBatcher()
+
+    def add_group(group: si.Group, offset_x: float, offset_y: float):
+        anchor_x, anchor_y = get_anchor(group, anchor_pos)
+        offset_x, offset_y = offset_x + xx(anchor_x), offset_y + yy(anchor_y)
+
+        def to_page(x, y) -> Point:
+            return (x + offset_x - viewbox[0]) * SVG_PX_TO_PT, (y + offset_y - viewbox[1]) * SVG_PX_TO_PT
+
+        for child in group.children.values():
+            if isinstance(child, si.Group):
+                add_group(child, offset_x, offset_y)
+            elif isinstance(child, si.Line):
+                for style, polyline in stroke_segments(child, to_page):
+                    _, stroke_width, opacity, _ = style
+                    # a single point draws nothing, neither does an invisible or negative width segment
+                    if len(polyline) > 1 and stroke_width > 0 and opacity > 0:
+                        batcher.add(style, polyline)
+
+    if tree.root_text is not None:
+        draw_text(page, tree.root_text, viewbox)
+    add_group(tree.root, 0, 0)
+
+    shape = page.new_shape()
+    page_height = page.rect.height
+    for batch in batcher.batches:
+        color, width, opacity, line_cap = batch.style
+        # Shape.draw_polyline creates a fitz.Point for every point, writing the path operators is a lot faster.
+        # Shape coordinates are PDF coordinates, y goes up
+        path = []
+        for polyline in batch.polylines:
+            (x, y), *rest = polyline
+            path.append(f"{x:.2f} {page_height - y:.2f} m\n")
+            path.extend(f"{x:.2f} {page_height - y:.2f} l\n" for x, y in rest)
+        shape.draw_cont += "".join(path)
+        shape.finish(color=color, width=width, stroke_opacity=opacity, lineCap=line_cap, closePath=False)
+    shape.commit()
+
+    return doc, viewbox
+
+
+def draw_text(page: fitz.Page, text: si.Text, viewbox: Tuple[float, float, float, float]):
+    """The text lines of rmc's `draw_text`"""
+    y_offset = TEXT_TOP_Y
+    for paragraph in TextDocument.from_scene_item(text).contents:
+        y_offset += LINE_HEIGHTS.get(paragraph.style.value, 70)
+        if not str(paragraph):
+            continue
+        fontname, fontsize = TEXT_STYLES.get(paragraph.style.value.name.lower(), DEFAULT_TEXT_STYLE)
+        position = fitz.Point(
+            (xx(text.pos_x) - viewbox[0]) * SVG_PX_TO_PT,
+            (yy(text.pos_y + y_offset) - viewbox[1]) * SVG_PX_TO_PT,
+        )
+        page.insert_text(position, str(paragraph).strip(), fontname=fontname, fontsize=fontsize)
@@ -0,0 +1,50 @@
+from typing import List, Tuple
+
+import fitz
+from rmc.exporters.writing_tools import RM_PALETTE
+from rmscene.scene_items import GlyphRange, PenColor
+
+# All highlighter colors of the device are stored as PenColor.HIGHLIGHT, which rmc's palette leaves out.
+# This is the yellow the device draws them in
+HIGHLIGHT_YELLOW = (255, 237, 117)
+
+
+def highlight_color(color: PenColor) -> Tuple[float, float, float]:
+    r, g, b = RM_PALETTE.get(color, HIGHLIGHT_YELLOW)
+    return r / 255, g / 255, b / 255
+
+
+def add_highlight_annotations(
+        page: fitz.Page, highlights: List[GlyphRange], origin: Tuple[float, float], scale: float
+) -> int:
+    """
+    Add every `GlyphRange` in `highlights` to `page` as a PDF highlight annotation, in its own color.
+
+    Unlike strokes, these leave the text they cover selectable, and `get_highlight_rects` reads them back without
+    having to look at the page's contents.
+
+    Args:
+        page: The page to annotate
+        highlights: The highlights of the page, as parsed from its .rm file
+        origin: Where x = 0, y = 0 of the .rm file is on `page`
+        scale: Page units per .rm unit
+
+    Returns:
+        The number of annotations added
+    """
+    origin_x, origin_y = origin
+    for highlight in highlights:
+        rects = [
+            fitz.Rect(
+                origin_x + rect.x * scale,
+                origin_y + rect.y * scale,
+                origin_x + (rect.x + rect.w) * scale,
+                origin_y + (rect.y + rect.h) * scale,
+            )
+            for rect in highlight.rectangles
+        ]
+        annot = page.add_highlight_annot(quads=rects)
+        annot.set_colors(stroke=highlight_color(highlight.color))
+        annot.set_info(content=highlight.text)
+        annot.update()
+    return len(highlights)
@@ -0,0 +1,177 @@
+import logging
+import os
+import queue
+import re
+import select
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import Optional
+
+# Inkscape prints this prompt when it is ready for the next line of actions
+PROMPT = b"> "
+
+# Paths that can go in a line of actions as they are. ";" separates actions and ":" an action from its argument,
+# Inkscape has no way to escape them
+ACTION_SAFE_PATH = re.compile(r"^[\w/\\. -]+$")
+
+INKSCAPE_PATHS = ["inkscape", "/Applications/Inkscape.app/Contents/MacOS/inkscape"]
+
+
+class ConversionError(Exception):
+    pass
+
+
+def find_inkscape() -> Optional[str]:
+    for path in INKSCAPE_PATHS:
+        found = shutil.which(path)
+        if found:
+            return found
+    return None
+
+
+class InkscapeShell:
+    """
+    A single long running `inkscape --shell` that converts SVG files to PDF, one line of actions per file.
+
+    Every shell has a profile directory of its own, Inkscape instances that share one step on each other's
+    preferences and caches. A shell that crashes or stops answering is killed and started again, and a shell is
+    restarted after `max_conversions` files to keep Inkscape's memory in check.
+    """
+
+    def __init__(self, inkscape: str, timeout: float = 60, max_conversions: int = 200):
+        self.inkscape = inkscape
+        self.timeout = timeout
+        self.max_conversions = max_conversions
+        self.profile_dir = tempfile.mkdtemp(prefix="remarks-inkscape-")
+        self.process: Optional[subprocess.Popen] = None
+        self.conversions = 0
+
+    def start(self):
+        env = dict(os.environ)
+        env["INKSCAPE_PROFILE_DIR"] = self.profile_dir
+        # https://gitlab.com/inkscape/inkscape/-/issues/4716#note_1898150983
+        env["SELF_CALL"] = "true"
+        self.process = subprocess.Popen(
+            [self.inkscape, "--shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=env,
+        )
+        self.conversions = 0
+        self._read_until_prompt()
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write(b"quit\n")
+            self.process.stdin.flush()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def close(self):
+        self.stop()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+    def _read_until_prompt(self):
+        deadline = time.monotonic() + self.timeout
+        output = b""
+        fd = self.process.stdout.fileno()
+        while not output.endswith(PROMPT):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ConversionError(f"Inkscape didn't answer within {self.timeout}s")
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise ConversionError(f"Inkscape exited with {self.process.wait()}")
+            output += chunk
+
+    def convert(self, svg_path: str, pdf_path: str):
+        """Convert `svg_path` to `pdf_path`, restarting Inkscape once if it fails"""
+        for attempt in range(2):
+            try:
+                if self.process is None or self.process.poll() is not None:
+                    self.start()
+                elif self.conversions >= self.max_conversions:
+                    self.stop()
+                    self.start()
+                self._convert(svg_path, pdf_path)
+                return
+            except (ConversionError, OSError) as e:
+                logging.warning(f"- Inkscape failed to convert {svg_path}, restarting it: {e}")
+                self.kill()
+                if attempt == 1:
+                    raise ConversionError(f"Inkscape failed to convert {svg_path}") from e
+            except BaseException:
+                # interrupted half way, by a page timeout for one. What the shell prints next can't be trusted
+                self.kill()
+                raise
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def _convert(self, svg_path: str, pdf_path: str):
+        # a path Inkscape can't read from the line of actions is converted under a name of the shell's own
+        open_path, export_path = svg_path, pdf_path
+        if not ACTION_SAFE_PATH.match(svg_path):
+            open_path = shutil.copyfile(svg_path, os.path.join(self.profile_dir, "convert.svg"))
+        if not ACTION_SAFE_PATH.match(pdf_path):
+            export_path = os.path.join(self.profile_dir, "convert.pdf")
+        if os.path.exists(export_path):
+            os.truncate(export_path, 0)
+        actions = f"file-open:{open_path};export-filename:{export_path};export-do;file-close\n"
+        self.process.stdin.write(actions.encode())
+        self.process.stdin.flush()
+        self._read_until_prompt()
+        self.conversions += 1
+        if not os.path.exists(export_path) or os.path.getsize(export_path) == 0:
+            raise ConversionError(f"Inkscape wrote no PDF for {svg_path}")
+        if export_path != pdf_path:
+            shutil.move(export_path, pdf_path)
+
+
+class InkscapePool:
+    """
+    Converts SVG files to PDF with up to `size` long running Inkscape shells, instead of starting Inkscape for every
+    page like rmc's `svg_to_pdf` does. Shells are started when they are first needed. `convert` can be called from
+    several threads at once, every call gets a shell of its own.
+    """
+
+    def __init__(self, size: int = 1, timeout: float = 60):
+        inkscape = find_inkscape()
+        if inkscape is None:
+            raise ConversionError("Can't find Inkscape, it is needed to convert SVG to PDF")
+        self.shells = [InkscapeShell(inkscape, timeout) for _ in range(max(1, size))]
+        # last in, first out: a single caller keeps using the same shell, the others are never started
+        self.idle: "queue.LifoQueue[InkscapeShell]" = queue.LifoQueue()
+        for shell in self.shells:
+            self.idle.put(shell)
+
+    def convert(self, svg_path: str, pdf_path: str):
+        shell = self.idle.get()
+        try:
+            shell.convert(svg_path, pdf_path)
+        finally:
+            self.idle.put(shell)
+
+    def close(self):
+        for shell in self.shells:
+            shell.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,55 @@
+import hashlib
+import json
+from typing import Dict, Iterable, List, Optional
+
+from remarks.utils import file_digest, save_json_file
+
+# Bump this when the markdown of a page changes for the same input, so fragments of earlier versions aren't reused
+FORMAT_VERSION = 1
+
+
+class MarkdownCache:
+    """
+    The markdown fragments of every page of a document as the last run made them, with a key of everything they
+    were made from. A page whose key is unchanged takes its fragments from here, without parsing its .rm file or
+    loading its smart highlights.
+
+    Kept in a JSON file per document, `save` replaces it with the pages of this run.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pages: Dict[str, dict] = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("version") == FORMAT_VERSION:
+                self.pages = data["pages"]
+        except (FileNotFoundError, ValueError, KeyError):
+            # a cache that can't be read is as good as none
+            pass
+
+    @staticmethod
+    def page_key(document_name: str, page_idx: int, *files) -> str:
+        """A key of what the markdown of a page is made from: the document name and page number that go in its
+        header, and the contents of `files`, the page's .rm file and smart highlights if it has them"""
+        key = hashlib.sha256(f"{document_name}\0{page_idx}".encode())
+        for path in files:
+            key.update(b"\0" + (file_digest(path).encode() if path is not None else b"-"))
+        return key.hexdigest()
+
+    def get(self, page_uuid: str, key: str) -> Optional[List[str]]:
+        """The fragments of the page, if they were made from the same input"""
+        page = self.pages.get(page_uuid)
+        if page is None or page["key"] != key:
+            return None
+        return page["fragments"]
+
+    def put(self, page_uuid: str, key: str, fragments: List[str]):
+        self.pages[page_uuid] = {"key": key, "fragments": fragments}
+
+    def save(self, page_uuids: Iterable[str]):
+        """Write the cache, forgetting pages that are not in `page_uuids` anymore"""
+        page_uuids = set(page_uuids)
+        pages = {page_uuid: page for page_uuid, page in self.pages.items() if page_uuid in page_uuids}
+        save_json_file(self.path, {"version": FORMAT_VERSION, "pages": pages})
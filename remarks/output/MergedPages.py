@@ -0,0 +1,32 @@
+from typing import List, Tuple, Optional
+
+import fitz
+
+
+class MergedPages:
+    """
+    Merged pages, a source page with its annotations on top, composed in a single document of their own.
+
+    Copying a page between documents with `show_pdf_page` or `insert_pdf` copies every object it refers to. Composed
+    one document per page, the fonts and images that pages of the source PDF share, or a template drawn on every page
+    of a notebook, end up in the output once for every page. Composed in one document, PyMuPDF's map of the objects
+    that were copied already makes them land in it once, and in the output once.
+
+    That map breaks when either document grows while it is in use. Pages are therefore composed while the source
+    document stays as it is, and moved into the output together afterwards, see `remarks.insert_merged_pages`.
+    """
+
+    def __init__(self):
+        self.doc = fitz.open()
+        self.source_pages: List[Tuple[int, Optional[fitz.Rect]]] = []
+        """For every page of `self.doc`, the source page it replaces and where the source page sits on it"""
+
+    def new_page(self, source_page_idx: int, width: float, height: float, background_rect: fitz.Rect) -> fitz.Page:
+        self.source_pages.append((source_page_idx, background_rect))
+        return self.doc.new_page(-1, width=width, height=height)
+
+    def add_pdf(self, source_page_idx: int, pdf: fitz.Document) -> fitz.Page:
+        """Use the first page of `pdf` as is, for source pages without a background"""
+        self.source_pages.append((source_page_idx, None))
+        self.doc.insert_pdf(pdf, from_page=0, to_page=0)
+        return self.doc[-1]
@@ -1,9 +1,12 @@
-from typing import List, Dict
+import logging
+import os
+from typing import List, Dict, Optional, TextIO
 
 import yaml
 from rmscene.scene_items import GlyphRange
 
 from remarks.Document import Document
+from remarks.output.OutputHashes import OutputHashes
 
 class RMPage:
     def __init__(self, index: int):
@@ -12,11 +15,22 @@ class RMPage:
 
 
 class ObsidianMarkdownFile:
-    def __init__(self, document: Document):
+    """
+    The markdown of a document, kept as lists of fragments: one for the header, one per page in `page_content`.
+
+    With a `location`, `write_pages_before` streams the pages that are done to the output file while the document is
+    still being processed, and forgets them. The file is written next to its final name and only takes that name in
+    `save`, a run that is cut short never leaves half a file behind.
+    """
+
+    def __init__(self, document: Document, location: str = None):
         self.pages: Dict[int, RMPage] = {}
-        self.content = ""
-        self.page_content = {}
+        self.content: List[str] = []
+        # page number, counting from 1, to the fragments of that page
+        self.page_content: Dict[int, List[str]] = {}
         self.document = document
+        self.location = location
+        self._file: Optional[TextIO] = None
 
     def add_document_header(self):
         frontmatter = {}
@@ -31,33 +45,81 @@ class ObsidianMarkdownFile:
 ---
 
 """
-            self.content += frontmatter_md
+            self.content.append(frontmatter_md)
 
-        self.content += f"""# {self.document.name}
+        self.content.append(f"""# {self.document.name}
 
 > [!WARNING] **Do not modify** this file
 > This file is automatically generated by Scrybble and will be overwritten whenever this file in synchronized.
 > Treat it as a reference.
-"""
+""")
 
-    def save(self, location: str):
-        if len(self.page_content):
-            self.content += "## Pages\n\n"
-
-            for page_idx in sorted(self.page_content.keys()):
-                self.content += self.page_content[page_idx]
+    def path(self) -> str:
+        return f"{self.location} _obsidian.md"
 
-        # don't write if the file is empty
-        if len(self.document.rm_tags) or len(self.page_content):
-            with open(f"{location} _obsidian.md", "w") as f:
-                f.write(self.content)
+    def _open(self):
+        self._file = open(f"{self.path()}.tmp", "w")
+        self._file.writelines(self.content)
+        self.content = []
+        if len(self.page_content):
+            self._file.write("## Pages\n\n")
+
+    def _write_pages(self, page_numbers: List[int]):
+        if self._file is None:
+            self._open()
+        for page_idx in page_numbers:
+            # written pages are forgotten, only the pages still in progress are kept in memory
+            self._file.writelines(self.page_content.pop(page_idx))
+
+    def write_pages_before(self, page_idx: int):
+        """Stream the pages before `page_idx`, counting from 0, to the output file. Pages come in document order,
+        these are done. Does nothing without a `location`"""
+        if self.location is None:
+            return
+        done = sorted(page for page in self.page_content if page <= page_idx)
+        if done:
+            self._write_pages(done)
+
+    def save(self, location: str, output_hashes: OutputHashes = None) -> Optional[bool]:
+        """Write the rest of the markdown and move the file into place, see `OutputHashes.replace`.
+
+        Returns:
+            Whether the file was written, None if there is nothing to write
+        """
+        if self._file is None:
+            # don't write if the file is empty
+            if not (len(self.document.rm_tags) or len(self.page_content)):
+                return None
+            self.location = location
+        self._write_pages(sorted(self.page_content))
+        self._file.close()
+        self._file = None
+        if output_hashes is None:
+            output_hashes = OutputHashes()
+        return output_hashes.replace(f"{self.path()}.tmp", self.path())
+
+    def discard(self):
+        """Remove what `write_pages_before` wrote so far, for a document that failed half way"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(f"{self.path()}.tmp")
+
+    def page_fragments(self, page_idx: int) -> List[str]:
+        """The markdown of page `page_idx`, counting from 0, as far as it is not written yet"""
+        return list(self.page_content.get(page_idx + 1, []))
+
+    def add_page_fragments(self, page_idx: int, fragments: List[str]):
+        """Add markdown that `page_fragments` returned earlier, see `MarkdownCache`"""
+        if fragments:
+            self.page_content.setdefault(page_idx + 1, []).extend(fragments)
 
     def add_highlights(
         self, page_idx: int, highlights: List[GlyphRange]
     ):
         doc = self.document
         page_idx += 1
-        highlight_content = ""
+        highlight_content: List[str] = []
         joined_highlights = []
         highlights = sorted(
             [highlight for highlight in highlights if highlight.start is not None],
@@ -65,11 +127,11 @@ class ObsidianMarkdownFile:
         )
         if len(highlights) > 0:
             if len(highlights) == 1:
-                highlight_content += f"""### [[{doc.name}.pdf#page={page_idx}|{doc.name}, page {page_idx}]]
+                highlight_content.append(f"""### [[{doc.name}.pdf#page={page_idx}|{doc.name}, page {page_idx}]]
 
 > {highlights[0].text}
 
-"""
+""")
             else:
                 # first, highlights may be disjointed. We want to join highlights that belong together
                 paired_highlights = [
@@ -85,17 +147,27 @@ class ObsidianMarkdownFile:
                         joined_highlights.append(joined_highlight)
                         joined_highlight = []
 
-                highlight_content += f"### [[{doc.name}.pdf#page={page_idx}|{doc.name}, page {page_idx}]]\n"
+                highlight_content.append(f"### [[{doc.name}.pdf#page={page_idx}|{doc.name}, page {page_idx}]]\n")
 
                 for joined_highlight in joined_highlights:
                     highlight_text = " ".join(joined_highlight)
-                    highlight_content += f"\n> {highlight_text}\n"
+                    highlight_content.append(f"\n> {highlight_text}\n")
 
-                highlight_content += "\n"
+                highlight_content.append("\n")
 
         if highlight_content:
             self.page_content[page_idx] = highlight_content
 
+    def add_smart_highlights(self, page_idx: int, hl_groups: List[List[str]]):
+        """Add the groups of `group_smart_highlights` to the page, after its other highlights"""
+        if not hl_groups:
+            return
+        doc = self.document
+        page_idx += 1
+        if page_idx not in self.page_content:
+            self.page_content[page_idx] = [f"### [[{doc.name}.pdf#page={page_idx}|{doc.name}, page {page_idx}]]\n\n"]
+        self.page_content[page_idx].extend(f"> {' '.join(hl_group)}\n\n" for hl_group in hl_groups)
+
     def add_text(self, page_idx: int, text):
         if not text:
             return
@@ -105,10 +177,10 @@ class ObsidianMarkdownFile:
         else:
             page = self.pages[page_idx]
 
-        print(text.keys())
+        logging.debug(f"- Text on page {page_idx}: {list(text.keys())}")
 
         for paragraph in text['text'].contents:
-            print(paragraph)
+            logging.debug(f"- {paragraph}")
         # page.add_user_written_paragraph(text)
         # page.highlights.append(GlyphRange(text))
 
@@ -0,0 +1,73 @@
+import os
+from typing import Dict, Optional
+
+from remarks.utils import file_digest, file_lock, load_json_file, save_json_file
+
+
+class OutputHashes:
+    """
+    The SHA-256 of every output file as remarks last wrote it. A new version of an output is written next to it and
+    only moved into place if its contents differ. An output that comes out the same keeps its modification time, so
+    tools that sync vaults don't upload it again.
+
+    With a `path` the hashes are kept in a JSON file between runs, and outputs whose size and modification time
+    didn't change since are not read again. Without one, or for a file that was changed by something else, the file
+    itself is hashed. Sessions can share the file, `save` merges their hashes.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        # output path to its "sha256", "size" and "mtime_ns"
+        self.files: Dict[str, dict] = {}
+        # the outputs this session wrote, see `save`
+        self.written: Dict[str, dict] = {}
+        if path is not None:
+            self.files = self._load()
+
+    def _load(self) -> Dict[str, dict]:
+        try:
+            return load_json_file(self.path)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def digest(self, path: str) -> Optional[str]:
+        """The SHA-256 of the current contents of `path`, None if it doesn't exist"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        known = self.files.get(os.path.abspath(path))
+        if known is not None and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["sha256"]
+        return file_digest(path)
+
+    def replace(self, temp_path: str, path: str) -> bool:
+        """
+        Move `temp_path`, a complete new version of `path`, into place, unless `path` has the same contents already.
+
+        Returns:
+            Whether `path` was written
+        """
+        digest = file_digest(temp_path)
+        if self.digest(path) == digest:
+            os.remove(temp_path)
+            written = False
+        else:
+            os.replace(temp_path, path)
+            written = True
+        stat = os.stat(path)
+        entry = {"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        self.files[os.path.abspath(path)] = entry
+        self.written[os.path.abspath(path)] = entry
+        return written
+
+    def save(self):
+        """Add the hashes of the outputs this session wrote to the file, on top of what other sessions saved since
+        it was read"""
+        if self.path is None:
+            return
+        with file_lock(self.path):
+            files = self._load()
+            files.update(self.written)
+            save_json_file(self.path, files)
+        self.files = files
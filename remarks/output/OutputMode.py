@@ -0,0 +1,14 @@
+class OutputMode:
+    """Which files remarks writes for every document"""
+
+    # The source PDF with all annotations merged in, plus the Obsidian markdown file
+    FULL = "full"
+    # Only the Obsidian markdown file. The source PDF is never opened and nothing is rendered
+    MARKDOWN = "markdown"
+    # Only the annotated pages, merged with their background, written to "<name> _remarks_annotated.pdf"
+    ANNOTATED = "annotated"
+    # Only the annotated pages without their background, written to "<name> _remarks_overlay.pdf".
+    # The pages are transparent so viewers can composite them over the source PDF they already have
+    OVERLAY = "overlay"
+
+    ALL = [FULL, MARKDOWN, ANNOTATED, OVERLAY]
@@ -0,0 +1,72 @@
+import logging
+import pathlib
+from typing import Dict, Optional
+
+import fitz
+
+# The device keeps its templates in /usr/share/remarkable/templates, as .svg and as .png
+TEMPLATE_SUFFIXES = [".svg", ".pdf", ".png"]
+
+
+class PageTemplates:
+    """
+    The page templates of the reMarkable ("P Lines small", "P Grid medium", ...) as backgrounds for notebook pages.
+
+    Every template is rendered once, as a page of a single templates document. Pages draw it with `show_pdf_page`,
+    which PyMuPDF turns into one Form XObject per output document that every page with that template refers to.
+    A notebook of a hundred lined pages holds the lines once, not a hundred times.
+
+    Templates are not part of a document's files, they are looked up in `templates_dir`, a copy of the device's
+    template directory.
+    """
+
+    def __init__(self, templates_dir):
+        self.templates_dir = pathlib.Path(templates_dir)
+        # opened when the first template is rendered
+        self.doc: Optional[fitz.Document] = None
+        self.page_numbers: Dict[str, Optional[int]] = {}
+
+    def page_number(self, name: str) -> Optional[int]:
+        """The page of `self.doc` that holds template `name`, rendering it on first use.
+        `None` if there is no file for the template"""
+        if name not in self.page_numbers:
+            self.page_numbers[name] = self._render(name)
+        return self.page_numbers[name]
+
+    def _render(self, name: str) -> Optional[int]:
+        for suffix in TEMPLATE_SUFFIXES:
+            path = self.templates_dir / f"{name}{suffix}"
+            if path.exists():
+                break
+        else:
+            logging.warning(f"- Can't find template \"{name}\" in {self.templates_dir}, leaving the pages blank")
+            return None
+
+        if self.doc is None:
+            self.doc = fitz.open()
+        if suffix == ".png":
+            with fitz.open(path) as image:
+                rect = image[0].rect
+            page = self.doc.new_page(-1, width=rect.width, height=rect.height)
+            page.insert_image(page.rect, filename=str(path))
+        else:
+            with fitz.open(path) as template:
+                template_pdf = fitz.open("pdf", template.convert_to_pdf(0, 1))
+            self.doc.insert_pdf(template_pdf)
+
+        return self.doc.page_count - 1
+
+    def draw(self, page: fitz.Page, name: str) -> bool:
+        """Draw template `name` below everything else on `page`. Returns whether there was a template to draw"""
+        pno = self.page_number(name)
+        if pno is None:
+            return False
+        page.show_pdf_page(page.rect, self.doc, pno, overlay=False)
+        return True
+
+    def close(self):
+        """Let go of the rendered templates, they are rendered again when used next"""
+        if self.doc is not None:
+            self.doc.close()
+            self.doc = None
+        self.page_numbers = {}
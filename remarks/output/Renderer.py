@@ -0,0 +1,10 @@
+class Renderer:
+    """How the strokes of v6 pages are drawn"""
+
+    # rmc writes an SVG with a path per stroke segment, Inkscape converts it to PDF
+    SVG = "svg"
+    # The strokes are drawn into the PDF directly, segments that share their style are batched into a single path.
+    # Doesn't need Inkscape, see `BatchedPdfRenderer`
+    BATCHED = "batched"
+
+    ALL = [SVG, BATCHED]
@@ -0,0 +1,64 @@
+from dataclasses import dataclass, asdict
+
+import fitz
+
+
+@dataclass(frozen=True)
+class SaveProfile:
+    """
+    Options passed to PyMuPDF when an output PDF is saved.
+
+    See https://pymupdf.readthedocs.io/en/latest/document.html#Document.save
+    """
+
+    garbage: int = 0
+    """0 keeps everything, 1 removes unused objects, 2 also compacts the xref table, 3 also merges duplicate
+    objects, 4 also merges duplicate streams. Merged pages embed their own copies of fonts and images, 3 and 4
+    shrink those the most"""
+
+    deflate: bool = False
+    """Compress uncompressed streams"""
+
+    deflate_images: bool = False
+    deflate_fonts: bool = False
+
+    clean: bool = False
+    """Clean and sanitize content streams"""
+
+    linear: bool = False
+    """Linearize the file, so viewers can show the first page before the download finished"""
+
+    no_new_id: bool = True
+    """Keep the file identifier of the source PDF. MuPDF gives every save a new random one otherwise, and an output
+    that didn't change would never come out the same"""
+
+    @property
+    def rewrites_file(self) -> bool:
+        """Whether saving does more than writing out the objects as they are"""
+        return self != SaveProfile()
+
+    def save(self, doc: fitz.Document, path: str):
+        doc.save(path, **asdict(self))
+
+
+SAVE_PROFILES = {
+    # Write objects as they are, what remarks has always done
+    "fast": SaveProfile(),
+    # Drop unused and duplicate objects and compress streams, a good deal smaller for little extra time
+    "compact": SaveProfile(garbage=3, deflate=True),
+    # Everything that makes the file smaller, also recompresses images and fonts
+    "smallest": SaveProfile(garbage=4, deflate=True, deflate_images=True, deflate_fonts=True, clean=True),
+}
+
+DEFAULT_SAVE_PROFILE = "fast"
+
+
+def get_save_profile(save_profile, linear: bool = False) -> SaveProfile:
+    """Resolve a preset name or a `SaveProfile`, optionally with linearization switched on"""
+    if isinstance(save_profile, str):
+        if save_profile not in SAVE_PROFILES:
+            raise ValueError(f"Unknown save profile: {save_profile}. Choose one of: {', '.join(SAVE_PROFILES)}")
+        save_profile = SAVE_PROFILES[save_profile]
+    if linear and not save_profile.linear:
+        save_profile = SaveProfile(**{**asdict(save_profile), "linear": True})
+    return save_profile
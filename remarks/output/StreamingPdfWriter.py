@@ -0,0 +1,84 @@
+import logging
+import os
+import shutil
+
+import fitz
+
+from .SaveProfile import SaveProfile
+
+
+class StreamingPdfWriter:
+    """
+    Writes the full output PDF while its pages are being processed, instead of keeping every merged page in memory
+    until a single save at the end.
+
+    The source document is written to `path` first. Pages are then changed on a document that is opened from `path`.
+    After every `chunk_size` changed pages, the changes are appended to the file with an incremental save and the
+    document is reopened, which drops everything MuPDF had loaded so far. Peak memory depends on the chunk size,
+    not on the length of the document.
+
+    Incremental saves leave the replaced page objects in the file, the output is larger than a regular save.
+    A `save_profile` that garbage collects, compresses or linearizes rewrites the whole file once, when closing.
+
+    All of this happens in `temp_path`, `path` itself is not touched. After `close`, `temp_path` is the complete
+    output, see `OutputHashes.replace`. A conversion that fails before that `discard`s it.
+    """
+
+    def __init__(self, rmc_pdf_src: fitz.Document, path: str, chunk_size: int, save_profile: SaveProfile = None):
+        self.path = path
+        self.temp_path = f"{path}.tmp"
+        self.chunk_size = max(1, chunk_size)
+        self.save_profile = save_profile or SaveProfile()
+        self.pending_pages = 0
+
+        # An untouched source PDF can be copied byte for byte, without MuPDF parsing it at all
+        if rmc_pdf_src.name and not rmc_pdf_src.is_dirty:
+            shutil.copyfile(rmc_pdf_src.name, self.temp_path)
+        else:
+            rmc_pdf_src.save(self.temp_path, no_new_id=True)
+        rmc_pdf_src.close()
+
+        self.doc = fitz.open(self.temp_path)
+        self.incremental = self.doc.can_save_incrementally()
+        if not self.incremental:
+            logging.warning(f"- {path} can't be saved incrementally, all pages will be kept in memory instead")
+
+    def page_done(self):
+        """Call after every changed page"""
+        self.pending_pages += 1
+
+    @property
+    def chunk_complete(self) -> bool:
+        """Whether enough pages changed to `flush` the document to disk"""
+        return self.incremental and self.pending_pages >= self.chunk_size
+
+    def flush(self):
+        if self.pending_pages == 0 or not self.incremental:
+            return
+        self.doc.save(self.temp_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP, no_new_id=True)
+        self.doc.close()
+        self.doc = fitz.open(self.temp_path)
+        self.pending_pages = 0
+
+    def close(self):
+        if self.incremental:
+            self.flush()
+            if not self.save_profile.rewrites_file:
+                self.doc.close()
+                return
+
+        # a regular save can't overwrite the file the document was opened from
+        rewritten_path = f"{self.temp_path}.rewrite"
+        self.save_profile.save(self.doc, rewritten_path)
+        self.doc.close()
+        os.replace(rewritten_path, self.temp_path)
+
+    def discard(self):
+        """Close the document and remove the files written so far, for a document that failed half way"""
+        if not self.doc.is_closed:
+            self.doc.close()
+        for path in (self.temp_path, f"{self.temp_path}.rewrite"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
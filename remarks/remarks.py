@@ -2,197 +2,571 @@ import logging
 import os
 import pathlib
 import re
-import sys
 import tempfile
+import time
 import traceback
-import zipfile
+from typing import Dict, List, Optional, Set, Tuple
 
 import fitz  # PyMuPDF
 from fitz import Page
 from rmc.exporters.pdf import svg_to_pdf
-from rmc.exporters.svg import rm_to_svg, PAGE_WIDTH_PT, PAGE_HEIGHT_PT
+from rmc.exporters.svg import tree_to_svg, PAGE_WIDTH_PT, PAGE_HEIGHT_PT, SCALE
+from rmscene import read_tree
+from rmscene.scene_items import GlyphRange
 
 from .Document import Document
 from .conversion.parsing import (
+    has_visible_content,
     parse_rm_file,
     read_rm_file_version,
 )
+from .conversion.erasers import Erasers, remove_erasers
+from .conversion.simplify import simplify_scene_tree
 from .conversion.text import (
-    extract_groups_from_smart_hl,
+    group_smart_highlights,
 )
 from .metadata import ReMarkableAnnotationsFileHeaderVersion
+from .output.MarkdownCache import MarkdownCache
+from .output.MergedPages import MergedPages
 from .output.ObsidianMarkdownFile import ObsidianMarkdownFile
+from .output.OutputHashes import OutputHashes
+from .output.OutputMode import OutputMode
+from .output.BatchedPdfRenderer import SVG_PX_TO_PT, tree_to_pdf
+from .output.HighlightAnnotations import add_highlight_annotations
+from .output.InkscapePool import InkscapePool
+from .output.PageTemplates import PageTemplates
+from .output.Renderer import Renderer
+from .output.SaveProfile import SaveProfile, DEFAULT_SAVE_PROFILE, get_save_profile
+from .output.StreamingPdfWriter import StreamingPdfWriter
+from .summary import RunSummary
 from .utils import (
-    is_document,
-    get_document_filetype,
-    get_visible_name,
-    get_ui_path,
-    load_json_file,
+    fitz_lock,
+    load_smart_highlights,
+    parse_page_selection,
 )
-from .warnings import scrybble_warning_only_v6_supported
+from .timeout import PageTimeoutError, time_limit
+from .warnings import scrybble_warning_only_v6_supported, scrybble_warning_page_timeout
 
 SVG_VIEWBOX_PATTERN = re.compile(r"^<svg .+ viewBox=\"([\-\d.]+) ([\-\d.]+) ([\-\d.]+) ([\-\d.]+)\">$")
 
 
-def run_remarks(
-        input_dir, output_dir
+def process_document(
+        metadata_path,
+        out_path,
+        summary: RunSummary = None,
+        output_mode: str = OutputMode.FULL,
+        pages=None,
+        only_selected_pages: bool = False,
+        stream_chunk_size: int = None,
+        save_profile=DEFAULT_SAVE_PROFILE,
+        templates: PageTemplates = None,
+        simplify_tolerance: float = None,
+        coordinate_decimals: int = None,
+        renderer: str = Renderer.SVG,
+        erasers: str = Erasers.KEEP,
+        native_highlights: bool = False,
+        converter: InkscapePool = None,
+        page_timeout: float = None,
+        cache_dir=None,
+        output_hashes: OutputHashes = None,
+        markdown_caches: Dict[str, MarkdownCache] = None,
 ):
-    if input_dir.endswith(".rmn"):
-        temp_dir = tempfile.mkdtemp()
-        with zipfile.ZipFile(input_dir, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        input_dir = temp_dir
-
-    num_docs = sum(1 for _ in pathlib.Path(f"{input_dir}/").glob("*.metadata"))
-
-    if num_docs == 0:
-        logging.warning(
-            f'No .metadata files found in "{input_dir}". Are you sure you\'re running remarks on a valid xochitl-like directory? See: https://github.com/lucasrla/remarks#1-copy-remarkables-raw-document-files-to-your-computer'
-        )
-        sys.exit(1)
-
-    logging.info(
-        f'\nFound {num_docs} documents in "{input_dir}", will process them now',
-    )
-
-    for metadata_path in pathlib.Path(f"{input_dir}/").glob("*.metadata"):
-        if not is_document(metadata_path):
-            continue
-
-        doc_type = get_document_filetype(metadata_path)
-        # Both "Quick Sheets" and "Notebooks" have doc_type="notebook"
-        supported_types = ["pdf", "epub", "notebook"]
+    """Convert the document of `metadata_path` to `out_path`, the options are those of `run_remarks`.
+
+    `output_hashes` and `markdown_caches`, the `MarkdownCache` of every document by its path, are kept from one
+    document to the next by a `Session`. Without them, they are read from `cache_dir` for this document alone."""
+    if summary is None:
+        summary = RunSummary()
+    if output_hashes is None:
+        output_hashes = OutputHashes()
+    save_profile = get_save_profile(save_profile)
+
+    # closed when the conversion is done, see `close_documents`
+    rmc_pdf_src = out_doc = merged_pages = streaming_writer = obsidian_markdown = None
+    try:
+        with summary.stage("open"):
+            document = Document(metadata_path)
+            selection = None if pages is None else parse_page_selection(pages, document.pages_list, document.name)
+            with fitz_lock:
+                # Markdown is generated from the .rm files and highlight JSON alone, the source PDF is never needed
+                if output_mode != OutputMode.MARKDOWN:
+                    rmc_pdf_src = document.open_source_pdf()
+                # Annotated and overlay output only holds the pages that carry annotations, in a document of its own
+                if output_mode in (OutputMode.ANNOTATED, OutputMode.OVERLAY):
+                    out_doc = fitz.open()
+                if templates is not None and rmc_pdf_src is not None:
+                    draw_page_templates(rmc_pdf_src, document, templates, selection)
+
+        out_doc_path_str = f"{out_path.parent}/{out_path.name}"
+
+        # With only_selected_pages the output is small enough to keep in memory, there's nothing to stream
+        if output_mode == OutputMode.FULL and stream_chunk_size and not (selection is not None and only_selected_pages):
+            with summary.stage("save"), fitz_lock:
+                streaming_writer = StreamingPdfWriter(
+                    rmc_pdf_src, f"{out_doc_path_str} _remarks.pdf", stream_chunk_size, save_profile
+                )
+
+        with fitz_lock:
+            merged_pages = MergedPages()
+
+        # the markdown of finished pages is written as the document goes
+        obsidian_markdown = ObsidianMarkdownFile(document, out_doc_path_str)
+        obsidian_markdown.add_document_header()
+
+        # pages that didn't change since the last run take their markdown from here
+        markdown_cache = None
+        if cache_dir is not None:
+            markdown_cache_path = f"{cache_dir}/{pathlib.Path(metadata_path).stem}.markdown.json"
+            if markdown_caches is None:
+                markdown_caches = {}
+            if markdown_cache_path not in markdown_caches:
+                markdown_caches[markdown_cache_path] = MarkdownCache(markdown_cache_path)
+            markdown_cache = markdown_caches[markdown_cache_path]
+
+        for (
+                page_uuid,
+                page_idx,
+                rm_annotation_file,
+                has_annotations,
+                rm_highlights_file,
+                has_smart_highlights,
+        ) in document.pages(selection):
+            logging.debug(f"- Processing page {page_idx}, {page_uuid}")
+
+            cached_fragments = None
+            if markdown_cache is not None:
+                with summary.stage("markdown"):
+                    markdown_key = markdown_cache.page_key(
+                        document.name, page_idx, rm_annotation_file, rm_highlights_file
+                    )
+                    cached_fragments = markdown_cache.get(page_uuid, markdown_key)
+
+            ann_data = None
+            if has_annotations:
+                if streaming_writer is not None:
+                    render_page(streaming_writer.doc, page_uuid, page_idx, rm_annotation_file, summary,
+                                merged_pages=merged_pages, simplify_tolerance=simplify_tolerance,
+                                coordinate_decimals=coordinate_decimals, renderer=renderer, erasers=erasers,
+                                native_highlights=native_highlights, converter=converter, page_timeout=page_timeout)
+                    streaming_writer.page_done()
+                    if streaming_writer.chunk_complete:
+                        with summary.stage("merge"), fitz_lock:
+                            insert_merged_pages(merged_pages, streaming_writer.doc)
+                        with summary.stage("save"), fitz_lock:
+                            streaming_writer.flush()
+                            merged_pages = MergedPages()
+                elif rmc_pdf_src is not None:
+                    render_page(rmc_pdf_src, page_uuid, page_idx, rm_annotation_file, summary, output_mode, out_doc,
+                                merged_pages, simplify_tolerance, coordinate_decimals, renderer, erasers,
+                                native_highlights, converter, page_timeout)
+
+                if cached_fragments is None:
+                    with summary.stage("parse"):
+                        (ann_data, has_ann_hl), version = parse_rm_file(rm_annotation_file)
+
+            if cached_fragments is not None:
+                with summary.stage("markdown"):
+                    obsidian_markdown.add_page_fragments(page_idx, cached_fragments)
+                    summary.cached_markdown_pages += 1
+            else:
+                with summary.stage("markdown"):
+                    if ann_data:
+                        if "text" in ann_data:
+                            obsidian_markdown.add_text(page_idx, ann_data['text'])
+                        if "highlights" in ann_data:
+                            obsidian_markdown.add_highlights(page_idx, ann_data["highlights"])
+
+                # Only pages that have them load their smart highlights, each file is parsed once until it changes
+                if has_smart_highlights:
+                    with summary.stage("smart_highlights"):
+                        smart_highlights = load_smart_highlights(rm_highlights_file)
+                        obsidian_markdown.add_smart_highlights(page_idx, group_smart_highlights(smart_highlights))
+                        summary.smart_highlights += len(smart_highlights)
+
+                if markdown_cache is not None:
+                    markdown_cache.put(page_uuid, markdown_key, obsidian_markdown.page_fragments(page_idx))
+
+            with summary.stage("markdown"):
+                obsidian_markdown.write_pages_before(page_idx + 1)
+
+            summary.pages += 1
+
+        with summary.stage("merge"), fitz_lock:
+            if streaming_writer is not None:
+                insert_merged_pages(merged_pages, streaming_writer.doc)
+            elif rmc_pdf_src is not None:
+                insert_merged_pages(merged_pages, rmc_pdf_src, output_mode, out_doc)
+
+        with summary.stage("save"):
+            with fitz_lock:
+                if streaming_writer is not None:
+                    start = time.perf_counter()
+                    streaming_writer.close()
+                    written = output_hashes.replace(streaming_writer.temp_path, streaming_writer.path)
+                    summary.record_output(streaming_writer.path, time.perf_counter() - start, written)
+                elif output_mode == OutputMode.FULL and selection is not None and only_selected_pages:
+                    # none of the selected pages are in this document of a library, there is no PDF to write
+                    if selection:
+                        emit_selected_pages(rmc_pdf_src, selection)
+                        save_pdf(rmc_pdf_src, f"{out_doc_path_str} _remarks.pdf", save_profile, summary,
+                                 output_hashes)
+                elif output_mode == OutputMode.FULL:
+                    save_pdf(rmc_pdf_src, f"{out_doc_path_str} _remarks.pdf", save_profile, summary, output_hashes)
+                elif out_doc is not None and out_doc.page_count > 0:
+                    sort_source_pages(out_doc)
+                    label_source_pages(out_doc)
+                    save_pdf(out_doc, f"{out_doc_path_str} _remarks_{output_mode}.pdf", save_profile, summary,
+                             output_hashes)
+
+            start = time.perf_counter()
+            written = obsidian_markdown.save(out_doc_path_str, output_hashes)
+            if written is not None:
+                summary.record_output(obsidian_markdown.path(), time.perf_counter() - start, written)
+            if markdown_cache is not None:
+                markdown_cache.save(document.pages_list)
+    except BaseException:
+        # a half written markdown file or PDF never takes the place of the last complete one
+        if obsidian_markdown is not None:
+            obsidian_markdown.discard()
+        if streaming_writer is not None:
+            with fitz_lock:
+                streaming_writer.discard()
+        raise
+    finally:
+        with fitz_lock:
+            close_documents(rmc_pdf_src, out_doc, merged_pages.doc if merged_pages is not None else None)
+
+    summary.documents += 1
+
+
+def close_documents(*docs: fitz.Document):
+    """Close the documents of `docs` that are still open, None is skipped. Closing frees a document and its pages
+    right away, while `fitz_lock` is held, instead of whenever the garbage collector gets to them"""
+    for doc in docs:
+        if doc is not None and not doc.is_closed:
+            doc.close()
+
+
+def save_pdf(
+        doc: fitz.Document,
+        path: str,
+        save_profile: SaveProfile,
+        summary: RunSummary,
+        output_hashes: OutputHashes = None,
+):
+    """Save `doc` to `path`, unless the file there has the same contents already, see `OutputHashes`"""
+    if output_hashes is None:
+        output_hashes = OutputHashes()
+    start = time.perf_counter()
+    save_profile.save(doc, f"{path}.tmp")
+    written = output_hashes.replace(f"{path}.tmp", path)
+    summary.record_output(path, time.perf_counter() - start, written)
+
+
+def render_page(
+        rmc_pdf_src: fitz.Document,
+        page_uuid: str,
+        page_idx: int,
+        rm_annotation_file,
+        summary: RunSummary,
+        output_mode: str = OutputMode.FULL,
+        out_doc: fitz.Document = None,
+        merged_pages: MergedPages = None,
+        simplify_tolerance: float = None,
+        coordinate_decimals: int = None,
+        renderer: str = Renderer.SVG,
+        erasers: str = Erasers.KEEP,
+        native_highlights: bool = False,
+        converter: InkscapePool = None,
+        page_timeout: float = None,
+):
+    """Draw the annotations of `rm_annotation_file` on top of page `page_idx`.
 
-        doc_name = get_visible_name(metadata_path)
+    In full mode `rmc_pdf_src` is changed in place. In annotated and overlay mode `rmc_pdf_src` is left alone and a
+    single page is appended to `out_doc` instead.
 
-        if not doc_name:
-            continue
+    The merged page is composed in `merged_pages`, it takes the place of the source page in the output with
+    `insert_merged_pages`. Pass the same `merged_pages` for all pages of a document, so that what they share is
+    copied once. Without it, the merged page is inserted right away.
 
-        if doc_type in supported_types:
-            logging.info(f'\nFile: "{doc_name}.{doc_type}" ({metadata_path.stem})')
+    `simplify_tolerance` and `coordinate_decimals` simplify the strokes before they are drawn, see
+    `simplify_scene_tree`. `renderer` is one of `Renderer`, `erasers` one of `Erasers`.
 
-            in_device_dir = get_ui_path(metadata_path)
-            out_path = pathlib.Path(f"{output_dir}/{in_device_dir}/{doc_name}/")
+    A page without anything visible to draw, see `has_visible_content`, is left alone and counted in `summary`. Its
+    highlights only count with `native_highlights`, the renderers don't draw them.
 
-            process_document(metadata_path, out_path)
-        else:
-            logging.info(
-                f'\nFile skipped: "{doc_name}" ({metadata_path.stem}) due to unsupported filetype: {doc_type}. remarks only supports: {", ".join(supported_types)}'
-            )
+    With `native_highlights` the highlights of the page become PDF highlight annotations. A page with nothing else on
+    it is not rendered at all, the annotations go on the source page.
 
-    logging.info(
-        f'\nDone processing "{input_dir}"',
-    )
+    `converter` converts the SVG to PDF with long running Inkscape processes, without it rmc starts Inkscape.
 
+    Parsing and rendering that take longer than `page_timeout` seconds are given up on, the page gets a warning.
 
-def process_document(
-        metadata_path,
-        out_path,
-):
-    document = Document(metadata_path)
-    rmc_pdf_src = document.open_source_pdf()
-
-    obsidian_markdown = ObsidianMarkdownFile(document)
-    obsidian_markdown.add_document_header()
-
-    for (
-            page_uuid,
-            page_idx,
-            rm_annotation_file,
-            has_annotations,
-            rm_highlights_file,
-            has_smart_highlights,
-    ) in document.pages():
-        print(f"processing page {page_idx}, {page_uuid}")
-        page = rmc_pdf_src[page_idx]
+    Pages can be rendered in several threads at once, PyMuPDF is only called with `fitz_lock` held."""
+    insert_now = merged_pages is None
+    if insert_now:
+        with fitz_lock:
+            merged_pages = MergedPages()
+    with summary.stage("parse"):
         rm_file_version = read_rm_file_version(rm_annotation_file)
 
-        if rm_file_version == ReMarkableAnnotationsFileHeaderVersion.V6:
-            temp_pdf = tempfile.NamedTemporaryFile(suffix=".pdf", mode="w", delete=False)
-            temp_svg = tempfile.NamedTemporaryFile(suffix=".svg", mode="w", delete=False)
-            try:
-                # convert the pdf
-                rm_to_svg(rm_annotation_file, temp_svg.name)
-                with open(temp_svg.name, "r") as svg_f, open(temp_pdf.name, "wb") as pdf_f:
-                    svg_to_pdf(svg_f, pdf_f)
-                svg_pdf = fitz.open(temp_pdf.name)
-
-                # if the background page is not empty, need to merge svg on top of background page
-                if page.get_contents() != []:
-                    w_bg, h_bg = page.cropbox.width, page.cropbox.height
-                    # find the (top, right) coordinates of the svg
-                    x_shift, y_shift, w_svg, h_svg = 0, 0, PAGE_WIDTH_PT, PAGE_HEIGHT_PT
-                    with open(temp_svg.name, "r") as f:
-                        svg_content = f.readlines()
-                    found = False
-                    for line in svg_content:
-                        res = SVG_VIEWBOX_PATTERN.match(line)
-                        if res is not None:
-                            x_shift, y_shift = float(res.group(1)), float(res.group(2))
-                            w_svg, h_svg = float(res.group(3)), float(res.group(4))
-                            found = True
-                            break
-                    if not found:
-                        logging.warning(f"Can't find x shift, y shift, width and height for {page_uuid}.")
-
-                    # compute the width/height of a blank page that can contains both svg and background pdf
-                    width, height = max(w_svg, w_bg), max(h_svg, h_bg)
-                    # compute position of svg and background in the new_page
-                    # it aligns the top-middle of the background and with the (0, 0) of the svg
-                    x_svg, y_svg = 0, 0
-                    x_bg, y_bg = 0, 0
-                    if w_svg > w_bg:
-                        x_bg = width / 2 - w_bg / 2 - (w_svg / 2 + x_shift)
-                    elif w_svg < w_bg:
-                        x_svg = width / 2 - w_svg / 2 + (w_svg / 2 + x_shift)
-                    if h_svg > h_bg:
-                        y_bg = - y_shift
-                    elif h_svg < h_bg:
-                        y_svg = y_shift
-
-                    # create the merged page in independent document as show_pdf_page can't be done on the same document
-                    doc = fitz.open()
-                    page = doc.new_page(-1,
-                                        width=width,
-                                        height=height)
-                    page.show_pdf_page(fitz.Rect(x_bg, y_bg, x_bg + w_bg, y_bg + h_bg),
-                                       rmc_pdf_src,
-                                       page_idx)
-                    page.show_pdf_page(fitz.Rect(x_svg, y_svg, x_svg + w_svg, y_svg + h_svg),
-                                       svg_pdf,
-                                       0)
-                    rmc_pdf_src.insert_pdf(doc, start_at=page_idx)
-                else:
-                    rmc_pdf_src.insert_pdf(svg_pdf, start_at=page_idx)
-                rmc_pdf_src.delete_page(page_idx + 1)
-
-            except AttributeError:
-                add_error_annotation(page)
-            finally:
-                temp_pdf.close()
-                os.remove(temp_pdf.name)
-                temp_svg.close()
-                os.remove(temp_svg.name)
+    if rm_file_version == ReMarkableAnnotationsFileHeaderVersion.V6:
+        temp_pdf = tempfile.NamedTemporaryFile(suffix=".pdf", mode="w", delete=False)
+        temp_svg = tempfile.NamedTemporaryFile(suffix=".svg", mode="w", delete=False)
+        svg_pdf = None
+        try:
+            # the steps that can get stuck on a malformed page, see `time_limit`
+            with time_limit(page_timeout):
+                with summary.stage("parse"):
+                    with open(rm_annotation_file, "rb") as f:
+                        tree = read_tree(f)
+                if erasers != Erasers.KEEP:
+                    with summary.stage("erasers"):
+                        eraser_strokes, erased_points = remove_erasers(tree, erasers)
+                        summary.eraser_strokes += eraser_strokes
+                        summary.erased_points += erased_points
+                # Nothing to draw, the source page stays as it is
+                if not has_visible_content(tree, highlights=native_highlights):
+                    summary.empty_pages += 1
+                    return
+                highlights = []
+                if native_highlights:
+                    highlights = [item for item in tree.walk() if isinstance(item, GlyphRange) and item.rectangles]
+                    if not has_visible_content(tree):
+                        with summary.stage("merge"), fitz_lock:
+                            summary.highlight_annotations += add_source_page_highlights(
+                                rmc_pdf_src, page_idx, output_mode, out_doc, highlights
+                            )
+                        return
+                if simplify_tolerance or coordinate_decimals is not None:
+                    with summary.stage("simplify"):
+                        points_before, points_after = simplify_scene_tree(tree, simplify_tolerance, coordinate_decimals)
+                        summary.points_before += points_before
+                        summary.points_after += points_after
+                with summary.stage("render"):
+                    if renderer == Renderer.BATCHED:
+                        with fitz_lock:
+                            svg_pdf, viewbox = tree_to_pdf(tree)
+                    else:
+                        # convert the pdf
+                        with open(temp_svg.name, "w") as svg_f:
+                            tree_to_svg(tree, svg_f)
+                        if converter is not None:
+                            converter.convert(temp_svg.name, temp_pdf.name)
+                        else:
+                            with open(temp_svg.name, "r") as svg_f, open(temp_pdf.name, "wb") as pdf_f:
+                                svg_to_pdf(svg_f, pdf_f)
+                        viewbox = None
+            with summary.stage("merge"), fitz_lock:
+                if svg_pdf is None:
+                    svg_pdf = fitz.open(temp_pdf.name)
+                summary.highlight_annotations += merge_page(
+                    rmc_pdf_src, page_uuid, page_idx, svg_pdf, viewbox, temp_svg.name, highlights, output_mode,
+                    merged_pages
+                )
+                if insert_now:
+                    insert_merged_pages(merged_pages, rmc_pdf_src, output_mode, out_doc)
+
+        except PageTimeoutError:
+            logging.warning(f"- Page {page_idx} ({page_uuid}) took longer than {page_timeout}s to render, skipping it")
+            summary.timed_out_pages += 1
+            with fitz_lock:
+                scrybble_warning_page_timeout.render_as_annotation(
+                    annotation_target_page(rmc_pdf_src, page_idx, output_mode, out_doc)
+                )
+        except AttributeError:
+            with fitz_lock:
+                add_error_annotation(annotation_target_page(rmc_pdf_src, page_idx, output_mode, out_doc))
+        finally:
+            with fitz_lock:
+                close_documents(svg_pdf, merged_pages.doc if insert_now else None)
+            temp_pdf.close()
+            os.remove(temp_pdf.name)
+            temp_svg.close()
+            os.remove(temp_svg.name)
+    else:
+        with fitz_lock:
+            scrybble_warning_only_v6_supported.render_as_annotation(
+                annotation_target_page(rmc_pdf_src, page_idx, output_mode, out_doc)
+            )
+            if insert_now:
+                close_documents(merged_pages.doc)
+
+
+def merge_page(
+        rmc_pdf_src: fitz.Document,
+        page_uuid: str,
+        page_idx: int,
+        svg_pdf: fitz.Document,
+        viewbox: Optional[Tuple[float, float, float, float]],
+        svg_path: str,
+        highlights: List[GlyphRange],
+        output_mode: str,
+        merged_pages: MergedPages,
+) -> int:
+    """Compose source page `page_idx` with the annotations of `svg_pdf` on top in `merged_pages`, see `render_page`.
+    Call with `fitz_lock` held, the pages it touches are freed before it returns.
+
+    Returns:
+        The number of native highlight annotations added
+    """
+    page = rmc_pdf_src[page_idx]
+    # if the background page is not empty, need to merge svg on top of background page
+    if page.get_contents() != []:
+        w_bg, h_bg = page.cropbox.width, page.cropbox.height
+        # find the (top, right) coordinates of the svg
+        if viewbox is None:
+            viewbox = read_svg_viewbox(svg_path, page_uuid)
+        x_shift, y_shift, w_svg, h_svg = viewbox
+
+        # compute the width/height of a blank page that can contains both svg and background pdf
+        width, height = max(w_svg, w_bg), max(h_svg, h_bg)
+        # compute position of svg and background in the new_page
+        # it aligns the top-middle of the background and with the (0, 0) of the svg
+        x_svg, y_svg = 0, 0
+        x_bg, y_bg = 0, 0
+        if w_svg > w_bg:
+            x_bg = width / 2 - w_bg / 2 - (w_svg / 2 + x_shift)
+        elif w_svg < w_bg:
+            x_svg = width / 2 - w_svg / 2 + (w_svg / 2 + x_shift)
+        if h_svg > h_bg:
+            y_bg = - y_shift
+        elif h_svg < h_bg:
+            y_svg = y_shift
+        background_rect = fitz.Rect(x_bg, y_bg, x_bg + w_bg, y_bg + h_bg)
+
+        # compose the merged page in an independent document as show_pdf_page can't be done on the same
+        # document
+        page = merged_pages.new_page(page_idx,
+                                     width=width,
+                                     height=height,
+                                     background_rect=background_rect)
+        # an overlay only carries the annotations, the background stays transparent
+        if output_mode != OutputMode.OVERLAY:
+            page.show_pdf_page(background_rect,
+                               rmc_pdf_src,
+                               page_idx)
+        page.show_pdf_page(fitz.Rect(x_svg, y_svg, x_svg + w_svg, y_svg + h_svg),
+                           svg_pdf,
+                           0)
+        if highlights:
+            # .rm coordinates are centered on the top edge of the source page
+            return add_highlight_annotations(
+                page, highlights, (background_rect.x0 + w_bg / 2, background_rect.y0), SCALE
+            )
+    else:
+        page = merged_pages.add_pdf(page_idx, svg_pdf)
+        if highlights:
+            if viewbox is None:
+                viewbox = read_svg_viewbox(svg_path, page_uuid)
+            # the page is the converted SVG as is, in points instead of SVG units
+            origin = (-viewbox[0] * SVG_PX_TO_PT, -viewbox[1] * SVG_PX_TO_PT)
+            return add_highlight_annotations(page, highlights, origin, SCALE * SVG_PX_TO_PT)
+    return 0
+
+
+def add_source_page_highlights(rmc_pdf_src: fitz.Document, page_idx: int, output_mode: str, out_doc: fitz.Document,
+                               highlights: List[GlyphRange]) -> int:
+    """Add `highlights` as annotations to source page `page_idx`, for a page with nothing else to draw. Call with
+    `fitz_lock` held. Returns the number of annotations added"""
+    target = annotation_target_page(rmc_pdf_src, page_idx, output_mode, out_doc)
+    return add_highlight_annotations(target, highlights, (target.rect.width / 2, 0), SCALE)
+
+
+def read_svg_viewbox(svg_path: str, page_uuid: str) -> Tuple[float, float, float, float]:
+    """The x shift, y shift, width and height of the SVG rmc wrote"""
+    with open(svg_path, "r") as f:
+        for line in f:
+            res = SVG_VIEWBOX_PATTERN.match(line)
+            if res is not None:
+                return float(res.group(1)), float(res.group(2)), float(res.group(3)), float(res.group(4))
+    logging.warning(f"Can't find x shift, y shift, width and height for {page_uuid}.")
+    return 0, 0, PAGE_WIDTH_PT, PAGE_HEIGHT_PT
+
+
+def annotation_target_page(rmc_pdf_src: fitz.Document, page_idx: int, output_mode: str, out_doc: fitz.Document):
+    """The page that warnings and errors about source page `page_idx` are written on"""
+    if output_mode == OutputMode.FULL:
+        return rmc_pdf_src[page_idx]
+
+    if output_mode == OutputMode.ANNOTATED:
+        out_doc.insert_pdf(rmc_pdf_src, from_page=page_idx, to_page=page_idx)
+    else:
+        source_rect = rmc_pdf_src[page_idx].rect
+        out_doc.new_page(-1, width=source_rect.width, height=source_rect.height)
+    tag_source_page(out_doc, out_doc.page_count - 1, page_idx)
+    return out_doc[-1]
+
+
+def insert_merged_pages(merged_pages: MergedPages, rmc_pdf_src: fitz.Document, output_mode: str = OutputMode.FULL,
+                        out_doc: fitz.Document = None):
+    """In full mode, replace the source pages of `rmc_pdf_src` with their merged pages. Otherwise append the merged
+    pages to `out_doc`"""
+    for pno, (page_idx, background_rect) in enumerate(merged_pages.source_pages):
+        # final=0 keeps PyMuPDF's map of the objects copied so far, the next page reuses them
+        if output_mode == OutputMode.FULL:
+            rmc_pdf_src.insert_pdf(merged_pages.doc, from_page=pno, to_page=pno, start_at=page_idx, final=0)
+            rmc_pdf_src.delete_page(page_idx + 1)
         else:
-            scrybble_warning_only_v6_supported.render_as_annotation(page)
+            out_doc.insert_pdf(merged_pages.doc, from_page=pno, to_page=pno, final=0)
+            tag_source_page(out_doc, out_doc.page_count - 1, page_idx, background_rect)
+    merged_pages.doc.close()
 
-        (ann_data, has_ann_hl), version = parse_rm_file(rm_annotation_file)
 
-        if ann_data:
-            if "text" in ann_data:
-                obsidian_markdown.add_text(page_idx, ann_data['text'])
-            if "highlights" in ann_data:
-                obsidian_markdown.add_highlights(page_idx, ann_data["highlights"])
-
-        if has_smart_highlights:
-            smart_hl_data = load_json_file(rm_highlights_file)
-            extract_groups_from_smart_hl(smart_hl_data)
-
-    out_doc_path_str = f"{out_path.parent}/{out_path.name}"
-
-    rmc_pdf_src.save(f"{out_doc_path_str} _remarks.pdf")
-
-    obsidian_markdown.save(out_doc_path_str)
+def draw_page_templates(rmc_pdf_src: fitz.Document, document: Document, templates: PageTemplates,
+                        selection: Set[int] = None):
+    """Draw the template of every blank page, pages of a PDF keep their own background"""
+    for page_idx, template in enumerate(document.page_templates):
+        if template is None or (selection is not None and page_idx not in selection):
+            continue
+        page = rmc_pdf_src[page_idx]
+        if page.get_contents() == []:
+            templates.draw(page, template)
+
+
+def tag_source_page(doc: fitz.Document, pno: int, source_page_idx: int, background_rect: fitz.Rect = None):
+    """Record which page of the source document page `pno` of `doc` belongs to.
+
+    The 0-based source index is stored in the page dictionary under /RemarksSourcePage. If the page was enlarged to fit
+    annotations outside the source page, /RemarksBackgroundRect holds where the source page sits, in PDF coordinates."""
+    page = doc[pno]
+    doc.xref_set_key(page.xref, "RemarksSourcePage", str(source_page_idx))
+    if background_rect is not None:
+        x0, y0, x1, y1 = background_rect * ~page.transformation_matrix
+        doc.xref_set_key(page.xref, "RemarksBackgroundRect", f"[{x0:g} {y0:g} {x1:g} {y1:g}]")
+
+
+def emit_selected_pages(rmc_pdf_src: fitz.Document, selection: Set[int]):
+    """Drop every page that wasn't selected from `rmc_pdf_src`, the remaining pages are tagged with their source index"""
+    selected_pages = sorted(selection)
+    rmc_pdf_src.select(selected_pages)
+    for pno, source_page_idx in enumerate(selected_pages):
+        tag_source_page(rmc_pdf_src, pno, source_page_idx)
+    label_source_pages(rmc_pdf_src)
+
+
+def sort_source_pages(doc: fitz.Document):
+    """Put the pages of `doc` in source page order, read from the /RemarksSourcePage tags.
+
+    Warning pages are added right away, merged pages only after all pages were rendered."""
+    source_page_indices = [int(doc.xref_get_key(doc[pno].xref, "RemarksSourcePage")[1]) for pno in range(doc.page_count)]
+    order = sorted(range(doc.page_count), key=source_page_indices.__getitem__)
+    if order != list(range(doc.page_count)):
+        doc.select(order)
+
+
+def label_source_pages(doc: fitz.Document):
+    """Show the source page numbers in PDF viewers, read from the /RemarksSourcePage tags"""
+    labels = []
+    previous_source_page_idx = None
+    for pno in range(doc.page_count):
+        _, source_page_idx = doc.xref_get_key(doc[pno].xref, "RemarksSourcePage")
+        source_page_idx = int(source_page_idx)
+        # consecutive source pages share a single label range
+        if previous_source_page_idx is None or source_page_idx != previous_source_page_idx + 1:
+            labels.append({"startpage": pno, "prefix": "", "style": "D", "firstpagenum": source_page_idx + 1})
+        previous_source_page_idx = source_page_idx
+    doc.set_page_labels(labels)
 
 
 def add_error_annotation(page: Page, more_info=""):
@@ -1,9 +1,51 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import atexit
+import logging
+import threading
+from typing import Optional
+
 from flask import Flask, request
 import remarks
+from remarks.output.InkscapePool import InkscapePool
 import os, os.path
 
 app = Flask("Remarks http server")
 
+# Conversions run in threads, at most REMARKS_SERVER_WORKERS at a time, with a `remarks.Session` each. They take turns
+# with PyMuPDF and parse, convert SVGs with Inkscape and write markdown in parallel. Page timeouts only apply in the
+# main thread, a request's page_timeout is ignored with a warning
+WORKERS = int(os.environ.get("REMARKS_SERVER_WORKERS", 4))
+# All conversions share this many Inkscape processes for the 'svg' renderer, see `InkscapePool`. 0 starts Inkscape for
+# every page instead
+CONVERTER_WORKERS = int(os.environ.get("REMARKS_SERVER_CONVERTER_WORKERS", 0))
+
+conversions = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="conversion")
+
+converter = None
+converter_lock = threading.Lock()
+
+
+def shared_converter() -> Optional[InkscapePool]:
+    """The Inkscape processes of all conversions, started with the first conversion that needs them"""
+    global converter
+    with converter_lock:
+        if converter is None and CONVERTER_WORKERS:
+            converter = InkscapePool(CONVERTER_WORKERS)
+            atexit.register(converter.close)
+        return converter
+
+
+def convert(in_path, out_dir, **options) -> remarks.RunSummary:
+    pool = shared_converter() if options.get("renderer") == remarks.Renderer.SVG else None
+    with remarks.Session(converter=pool, **options) as session:
+        return session.run(in_path, out_dir)
+
+
+def log_failure(future: Future):
+    if future.exception() is not None:
+        logging.error("Conversion failed", exc_info=future.exception())
+
+
 @app.post("/process")
 def process():
     params = request.get_json()
@@ -13,24 +55,65 @@ def process():
 
     in_path = params['in_path']
     out_path = params['out_path']
+    # optional, see `remarks.run_remarks` and `remarks.Session`
+    output_mode = params.get('output_mode', remarks.OutputMode.FULL)
+    pages = params.get('pages')
+    only_selected_pages = bool(params.get('only_selected_pages', False))
+    save_profile = params.get('save_profile', 'fast')
+    linearize = bool(params.get('linearize', False))
+    renderer = params.get('renderer', remarks.Renderer.SVG)
+    erasers = params.get('erasers', remarks.Erasers.KEEP)
+    native_highlights = bool(params.get('native_highlights', False))
+    converter_workers = params.get('converter_workers')
+    page_timeout = params.get('page_timeout')
+    cache_dir = params.get('cache_dir')
+    # with wait=false the response comes right away, the conversion goes on in the background
+    wait = bool(params.get('wait', True))
+
+    assert output_mode in remarks.OutputMode.ALL, f"Unknown output_mode: {output_mode}"
+    assert save_profile in remarks.SAVE_PROFILES, f"Unknown save_profile: {save_profile}"
+    assert renderer in remarks.Renderer.ALL, f"Unknown renderer: {renderer}"
+    assert erasers in remarks.Erasers.ALL, f"Unknown erasers: {erasers}"
+    assert converter_workers in (None, CONVERTER_WORKERS), \
+        f"converter_workers is {CONVERTER_WORKERS} for all requests, set with REMARKS_SERVER_CONVERTER_WORKERS"
 
     assert os.path.exists(in_path), f"Path does not exist: {in_path}"
     assert os.path.exists(out_path), f"Path does not exist: {out_path}"
 
-    print(f"Got a request to process {params['in_path']}")
+    logging.info(f"Got a request to process {params['in_path']}")
 
     parent_dir = in_path
     parent_dir = os.path.dirname(parent_dir)
     out_dir = os.path.join(parent_dir, "out")
 
-    print(f"Making directory {out_dir}")
+    logging.info(f"Making directory {out_dir}")
     os.makedirs(out_dir)
 
-    result = remarks.run_remarks(in_path, out_dir)
+    conversion = conversions.submit(
+        convert,
+        in_path,
+        out_dir,
+        output_mode=output_mode,
+        pages=pages,
+        only_selected_pages=only_selected_pages,
+        save_profile=save_profile,
+        linearize=linearize,
+        renderer=renderer,
+        erasers=erasers,
+        native_highlights=native_highlights,
+        page_timeout=page_timeout,
+        cache_dir=cache_dir,
+    )
+
+    if not wait:
+        conversion.add_done_callback(log_failure)
+        return "Accepted", 202
 
+    conversion.result()
     return "OK"
 
 def main():
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
     app.run(host="0.0.0.0", port=5000)
 
 if __name__ == "__main__":
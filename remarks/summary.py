@@ -0,0 +1,102 @@
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict
+
+
+@dataclass
+class RunSummary:
+    """Counters and per-stage timings collected while remarks processes documents"""
+
+    documents: int = 0
+    pages: int = 0
+    empty_pages: int = 0
+    """Pages with an annotation file but nothing to draw, left as the source page"""
+    timed_out_pages: int = 0
+    """Pages that took longer than the page timeout to render, left as the source page with a warning"""
+
+    points_before: int = 0
+    points_after: int = 0
+    """Stroke points before and after simplification, only counted when strokes are simplified"""
+
+    eraser_strokes: int = 0
+    erased_points: int = 0
+    """Eraser strokes removed before drawing, and the stroke points they erased"""
+
+    smart_highlights: int = 0
+    """Smart highlights of .highlights/*.json files added to the markdown"""
+
+    cached_markdown_pages: int = 0
+    """Pages whose markdown was taken from the cache of an earlier run, without parsing them"""
+
+    highlight_annotations: int = 0
+    """Highlights added as PDF highlight annotations"""
+
+    output_files: int = 0
+    output_bytes: int = 0
+    """PDF and markdown files written, and their size"""
+    unchanged_files: int = 0
+    """Output files that came out the same as the file already there, and were left alone"""
+
+    stage_timings: Dict[str, float] = field(default_factory=dict)
+    """Wall-clock seconds spent in each pipeline stage, summed over all pages and documents"""
+
+    stage_peak_memory: Dict[str, int] = field(default_factory=dict)
+    """Peak traced memory in bytes per stage, only filled in while tracemalloc is tracing"""
+
+    @contextmanager
+    def stage(self, name: str):
+        """Accumulate the time spent inside the `with` block under `name`.
+
+        Stages must not be nested, tracemalloc only keeps a single peak."""
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_timings[name] = self.stage_timings.get(name, 0.0) + time.perf_counter() - start
+            if tracing:
+                _, peak = tracemalloc.get_traced_memory()
+                self.stage_peak_memory[name] = max(self.stage_peak_memory.get(name, 0), peak)
+
+    def record_output(self, path: str, save_time: float, written: bool = True):
+        """Count an output file that was just saved, `written` is False if it was the same as before"""
+        if not written:
+            self.unchanged_files += 1
+            logging.info(f"- {path} didn't change, left it alone")
+            return
+        size = os.path.getsize(path)
+        self.output_files += 1
+        self.output_bytes += size
+        logging.info(f"- Saved {path}: {size / 1024:.0f} KiB in {save_time:.2f}s")
+
+    def log(self):
+        logging.info(f"Processed {self.documents} documents, {self.pages} pages")
+        if self.empty_pages:
+            logging.info(f"Skipped {self.empty_pages} pages without visible annotations")
+        if self.timed_out_pages:
+            logging.warning(f"Gave up on {self.timed_out_pages} pages that took too long to render")
+        if self.points_before:
+            logging.info(
+                f"Simplified strokes from {self.points_before} to {self.points_after} points "
+                f"({self.points_after / self.points_before:.0%})"
+            )
+        if self.eraser_strokes:
+            logging.info(f"Removed {self.eraser_strokes} eraser strokes, erasing {self.erased_points} stroke points")
+        if self.smart_highlights:
+            logging.info(f"Added {self.smart_highlights} smart highlights to markdown")
+        if self.cached_markdown_pages:
+            logging.info(f"Took the markdown of {self.cached_markdown_pages} unchanged pages from the cache")
+        if self.highlight_annotations:
+            logging.info(f"Added {self.highlight_annotations} highlight annotations")
+        logging.info(
+            f"Wrote {self.output_files} files, {self.output_bytes / 1024:.0f} KiB in total, "
+            f"{self.unchanged_files} files didn't change"
+        )
+        for name, duration in self.stage_timings.items():
+            logging.info(f"- {name}: {duration:.3f}s")
@@ -0,0 +1,57 @@
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+from .utils import warn_once
+
+
+class PageTimeoutError(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise PageTimeoutError()
+
+
+@contextmanager
+def time_limit(seconds: float = None):
+    """
+    Raise `PageTimeoutError` inside the `with` block once it ran for `seconds`.
+
+    Uses SIGALRM, like the whole-file timeout of datatest.py, which stays in effect: an alarm that was already set is
+    put back afterwards, minus the time spent in the block. Pure Python code and waiting on subprocesses are
+    interrupted, a single long call into a C library only when it returns.
+
+    Without `seconds` the block runs without a limit. So it does outside the main thread, or on platforms without
+    SIGALRM, with a warning that the limit doesn't apply. Convert in processes of their own to give up on pages in
+    parallel conversions, like remarks-server does.
+    """
+    if not seconds:
+        yield
+        return
+    if not hasattr(signal, "SIGALRM") or threading.current_thread() is not threading.main_thread():
+        warn_once(
+            f"- Pages are not given up on after {seconds}s, the page timeout only works in the main thread of a "
+            f"process, on platforms with SIGALRM"
+        )
+        yield
+        return
+
+    previous_delay, _ = signal.getitimer(signal.ITIMER_REAL)
+    if previous_delay and previous_delay <= seconds:
+        # the outer alarm goes off first anyway
+        yield
+        return
+
+    previous_handler = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        if previous_delay:
+            # an outer alarm that got due meanwhile still goes off, right away
+            signal.setitimer(signal.ITIMER_REAL, max(previous_delay - (time.monotonic() - start), 1e-3))
@@ -1,7 +1,21 @@
+import hashlib
 import json
+import logging
+import os
 import pathlib
-from functools import cache
-from typing import Tuple, List, Generator
+import re
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Tuple, List, Generator, Set, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
 
 # reMarkable's device dimensions
 RM_WIDTH = 1404
@@ -9,16 +23,129 @@ RM_HEIGHT = 1872
 
 INSERTED_PAGE = -1
 
+BLANK_TEMPLATE = "Blank"
 
-@cache
-def read_meta_file(path, suffix=".metadata"):
-    file = path.with_name(f"{path.stem}{suffix}")
-    if not file.exists():
-        return None
-    data = json.loads(open(file).read())
+# "5", "120-125" or "120-"
+PAGE_RANGE_PATTERN = re.compile(r"^(\d+)(-(\d*))?$")
+
+# PyMuPDF isn't thread-safe, every thread works on the same MuPDF state. Conversions in several threads take turns
+# with it: every call into PyMuPDF, and closing the documents, which frees them and their pages, happens while this
+# lock is held. Parsing, SVG, Inkscape and markdown run in parallel. Reentrant, so helpers can take it as well
+fitz_lock = threading.RLock()
+
+
+def load_json_file(path):
+    with open(path) as f:
+        data = json.load(f)
     return data
 
 
+def save_json_file(path, data):
+    """Write `data` to `path` in one go, readers see the old file or the new one. Every writer has a temporary file
+    of its own, so sessions that share a cache directory don't step on each other"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=directory, prefix=f"{os.path.basename(path)}.", suffix=".tmp",
+                                     delete=False) as f:
+        try:
+            json.dump(data, f)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on `path`.lock inside the `with` block, against other processes and threads. Without
+    fcntl nothing is locked"""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class MetadataIndex:
+    """The .metadata, .content, smart highlights and other JSON files of documents, each read once until it changes
+    on disk"""
+
+    def __init__(self):
+        # file path to its modification time and size, and its contents
+        self.files: Dict[str, Tuple[Tuple[int, int], Any]] = {}
+        # the index outside of sessions is shared by all threads
+        self.lock = threading.Lock()
+
+    def read(self, path, suffix=".metadata"):
+        return self.load(path.with_name(f"{path.stem}{suffix}"))
+
+    def load(self, file, parse: Callable[[Any], Any] = load_json_file):
+        """`parse(file)`, or what it returned the last time if `file` didn't change since. None if it doesn't exist.
+        Use a single `parse` per file"""
+        try:
+            stat = os.stat(file)
+        except FileNotFoundError:
+            return None
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.files.get(str(file))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        data = parse(file)
+        with self.lock:
+            self.files[str(file)] = (version, data)
+        return data
+
+
+# the index `read_meta_file` reads through, see `use_metadata_index`
+_metadata_index: ContextVar[MetadataIndex] = ContextVar("metadata_index", default=MetadataIndex())
+
+
+@contextmanager
+def use_metadata_index(index: MetadataIndex):
+    """Read metadata through `index` inside the `with` block"""
+    token = _metadata_index.set(index)
+    try:
+        yield
+    finally:
+        _metadata_index.reset(token)
+
+
+def read_meta_file(path, suffix=".metadata"):
+    return _metadata_index.get().read(path, suffix)
+
+
+# the messages `warn_once` logged so far, in this conversion or this thread, see `conversion_warnings`
+_shown_warnings: ContextVar[Optional[Set[str]]] = ContextVar("shown_warnings", default=None)
+
+
+def warn_once(message: str):
+    """Log `message` as a warning once, for problems that can come up on every stroke of a notebook"""
+    shown = _shown_warnings.get()
+    if shown is None:
+        shown = set()
+        _shown_warnings.set(shown)
+    if message not in shown:
+        shown.add(message)
+        logging.warning(message)
+
+
+@contextmanager
+def conversion_warnings():
+    """Inside the `with` block, every `warn_once` message is logged once more"""
+    token = _shown_warnings.set(set())
+    try:
+        yield
+    finally:
+        _shown_warnings.reset(token)
+
+
 def is_document(path):
     metadata = read_meta_file(path)
     return metadata["type"] == "DocumentType"
@@ -61,6 +188,20 @@ def get_ui_path(path):
     return ui_path
 
 
+def get_parent_uuids(path) -> List[str]:
+    """The UUIDs of the folders `path` is in, from its own folder up to the top level"""
+    parent_uuids = []
+    parent_uuid = read_meta_file(path)["parent"]
+    # "trash" has no .metadata of its own
+    while parent_uuid and parent_uuid not in parent_uuids:
+        parent_uuids.append(parent_uuid)
+        metadata = read_meta_file(pathlib.Path(path.parent, parent_uuid))
+        if not metadata:
+            break
+        parent_uuid = metadata["parent"]
+    return parent_uuids
+
+
 def construct_redirection_map(content: dict) -> List[int]:
     """
     Constructs a redirection map based on the .content file.
@@ -131,6 +272,115 @@ def get_pages_data(path: str) -> Tuple[List[str], List[int]]:
     return content["pages"], redirection_map
 
 
+def get_page_templates(path) -> List[Optional[str]]:
+    """The template name of every page in `get_pages_data` order, `None` for pages without a template.
+
+    Newer documents keep the templates in the .content file, older ones in the .pagedata file, one name per line."""
+    content = read_meta_file(path, suffix=".content")
+    if "cPages" in content:
+        templates = [page.get("template", {}).get("value") for page in content["cPages"]["pages"]
+                     if not page.get("deleted", {"value": 0})["value"] == 1]
+    else:
+        pagedata = path.with_name(f"{path.stem}.pagedata")
+        lines = pagedata.read_text().splitlines() if pagedata.exists() else []
+        templates = [line.strip() for line in lines][:len(content["pages"])]
+        templates += [None] * (len(content["pages"]) - len(templates))
+
+    return [template if template and template != BLANK_TEMPLATE else None for template in templates]
+
+
+def split_page_selection(selection) -> List[str]:
+    """
+    The items of a page selection, see `parse_page_selection`. Checks what can be checked without a document, so
+    that a malformed selection fails before any document is converted.
+
+    Raises:
+        ValueError: When an item is neither a page number, a range nor a page UUID, or a range is empty
+    """
+    if isinstance(selection, str):
+        selection = selection.split(",")
+
+    items = []
+    for item in selection:
+        if isinstance(item, int):
+            item = str(item)
+        item = item.strip()
+        if not item:
+            continue
+
+        match = PAGE_RANGE_PATTERN.match(item)
+        if match is None:
+            try:
+                uuid.UUID(item)
+            except ValueError:
+                raise ValueError(
+                    f"Invalid page selection: \"{item}\" is neither a page number, a range nor a page UUID"
+                ) from None
+        else:
+            first = int(match.group(1))
+            last = int(match.group(3)) if match.group(3) else None
+            if first < 1 or (last is not None and first > last):
+                raise ValueError(f"Invalid page selection: \"{item}\", pages are counted from 1")
+        items.append(item)
+
+    return items
+
+
+def parse_page_selection(selection, pages_list: List[str], document_name: str = None) -> Set[int]:
+    """
+    Resolves a page selection to 0-based page indices of a document.
+
+    The selection is either a string of comma separated items, or an iterable of items. An item is one of
+
+    - a page number, counted from 1 like the page numbers shown in the Markdown links, e.g. `5`
+    - an inclusive range of page numbers, e.g. `120-125`. An open end runs to the last page, e.g. `120-`
+    - a page UUID, as found in the .content file and the .rm file names
+
+    The same selection applies to every document of a library. Items that don't apply to this document, page UUIDs
+    of other documents and pages past its last page, are left out with a warning. A range that runs past the last
+    page is cut short.
+
+    Args:
+        selection: The page selection, e.g. "1,3,120-125,0f2b9c42-8a35-4d7a-9c6e-2b1c0b5f3f5a"
+        pages_list: The page UUIDs of the document, in order. See `get_pages_data`
+        document_name: The name of the document, for the warnings
+
+    Raises:
+        ValueError: When an item is malformed, see `split_page_selection`
+    """
+    page_count = len(pages_list)
+    page_indices = {page_uuid: i for i, page_uuid in enumerate(pages_list)}
+    selected = set()
+    skipped = []
+
+    for item in split_page_selection(selection):
+        match = PAGE_RANGE_PATTERN.match(item)
+        if match is None:
+            if item in page_indices:
+                selected.add(page_indices[item])
+            else:
+                skipped.append(item)
+            continue
+
+        first = int(match.group(1))
+        last = first if match.group(2) is None else int(match.group(3) or page_count)
+        if first > page_count:
+            skipped.append(item)
+            continue
+        if last > page_count:
+            skipped.append(item)
+            last = page_count
+        selected.update(range(first - 1, last))
+
+    if skipped:
+        warn_once(
+            f"- {document_name or 'The document'} has pages 1-{page_count}, "
+            f"the page selection doesn't apply to it in full: {', '.join(skipped)}"
+        )
+
+    return selected
+
+
 def list_ann_rm_files(path):
     content_dir = pathlib.Path(f"{path.parents[0]}/{path.stem}/")
     # print("content_dir", content_dir, not content_dir.is_dir())
@@ -147,10 +397,25 @@ def list_hl_json_files(path):
     return list(hl_dir.glob("*.json"))
 
 
-def load_json_file(path):
-    with open(path) as f:
-        data = json.load(f)
-    return data
+def load_smart_highlights(path) -> Tuple[dict, ...]:
+    """The smart highlights of a page's .highlights/*.json file, of all its layers.
+
+    Files are parsed once and kept in the `MetadataIndex` of the session until they change on disk. Treat the
+    highlights as read-only, they are shared."""
+    return _metadata_index.get().load(path, _parse_smart_highlights)
+
+
+def _parse_smart_highlights(path) -> Tuple[dict, ...]:
+    return tuple(hl for layer in load_json_file(path)["highlights"] for hl in layer)
+
+
+def file_digest(path) -> str:
+    """The SHA-256 of the contents of `path`, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def prepare_subdir(base_dir, fmt):
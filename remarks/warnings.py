@@ -24,3 +24,4 @@ class ScrybbleWarning:
 
 
 scrybble_warning_only_v6_supported = ScrybbleWarning("This page is not V6")
+scrybble_warning_page_timeout = ScrybbleWarning("This page took too long to render")
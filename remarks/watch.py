@@ -0,0 +1,138 @@
+import logging
+import os
+import queue
+import time
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+# watchdog also reports files that were only opened or read, converting a document would trigger itself
+WRITE_EVENTS = {"created", "modified", "deleted", "moved", "closed"}
+
+
+def document_uuid(input_dir: str, path: str) -> Optional[str]:
+    """
+    The UUID of the document that `path` belongs to, in a xochitl-like directory: <uuid>.metadata, <uuid>.content,
+    <uuid>.pdf, <uuid>/<page>.rm, <uuid>.highlights/<page>.json and so on. None for files outside `input_dir`.
+    """
+    relative = os.path.relpath(path, input_dir)
+    if relative.startswith(os.pardir) or relative == os.curdir:
+        return None
+    name = relative.split(os.sep)[0]
+    return name.split(".")[0] or None
+
+
+class PollingWatcher:
+    """Finds changed files by comparing the size and modification time of every file, every `interval` seconds"""
+
+    def __init__(self, input_dir: str, interval: float = 1.0):
+        self.input_dir = input_dir
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+        files = {}
+        for root, _, names in os.walk(self.input_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files[path] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def changes(self, timeout: float) -> Set[str]:
+        """The files that were added, changed or removed since the last call, waits `timeout` seconds"""
+        time.sleep(min(timeout, self.interval))
+        snapshot = self.scan()
+        changed = {
+            path for path in snapshot.keys() | self.snapshot.keys() if snapshot.get(path) != self.snapshot.get(path)
+        }
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Finds changed files with the file system's own notifications, inotify on Linux. Needs watchdog"""
+
+    def __init__(self, input_dir: str):
+        self.events: "queue.Queue[str]" = queue.Queue()
+        events = self.events
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type not in WRITE_EVENTS:
+                    return
+                events.put(event.src_path)
+                # files are moved into place by xochitl and most sync tools
+                if getattr(event, "dest_path", None):
+                    events.put(event.dest_path)
+
+        self.observer = Observer()
+        self.observer.schedule(Handler(), input_dir, recursive=True)
+        self.observer.start()
+
+    def changes(self, timeout: float) -> Set[str]:
+        """The files that changed since the last call, waits up to `timeout` seconds for the first one"""
+        try:
+            changed = {self.events.get(timeout=timeout)}
+        except queue.Empty:
+            return set()
+        while not self.events.empty():
+            changed.add(self.events.get_nowait())
+        return changed
+
+    def close(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+def start_watcher(input_dir: str, poll_interval: float = 1.0):
+    """Start collecting the changes in `input_dir`. Uses inotify through watchdog, the 'watch' extra, when it is
+    installed, and checks the files every `poll_interval` seconds otherwise. `close` it when done"""
+    if Observer is not None:
+        return InotifyWatcher(input_dir)
+    logging.info(
+        f"- watchdog is not installed, checking for changes every {poll_interval}s instead. "
+        f"Install remarks with the 'watch' extra for inotify"
+    )
+    return PollingWatcher(input_dir, poll_interval)
+
+
+def watch_documents(
+        input_dir: str, debounce: float = 2.0, poll_interval: float = 1.0, watcher=None
+) -> Iterator[Set[str]]:
+    """
+    Yields the UUIDs of the documents in `input_dir` whose files changed, see `document_uuid`.
+
+    A sync writes many files in bursts. Changes are collected until no file changed for `debounce` seconds, every
+    document is yielded once for all of them. Pass a `watcher` from `start_watcher` to include the changes made
+    before the first document is asked for, it is left open. Otherwise one is started, see `start_watcher`.
+    """
+    owns_watcher = watcher is None
+    if owns_watcher:
+        watcher = start_watcher(input_dir, poll_interval)
+
+    pending: Set[str] = set()
+    last_change = time.monotonic()
+    try:
+        while True:
+            uuids = {document_uuid(input_dir, path) for path in watcher.changes(timeout=poll_interval)}
+            uuids.discard(None)
+            if uuids:
+                pending |= uuids
+                last_change = time.monotonic()
+            elif pending and time.monotonic() - last_change >= debounce:
+                yield pending
+                pending = set()
+    finally:
+        if owns_watcher:
+            watcher.close()
@@ -1,6 +1,23 @@
 from parsita import lit, reg, rep, Parser, opt, Failure, until
 from returns.result import Success
 
+import json
+import os
+from types import SimpleNamespace
+
+import fitz
+
+import remarks
+from remarks.conversion.text import (
+    check_if_text_extractable,
+    extract_groups_from_pdf_ann_hl,
+    group_smart_highlights,
+    prepare_md_from_hl_groups,
+    prepare_md_from_page,
+)
+from remarks.output.ObsidianMarkdownFile import ObsidianMarkdownFile
+from remarks.output.OutputMode import OutputMode
+from remarks.utils import load_smart_highlights
 from tests.notebook_fixtures import *
 
 r"""
@@ -85,3 +102,120 @@ def test_highlights_are_available_in_markdown(notebook, remarks_document, obsidi
     assert_parser_succeeds(until(smart_highlight_three) >> smart_highlight_three << whatever, obsidian_markdown, smart_highlight_three)
     assert_parser_succeeds(until(smart_highlight_four) >> smart_highlight_four << whatever, obsidian_markdown, smart_highlight_four)
     # assert_parser_succeeds(until(smart_highlight_five) >> smart_highlight_four << whatever, obsidian_markdown, smart_highlight_five)
+
+
+@pytest.mark.markdown
+@pytest.mark.parametrize("notebook", ["highlights_document"], indirect=True)
+def test_markdown_output_mode_writes_no_pdf(notebook, tmp_path):
+    remarks.run_remarks(notebook.rmn_source, str(tmp_path), output_mode=OutputMode.MARKDOWN)
+
+    with open(tmp_path / f"{notebook.notebook_name} _obsidian.md") as f:
+        obsidian_markdown = f.read()
+    assert "theory of functions" in obsidian_markdown
+    assert list(tmp_path.glob("*.pdf")) == []
+
+
+@pytest.mark.markdown
+@pytest.mark.parametrize("notebook", ["highlights_document"], indirect=True)
+def test_unchanged_pages_take_their_markdown_from_the_cache(notebook, tmp_path):
+    cache_dir = tmp_path / "cache"
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    markdown_path = out_dir / f"{notebook.notebook_name} _obsidian.md"
+
+    first = remarks.run_remarks(notebook.rmn_source, str(out_dir), output_mode=OutputMode.MARKDOWN,
+                                cache_dir=str(cache_dir))
+    with open(markdown_path) as f:
+        uncached_markdown = f.read()
+    second = remarks.run_remarks(notebook.rmn_source, str(out_dir), output_mode=OutputMode.MARKDOWN,
+                                 cache_dir=str(cache_dir))
+    with open(markdown_path) as f:
+        cached_markdown = f.read()
+
+    assert first.cached_markdown_pages == 0
+    assert second.cached_markdown_pages == second.pages > 0
+    # nothing was parsed the second time
+    assert "parse" not in second.stage_timings
+    assert cached_markdown == uncached_markdown
+
+
+@pytest.mark.markdown
+def test_highlights_are_marked_in_their_text_block():
+    document = fitz.open()
+    page = document.new_page()
+    page.insert_text((50, 100), "On computable numbers, with an application to the Entscheidungsproblem")
+    page.insert_text((50, 300), "The computable numbers may be described briefly as the real numbers")
+
+    markdown = prepare_md_from_hl_groups(
+        page,
+        [["computable", "numbers"], ["described", "briefly"], ["as", "the"], ["not", "on", "the", "page"]],
+        [],
+    )
+
+    assert markdown == "\n\n".join([
+        "On <mark>computable numbers</mark>, with an application to the Entscheidungsproblem",
+        # highlights that only a space separates are a single mark
+        "The computable numbers may be <mark>described briefly as the</mark> real numbers",
+        "<mark>not on the page</mark>",
+    ])
+
+
+@pytest.mark.markdown
+def test_markdown_from_a_shared_textpage_matches_separate_extraction():
+    document = fitz.open()
+    page = document.new_page()
+    page.insert_text((50, 100), "On computable numbers, with an application to the Entscheidungsproblem")
+    page.insert_text((50, 300), "The computable numbers may be described briefly as the real numbers")
+    # a little inside the words, so the highlight doesn't touch the words around them
+    page.add_highlight_annot(page.search_for("described briefly")[0] + (2, 2, -2, -2))
+
+    malformed = not check_if_text_extractable(page)
+    ann_hl_groups = extract_groups_from_pdf_ann_hl(page, malformed=malformed)
+    expected = prepare_md_from_hl_groups(page, ann_hl_groups, [["application"]])
+
+    assert prepare_md_from_page(page, [["application"]]) == expected
+    assert "<mark>described briefly</mark>" in expected
+
+
+@pytest.mark.markdown
+def test_smart_highlights_are_grouped_in_markdown(tmp_path):
+    highlights_file = tmp_path / "page.json"
+    with open(highlights_file, "w") as f:
+        json.dump({"highlights": [
+            [{"start": 20, "length": 5, "text": "numbers"}, {"start": 0, "length": 10, "text": "computable"}],
+            [{"start": 11, "length": 8, "text": "briefly"}],
+        ]}, f)
+
+    markdown = ObsidianMarkdownFile(SimpleNamespace(name="Turing", rm_tags=[]))
+    markdown.add_smart_highlights(0, group_smart_highlights(load_smart_highlights(highlights_file)))
+
+    assert markdown.page_content == {
+        1: ["### [[Turing.pdf#page=1|Turing, page 1]]\n\n", "> computable briefly numbers\n\n"]
+    }
+
+
+@pytest.mark.markdown
+def test_markdown_streams_finished_pages(tmp_path):
+    location = str(tmp_path / "Turing")
+    streamed = ObsidianMarkdownFile(SimpleNamespace(name="Turing", rm_tags=[]), location)
+    in_memory = ObsidianMarkdownFile(SimpleNamespace(name="Turing", rm_tags=[]))
+    for markdown in (streamed, in_memory):
+        markdown.add_document_header()
+
+    for page_idx in (0, 2, 3):
+        for markdown in (streamed, in_memory):
+            markdown.add_smart_highlights(page_idx, [[f"page {page_idx}"]])
+            markdown.write_pages_before(page_idx + 1)
+        # finished pages are written and forgotten, but the file only gets its name when saved
+        assert streamed.page_content == {}
+        assert not os.path.exists(f"{location} _obsidian.md")
+
+    streamed.save(location)
+    with open(f"{location} _obsidian.md") as f:
+        streamed_md = f.read()
+    in_memory.save(str(tmp_path / "in memory"))
+    with open(f"{tmp_path / 'in memory'} _obsidian.md") as f:
+        assert streamed_md == f.read()
+    assert streamed_md.index("> page 0") < streamed_md.index("> page 2") < streamed_md.index("> page 3")
+    # no temporary files are left behind
+    assert sorted(os.listdir(tmp_path)) == ["Turing _obsidian.md", "in memory _obsidian.md"]
@@ -1,4 +1,28 @@
+import io
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz
+import numpy as np
 import pytest
+from rmscene import CrdtId, SceneTree, read_tree
+from rmscene import scene_items as si
+from rmc.exporters.svg import SCALE, tree_to_svg
+from rmscene.crdt_sequence import CrdtSequenceItem, END_MARKER
+from rmscene.scene_items import GlyphRange, Line
+
+import remarks
+from remarks.conversion.erasers import Erasers, remove_erasers
+from remarks.conversion.parsing import has_visible_content
+from remarks.conversion.simplify import simplify_scene_tree
+from remarks.conversion.text import get_highlight_rects, intersecting_rects_mask
+from remarks.output.BatchedPdfRenderer import tree_to_pdf
+from remarks.output.HighlightAnnotations import add_highlight_annotations
+from remarks.output.InkscapePool import InkscapePool, find_inkscape
+from remarks.output.OutputMode import OutputMode
+from remarks.output.StreamingPdfWriter import StreamingPdfWriter
+from remarks.warnings import scrybble_warning_page_timeout
 
 from tests.pdf_test_support import assert_page_renders_without_warnings, assert_warning_exists
 from tests.notebook_fixtures import *
@@ -44,3 +68,363 @@ def test_warnings_match_specification(notebook, remarks_document):
             assert_page_renders_without_warnings(remarks_document, page_num)
 
 
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["gosper_notebook"], indirect=True)
+@pytest.mark.parametrize("output_mode", [OutputMode.ANNOTATED, OutputMode.OVERLAY])
+def test_annotation_only_output_maps_pages_to_source(notebook, output_mode, tmp_path):
+    remarks.run_remarks(notebook.rmn_source, str(tmp_path), output_mode=output_mode)
+
+    document = fitz.open(tmp_path / f"{notebook.notebook_name} _remarks_{output_mode}.pdf")
+    source_pages = [int(document.xref_get_key(page.xref, "RemarksSourcePage")[1]) for page in document]
+    assert source_pages == sorted(file["input_document_position"] for file in notebook.rm_files)
+    assert [page.get_label() for page in document] == [str(i + 1) for i in source_pages]
+    assert list(tmp_path.glob("* _remarks.pdf")) == []
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["gosper_notebook"], indirect=True)
+def test_only_selected_pages_are_emitted(notebook, tmp_path):
+    remarks.run_remarks(notebook.rmn_source, str(tmp_path), pages="2-3", only_selected_pages=True)
+
+    document = fitz.open(tmp_path / f"{notebook.notebook_name} _remarks.pdf")
+    assert document.page_count == 2
+    assert [page.get_label() for page in document] == ["2", "3"]
+    for page in document:
+        assert_warning_exists(document, page.number, scrybble_warning_only_v6_supported)
+
+
+@pytest.mark.pdf
+def test_page_selection_applies_to_every_document_of_a_library(tmp_path, caplog):
+    in_dir, out_dir = tmp_path / "in", tmp_path / "out"
+    for source in ["tests/in/v2 notebook complex.rmn", "tests/in/v3 markdown tags.rmn"]:
+        with zipfile.ZipFile(source) as rmn:
+            rmn.extractall(in_dir)
+    out_dir.mkdir()
+
+    # page 3 and the page UUID only exist in the Gosper notebook, the tags document has 2 pages
+    remarks.run_remarks(str(in_dir), str(out_dir), pages="3,e411a942-054b-4d32-9be3-e224a800b84e",
+                        only_selected_pages=True, renderer=remarks.Renderer.BATCHED)
+
+    document = fitz.open(out_dir / "Gosper _remarks.pdf")
+    assert [page.get_label() for page in document] == ["1", "3"]
+    assert not (out_dir / "tags test _remarks.pdf").exists()
+    assert "tags test has pages 1-2" in caplog.text
+
+    with pytest.raises(ValueError):
+        remarks.run_remarks(str(in_dir), str(out_dir), pages="3,first")
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["gosper_notebook"], indirect=True)
+@pytest.mark.parametrize("stream_chunk_size", [1, 2])
+def test_streamed_output_matches_specification(notebook, stream_chunk_size, tmp_path):
+    remarks.run_remarks(notebook.rmn_source, str(tmp_path), stream_chunk_size=stream_chunk_size)
+
+    document = fitz.open(tmp_path / f"{notebook.notebook_name} _remarks.pdf")
+    assert document.page_count == notebook.export_properties["merged_pages"]
+    for warning_spec in notebook.export_properties["warnings"]:
+        for warning in warning_spec["warning"]:
+            assert_warning_exists(document, warning_spec["output_document_position"], warning)
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["gosper_notebook"], indirect=True)
+def test_streamed_output_is_removed_when_a_page_fails(notebook, tmp_path, monkeypatch):
+    render_page = remarks.remarks.render_page
+    rendered = []
+
+    def failing_render_page(*args, **kwargs):
+        rendered.append(args[2])
+        if len(rendered) == 3:
+            raise RuntimeError("a page that can't be rendered")
+        return render_page(*args, **kwargs)
+
+    monkeypatch.setattr(remarks.remarks, "render_page", failing_render_page)
+    writers = []
+    monkeypatch.setattr(remarks.remarks, "StreamingPdfWriter",
+                        lambda *args: writers.append(StreamingPdfWriter(*args)) or writers[-1])
+    with pytest.raises(RuntimeError):
+        remarks.run_remarks(notebook.rmn_source, str(tmp_path), stream_chunk_size=1)
+
+    assert len(rendered) == 3
+    assert writers and all(writer.doc.is_closed for writer in writers)
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["gosper_notebook"], indirect=True)
+@pytest.mark.parametrize("save_profile", ["compact", "smallest"])
+def test_save_profile_keeps_output_intact(notebook, save_profile, tmp_path):
+    summary = remarks.run_remarks(notebook.rmn_source, str(tmp_path), save_profile=save_profile, linearize=True)
+
+    path = tmp_path / f"{notebook.notebook_name} _remarks.pdf"
+    assert summary.output_files == 1
+    assert summary.output_bytes == path.stat().st_size
+    document = fitz.open(path)
+    assert document.page_count == notebook.export_properties["merged_pages"]
+    for warning_spec in notebook.export_properties["warnings"]:
+        for warning in warning_spec["warning"]:
+            assert_warning_exists(document, warning_spec["output_document_position"], warning)
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["gosper_notebook"], indirect=True)
+def test_page_template_is_shared_between_pages(notebook, tmp_path):
+    templates_dir = tmp_path / "templates"
+    templates_dir.mkdir()
+    (templates_dir / "P Dots large.svg").write_text(
+        '<svg xmlns="http://www.w3.org/2000/svg" width="1404" height="1872">'
+        '<circle cx="702" cy="936" r="4" fill="#999"/></svg>'
+    )
+    remarks.run_remarks(notebook.rmn_source, str(tmp_path), templates_dir=str(templates_dir))
+
+    document = fitz.open(tmp_path / f"{notebook.notebook_name} _remarks.pdf")
+    assert document.page_count == notebook.export_properties["merged_pages"]
+    # every page places the template with a small XObject of its own, which invokes the one that draws it
+    template_xrefs = {xref for page in document for xref, _, invoker, _ in page.get_xobjects() if invoker != 0}
+    assert len(template_xrefs) == 1
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["colored_document"], indirect=True)
+def test_simplified_strokes_keep_their_endpoints(notebook):
+    with zipfile.ZipFile(notebook.rmn_source) as rmn:
+        rm_files = [name for name in rmn.namelist() if name.endswith(".rm")]
+        trees = [read_tree(io.BytesIO(rmn.read(name))) for name in rm_files]
+
+    for tree in trees:
+        lines = [item for item in tree.walk() if isinstance(item, Line) and item.points]
+        original = [list(line.points) for line in lines]
+
+        points_before, points_after = simplify_scene_tree(tree, tolerance=0.3)
+
+        assert points_before == sum(len(points) for points in original)
+        assert points_after == sum(len(line.points) for line in lines) < points_before
+        for line, points in zip(lines, original):
+            assert line.points[0] is points[0] and line.points[-1] is points[-1]
+
+
+def point(x, y):
+    return si.Point(x, y, speed=0, direction=0, width=2, pressure=100)
+
+
+def scene_tree(lines):
+    """A page holding `lines`, in drawing order"""
+    tree = SceneTree()
+    left_id = END_MARKER
+    for i, line in enumerate(lines):
+        item_id = CrdtId(1, i + 10)
+        tree.add_item(CrdtSequenceItem(item_id, left_id, END_MARKER, 0, line), tree.root.node_id)
+        left_id = item_id
+    return tree
+
+
+@pytest.mark.pdf
+def test_erasers_remove_what_they_cover():
+    tree = scene_tree([
+        Line(si.PenColor.BLACK, si.Pen.FINELINER_1, [point(x, 0) for x in range(0, 100, 5)], 2.0, 0),
+        Line(si.PenColor.WHITE, si.Pen.ERASER, [point(50, -10), point(50, 10)], 3.0, 0),
+        Line(si.PenColor.BLACK, si.Pen.FINELINER_1, [point(x, 1) for x in range(0, 100, 5)], 2.0, 0),
+    ])
+
+    assert remove_erasers(tree, Erasers.SUBTRACT) == (1, 1)
+
+    lines = [item for item in tree.walk() if isinstance(item, Line)]
+    # the first stroke falls apart around the eraser, the stroke drawn after the eraser is left alone
+    assert [len(line.points) for line in lines] == [10, 9, 20]
+    assert all(line.tool != si.Pen.ERASER for line in lines)
+
+
+@pytest.mark.pdf
+def test_pages_without_visible_content_are_detected():
+    stroke = Line(si.PenColor.BLACK, si.Pen.FINELINER_1, [point(0, 0), point(10, 10)], 2.0, 0)
+    eraser = Line(si.PenColor.WHITE, si.Pen.ERASER, [point(0, 0), point(10, 10)], 3.0, 0)
+    erase_area = Line(si.PenColor.BLACK, si.Pen.ERASER_AREA, [point(0, 0), point(10, 0), point(0, 10)], 2.0, 0)
+
+    assert not has_visible_content(SceneTree())
+    assert not has_visible_content(scene_tree([erase_area]))
+    assert has_visible_content(scene_tree([stroke, erase_area]))
+
+    # a page where everything was erased is empty once the erasers are resolved
+    tree = scene_tree([stroke, eraser])
+    assert has_visible_content(tree)
+    remove_erasers(tree, Erasers.SUBTRACT)
+    assert not has_visible_content(tree)
+
+    # the renderers don't draw highlights, only native highlights do
+    highlight = si.GlyphRange(0, 5, "words", si.PenColor.YELLOW, [si.Rectangle(0, 0, 50, 10)])
+    assert not has_visible_content(scene_tree([highlight]))
+    assert has_visible_content(scene_tree([highlight]), highlights=True)
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["black_and_white"], indirect=True)
+@pytest.mark.parametrize("native_highlights", [False, True])
+def test_pages_with_only_highlights_are_not_rendered(notebook, native_highlights, tmp_path, monkeypatch):
+    with zipfile.ZipFile(notebook.rmn_source) as rmn:
+        rmn.extractall(tmp_path)
+    rm_file = next(tmp_path.glob("*/*.rm"))
+    highlight = si.GlyphRange(0, 5, "words", si.PenColor.YELLOW, [si.Rectangle(0, 0, 50, 10)])
+    monkeypatch.setattr(remarks.remarks, "read_tree", lambda f: scene_tree([highlight]))
+    doc = fitz.open()
+    doc.new_page()
+    summary = remarks.RunSummary()
+
+    remarks.remarks.render_page(doc, rm_file.stem, 0, rm_file, summary, native_highlights=native_highlights)
+
+    assert "render" not in summary.stage_timings
+    if native_highlights:
+        assert summary.empty_pages == 0
+        assert summary.highlight_annotations == 1
+        assert len(list(doc[0].annots())) == 1
+    else:
+        assert summary.empty_pages == 1
+        assert doc[0].get_contents() == [] and not list(doc[0].annots())
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["highlights_document"], indirect=True)
+def test_native_highlights_cover_the_highlighted_text(notebook):
+    with zipfile.ZipFile(notebook.rmn_source) as rmn:
+        pdf_file = next(name for name in rmn.namelist() if name.endswith(".pdf"))
+        source = fitz.open("pdf", rmn.read(pdf_file))
+        trees = [read_tree(io.BytesIO(rmn.read(name))) for name in rmn.namelist() if name.endswith(".rm")]
+    highlights = [item for tree in trees for item in tree.walk() if isinstance(item, GlyphRange)]
+    # the first page of the notebook is the one with highlights
+    page = source[0]
+
+    assert add_highlight_annotations(page, highlights, (page.rect.width / 2, 0), SCALE) == len(highlights)
+
+    rects = get_highlight_rects(page, sort=False)
+    assert len(rects) == len(highlights)
+    for rect, highlight in zip(rects, highlights):
+        first_word = highlight.text.split()[0]
+        assert first_word in page.get_textbox(rect)
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["highlights_document"], indirect=True)
+def test_highlighted_words_match_rect_intersection(notebook):
+    with zipfile.ZipFile(notebook.rmn_source) as rmn:
+        pdf_file = next(name for name in rmn.namelist() if name.endswith(".pdf"))
+        source = fitz.open("pdf", rmn.read(pdf_file))
+        trees = [read_tree(io.BytesIO(rmn.read(name))) for name in rmn.namelist() if name.endswith(".rm")]
+    highlights = [item for tree in trees for item in tree.walk() if isinstance(item, GlyphRange)]
+    page = source[0]
+    add_highlight_annotations(page, highlights, (page.rect.width / 2, 0), SCALE)
+
+    words = page.get_text("words")
+    hl_rects = get_highlight_rects(page)
+    expected = [any(fitz.Rect(w[:4]).intersects(r) for r in hl_rects) for w in words]
+
+    assert intersecting_rects_mask([w[:4] for w in words], hl_rects).tolist() == expected
+    assert any(expected)
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["colored_document"], indirect=True)
+def test_converter_pool_output_matches_per_page_conversion(notebook, remarks_document, tmp_path):
+    remarks.run_remarks(notebook.rmn_source, str(tmp_path), converter_workers=2)
+
+    document = fitz.open(tmp_path / f"{notebook.notebook_name} _remarks.pdf")
+    assert document.page_count == remarks_document.page_count
+    for page, expected in zip(document, remarks_document):
+        assert page.rect == expected.rect
+
+
+@pytest.mark.pdf
+@pytest.mark.skipif(find_inkscape() is None, reason="Inkscape is not installed")
+def test_inkscape_shell_converts_paths_with_action_separators(tmp_path):
+    directory = tmp_path / "shell; actions:here"
+    directory.mkdir()
+    svg = directory / "page;1.svg"
+    svg.write_text(
+        '<svg xmlns="http://www.w3.org/2000/svg" width="200" height="100" viewBox="0 0 200 100">'
+        '<path d="M 10 10 L 190 90" stroke="black" stroke-width="4"/></svg>'
+    )
+
+    with InkscapePool(1) as pool:
+        # the second file goes to the shell that is already running
+        for name in ["page:1.pdf", "page 2.pdf"]:
+            pool.convert(str(svg), str(directory / name))
+            document = fitz.open(directory / name)
+            assert document.page_count == 1
+            assert document[0].get_drawings()
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["black_and_white"], indirect=True)
+def test_pages_that_render_too_long_get_a_warning(notebook, tmp_path, monkeypatch):
+    def read_tree_forever(f):
+        time.sleep(60)
+
+    monkeypatch.setattr(remarks.remarks, "read_tree", read_tree_forever)
+    start = time.monotonic()
+    summary = remarks.run_remarks(notebook.rmn_source, str(tmp_path), page_timeout=0.5)
+
+    assert time.monotonic() - start < 30
+    assert summary.timed_out_pages == 1
+    document = fitz.open(tmp_path / f"{notebook.notebook_name} _remarks.pdf")
+    assert document.page_count == notebook.export_properties["merged_pages"]
+    assert_warning_exists(document, 0, scrybble_warning_page_timeout)
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["black_and_white"], indirect=True)
+def test_page_timeout_outside_the_main_thread_is_reported(notebook, tmp_path, caplog):
+    with ThreadPoolExecutor(max_workers=1) as thread:
+        summary = thread.submit(
+            remarks.run_remarks, notebook.rmn_source, str(tmp_path), renderer=remarks.Renderer.BATCHED,
+            page_timeout=0.5,
+        ).result()
+
+    assert "the page timeout only works in the main thread" in caplog.text
+    # the document is converted as usual
+    assert summary.timed_out_pages == 0
+    assert fitz.open(tmp_path / f"{notebook.notebook_name} _remarks.pdf").page_count == 1
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", all_notebooks, indirect=True)
+def test_batched_renderer_output_matches_specification(notebook, tmp_path):
+    remarks.run_remarks(notebook.rmn_source, str(tmp_path), renderer=remarks.Renderer.BATCHED)
+
+    document = fitz.open(tmp_path / f"{notebook.notebook_name} _remarks.pdf")
+    assert document.page_count == notebook.export_properties["merged_pages"]
+    expected_warnings = notebook.export_properties.get("warnings", [])
+    for page_num in range(document.page_count):
+        page_warnings = [w for w in expected_warnings if w["output_document_position"] == page_num]
+        if page_warnings:
+            for warning_spec in page_warnings:
+                for warning in warning_spec["warning"]:
+                    assert_warning_exists(document, page_num, warning)
+        else:
+            assert_page_renders_without_warnings(document, page_num)
+
+
+def ink(page: fitz.Page, scale: float):
+    """The size of `page` rendered at `scale`, the bounding box of its ink in pixels and the number of ink pixels"""
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+    samples = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n)
+    ys, xs = np.nonzero((samples < 200).any(axis=2))
+    return (pixmap.width, pixmap.height), (xs.min(), ys.min(), xs.max(), ys.max()), len(xs)
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("notebook", ["black_and_white", "colored_document"], indirect=True)
+def test_batched_renderer_draws_what_the_svg_renderer_draws(notebook):
+    with zipfile.ZipFile(notebook.rmn_source) as rmn:
+        trees = [read_tree(io.BytesIO(rmn.read(name))) for name in rmn.namelist() if name.endswith(".rm")]
+
+    for tree in trees:
+        svg = io.StringIO()
+        tree_to_svg(tree, svg)
+        # MuPDF converts the SVG instead of Inkscape. It makes a px of the SVG a pt, Inkscape a 96th of an inch
+        svg_pdf = fitz.open("pdf", fitz.open("svg", svg.getvalue().encode()).convert_to_pdf())
+        batched_pdf, _ = tree_to_pdf(tree)
+
+        svg_size, svg_bbox, svg_pixels = ink(svg_pdf[0], 72 / 96)
+        batched_size, batched_bbox, batched_pixels = ink(batched_pdf[0], 1)
+        assert batched_size == svg_size
+        assert all(abs(a - b) <= 2 for a, b in zip(batched_bbox, svg_bbox))
+        assert batched_pixels == pytest.approx(svg_pixels, rel=0.05)
+
@@ -0,0 +1,96 @@
+import json
+import random
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import remarks
+from tests.perf_support import (
+    PerfMeasurement,
+    find_regressions,
+    load_perf_baseline,
+    measure_remarks,
+    save_perf_baseline,
+)
+from tests.notebook_fixtures import *
+from remarks.conversion.text import group_smart_highlights
+from remarks.output.ObsidianMarkdownFile import ObsidianMarkdownFile
+from remarks.utils import MetadataIndex, load_smart_highlights, use_metadata_index
+
+r"""
+ _____  ______ _____  ______
+|  __ \|  ____|  __ \|  ____|
+| |__) | |__  | |__) | |__
+|  ___/|  __| |  _  /|  __|
+| |    | |____| | \ \| |
+|_|    |______|_|  \_\_|
+
+Timings and peak memory are compared against tests/perf_baseline.json.
+Record a new baseline with `pytest -m perf --perf-update-baseline` after an intentional change.
+Baselines are kept per notebook and renderer, the SVG renderer can only be measured where Inkscape is installed.
+"""
+
+
+@pytest.mark.perf
+@pytest.mark.parametrize("notebook", all_notebooks, indirect=True)
+@pytest.mark.parametrize("renderer", remarks.Renderer.ALL)
+def test_no_performance_regression(notebook, renderer, request):
+    baseline_name = f"{request.node.callspec.params['notebook']}[{renderer}]"
+    runs = request.config.getoption("--perf-runs")
+    tolerance = request.config.getoption("--perf-tolerance")
+
+    baseline = load_perf_baseline().get(baseline_name)
+    if baseline is None and not request.config.getoption("--perf-update-baseline"):
+        pytest.skip(f"No performance baseline recorded for {baseline_name}, run with --perf-update-baseline")
+
+    measurement = measure_remarks(notebook.rmn_source, runs, renderer)
+
+    if request.config.getoption("--perf-update-baseline"):
+        save_perf_baseline(baseline_name, measurement)
+        return
+
+    regressions = find_regressions(PerfMeasurement.from_json(baseline), measurement, tolerance)
+    assert not regressions, "\n".join(regressions)
+
+
+def write_smart_highlights(path, count: int):
+    """A .highlights/*.json file with `count` highlights in two layers. The device writes them in the order they were
+    made, not in text order"""
+    # one character apart they join, every third one starts a new group after a wider gap
+    highlights = [
+        {"start": i * 11 + (i // 3) * 5, "length": 10, "text": f"highlight {i}"}
+        for i in range(count)
+    ]
+    random.Random(0).shuffle(highlights)
+    with open(path, "w") as f:
+        json.dump({"highlights": [highlights[::2], highlights[1::2]]}, f)
+
+
+def time_smart_highlights_stage(path, index: MetadataIndex = None) -> float:
+    """Without an `index` of a session that read `path` already, the file is parsed"""
+    with use_metadata_index(index or MetadataIndex()):
+        start = time.perf_counter()
+        markdown = ObsidianMarkdownFile(SimpleNamespace(name="Benchmark", rm_tags=[]))
+        smart_highlights = load_smart_highlights(path)
+        markdown.add_smart_highlights(0, group_smart_highlights(smart_highlights))
+        return time.perf_counter() - start
+
+
+@pytest.mark.perf
+def test_smart_highlights_stage_scales_linearly(tmp_path):
+    small, large = tmp_path / "small.json", tmp_path / "large.json"
+    write_smart_highlights(small, 2_000)
+    write_smart_highlights(large, 20_000)
+
+    small_time = min(time_smart_highlights_stage(small) for _ in range(3))
+    large_time = min(time_smart_highlights_stage(large) for _ in range(3))
+    index = MetadataIndex()
+    time_smart_highlights_stage(large, index)
+    large_cached = min(time_smart_highlights_stage(large, index) for _ in range(3))
+
+    assert large_time < 2
+    # ten times the highlights, sorting included, shouldn't cost much more than ten times the time
+    assert large_time < max(small_time, 1e-3) * 30
+    # the file is parsed once, until it changes
+    assert large_cached < large_time
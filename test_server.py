@@ -0,0 +1,48 @@
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import remarks
+
+
+@pytest.fixture
+def server_client():
+    server = pytest.importorskip("remarks.server")
+    return server.app.test_client()
+
+
+def test_server_converts_requests_at_once_in_threads(server_client, tmp_path):
+    sources = ["tests/in/v3 markdown tags.rmn", "tests/in/rmpp - v6 - black and white only.rmn"]
+    cache_dir = tmp_path / "cache"
+    in_paths = []
+    for i, source in enumerate(sources):
+        (tmp_path / f"library {i}").mkdir()
+        in_paths.append(shutil.copy(source, tmp_path / f"library {i}"))
+
+    def post(in_path):
+        return server_client.post("/process", json={
+            "in_path": in_path, "out_path": str(tmp_path), "renderer": remarks.Renderer.BATCHED,
+            "cache_dir": str(cache_dir),
+        })
+
+    with ThreadPoolExecutor(max_workers=len(in_paths)) as requests:
+        responses = list(requests.map(post, in_paths))
+
+    assert [response.status_code for response in responses] == [200, 200]
+    output_hashes = json.loads((cache_dir / "output_hashes.json").read_text())
+    for i in range(len(sources)):
+        outputs = list((tmp_path / f"library {i}" / "out").iterdir())
+        assert outputs
+        # the hashes of both sessions were kept
+        assert all(str(path) in output_hashes for path in outputs)
+    # no temporary files left behind in the shared cache
+    assert not list(cache_dir.glob("**/*.tmp"))
+
+
+def test_server_converter_workers_are_set_for_all_requests(server_client, tmp_path):
+    response = server_client.post("/process", json={
+        "in_path": "tests/in/v3 markdown tags.rmn", "out_path": str(tmp_path), "converter_workers": 3,
+    })
+    assert response.status_code == 500
@@ -0,0 +1,88 @@
+import json
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import remarks
+
+from tests.notebook_fixtures import *
+
+
+@pytest.mark.parametrize("notebook", ["markdown_tags_document"], indirect=True)
+def test_session_keeps_its_state_between_runs(notebook, tmp_path):
+    in_dir, out_dir = tmp_path / "in", tmp_path / "out"
+    with zipfile.ZipFile(notebook.rmn_source) as rmn:
+        rmn.extractall(in_dir)
+    out_dir.mkdir()
+
+    with remarks.Session(renderer=remarks.Renderer.BATCHED) as session:
+        first = session.run(str(in_dir), str(out_dir))
+        metadata = dict(session.metadata.files)
+        second = session.run(str(in_dir), str(out_dir))
+
+        assert first.output_files == second.unchanged_files == 2
+        # the metadata was read once
+        assert all(session.metadata.files[path] is metadata[path] for path in metadata)
+
+        metadata_path = next(in_dir.glob("*.metadata"))
+        with open(metadata_path) as f:
+            document_metadata = json.load(f)
+        document_metadata["visibleName"] = "Renamed"
+        with open(metadata_path, "w") as f:
+            json.dump(document_metadata, f)
+        # changes on disk are picked up
+        session.run(str(in_dir), str(out_dir))
+        assert (out_dir / "Renamed _remarks.pdf").exists()
+
+
+@pytest.mark.parametrize("notebook", ["markdown_tags_document"], indirect=True)
+def test_session_keeps_its_caches_until_closed(notebook, tmp_path):
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    session = remarks.Session(renderer=remarks.Renderer.BATCHED, cache_dir=str(tmp_path / "cache"))
+    first = session.run(notebook.rmn_source, str(out_dir))
+    markdown_caches = dict(session.markdown_caches)
+    second = session.run(notebook.rmn_source, str(out_dir))
+
+    assert len(markdown_caches) == 1
+    # the cache of the document was read from disk once
+    assert session.markdown_caches == markdown_caches
+    assert all(session.markdown_caches[path] is cache for path, cache in markdown_caches.items())
+    assert second.cached_markdown_pages == first.pages
+    # sessions don't share what they keep
+    with remarks.Session(cache_dir=str(tmp_path / "cache")) as other:
+        assert other.markdown_caches == {} and other.metadata.files == {}
+
+    session.close()
+    assert session.markdown_caches == {} and session.metadata.files == {}
+
+
+def convert_in_session(rmn_source, out_dir, **options):
+    out_dir.mkdir()
+    with remarks.Session(renderer=remarks.Renderer.BATCHED, **options) as session:
+        return session.run(rmn_source, str(out_dir))
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    {"stream_chunk_size": 1},
+    {"output_mode": remarks.OutputMode.ANNOTATED, "native_highlights": True},
+])
+def test_sessions_convert_in_threads_at_once(options, tmp_path):
+    sources = [
+        "tests/in/v3 markdown tags.rmn",
+        "tests/in/rmpp - v6 - black and white only.rmn",
+        "tests/in/rmpp - v6 - various colors.rmn",
+    ] * 3
+    serial = [convert_in_session(source, tmp_path / f"serial {i}", **options) for i, source in enumerate(sources)]
+    with ThreadPoolExecutor(max_workers=len(sources)) as threads:
+        parallel = list(threads.map(
+            lambda i: convert_in_session(sources[i], tmp_path / f"parallel {i}", **options), range(len(sources))
+        ))
+
+    for i, (serial_summary, parallel_summary) in enumerate(zip(serial, parallel)):
+        assert parallel_summary.pages == serial_summary.pages > 0
+        assert parallel_summary.output_files == serial_summary.output_files > 0
+        for path in (tmp_path / f"serial {i}").iterdir():
+            assert (tmp_path / f"parallel {i}" / path.name).read_bytes() == path.read_bytes()
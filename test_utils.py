@@ -0,0 +1,56 @@
+import json
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import remarks
+from remarks.output.OutputHashes import OutputHashes
+from remarks.utils import conversion_warnings, warn_once
+
+from tests.notebook_fixtures import *
+
+
+def test_output_hashes_of_sessions_that_share_a_file_are_merged(tmp_path):
+    path = str(tmp_path / "cache" / "output_hashes.json")
+
+    def save(i):
+        output = tmp_path / f"output {i}.md"
+        output.write_text(f"output {i}")
+        temp = tmp_path / f"output {i}.md.tmp"
+        temp.write_text(f"output {i}, changed")
+        output_hashes = OutputHashes(path)
+        output_hashes.replace(str(temp), str(output))
+        output_hashes.save()
+
+    with ThreadPoolExecutor(max_workers=8) as threads:
+        list(threads.map(save, range(32)))
+
+    saved = json.loads(pathlib.Path(path).read_text())
+    assert set(saved) == {str(tmp_path / f"output {i}.md") for i in range(32)}
+
+
+def test_warn_once_warns_once_per_conversion(caplog):
+    for _ in range(2):
+        with conversion_warnings():
+            warn_once("- a segment with a single point")
+            warn_once("- a segment with a single point")
+    assert caplog.text.count("- a segment with a single point") == 2
+
+
+@pytest.mark.parametrize("notebook", ["markdown_tags_document"], indirect=True)
+@pytest.mark.parametrize("stream_chunk_size", [None, 1])
+def test_unchanged_outputs_are_not_written_again(notebook, stream_chunk_size, tmp_path):
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    first = remarks.run_remarks(notebook.rmn_source, str(out_dir), renderer=remarks.Renderer.BATCHED,
+                                stream_chunk_size=stream_chunk_size, cache_dir=str(tmp_path / "cache"))
+    modified = {path.name: path.stat().st_mtime_ns for path in out_dir.iterdir()}
+    second = remarks.run_remarks(notebook.rmn_source, str(out_dir), renderer=remarks.Renderer.BATCHED,
+                                 stream_chunk_size=stream_chunk_size, cache_dir=str(tmp_path / "cache"))
+
+    assert first.output_files == len(modified) == 2
+    assert second.output_files == 0
+    assert second.unchanged_files == 2
+    # no temporary files left behind, and nothing was touched
+    assert {path.name: path.stat().st_mtime_ns for path in out_dir.iterdir()} == modified
@@ -0,0 +1,98 @@
+import _thread
+import json
+import threading
+import time
+import zipfile
+
+import pytest
+
+import remarks
+from remarks.watch import InotifyWatcher, document_uuid, watch_documents
+
+from tests.notebook_fixtures import *
+
+
+def test_watch_yields_every_changed_document_once_per_burst(tmp_path):
+    assert document_uuid(str(tmp_path), str(tmp_path / "a.highlights" / "page.json")) == "a"
+    assert document_uuid(str(tmp_path), str(tmp_path / "b" / "page.rm")) == "b"
+    assert document_uuid(str(tmp_path), str(tmp_path.parent / "c.metadata")) is None
+
+    def sync():
+        time.sleep(0.3)
+        for name in ["a.metadata", "a.content", "b.metadata", "a.metadata"]:
+            (tmp_path / name).write_text(str(time.monotonic()))
+            time.sleep(0.05)
+
+    threading.Thread(target=sync).start()
+    changes = watch_documents(str(tmp_path), debounce=0.5, poll_interval=0.1)
+    start = time.monotonic()
+    assert next(changes) == {"a", "b"}
+    # not before the burst settled
+    assert time.monotonic() - start >= 0.8
+    changes.close()
+
+
+@pytest.mark.parametrize("notebook", ["markdown_tags_document"], indirect=True)
+def test_watched_folder_changes_map_to_the_documents_inside(notebook, tmp_path):
+    in_dir = tmp_path / "in"
+    with zipfile.ZipFile(notebook.rmn_source) as rmn:
+        rmn.extractall(in_dir)
+    metadata_path = next(in_dir.glob("*.metadata"))
+    document_metadata = json.loads(metadata_path.read_text())
+    # the document sits in "Inner", which sits in "Outer"
+    folders = {"outer": ("Outer", ""), "inner": ("Inner", "outer")}
+    for uuid, (name, parent) in folders.items():
+        (in_dir / f"{uuid}.metadata").write_text(
+            json.dumps({"type": "CollectionType", "visibleName": name, "parent": parent})
+        )
+    document_metadata["parent"] = "inner"
+    metadata_path.write_text(json.dumps(document_metadata))
+
+    with remarks.Session() as session:
+        assert session.changed_documents(str(in_dir), {"outer"}) == {metadata_path.stem}
+        assert session.changed_documents(str(in_dir), {"inner", "other"}) == {metadata_path.stem, "other"}
+        assert session.changed_documents(str(in_dir), {metadata_path.stem}) == {metadata_path.stem}
+
+
+def test_inotify_watcher_reports_written_files_only(tmp_path):
+    pytest.importorskip("watchdog")
+    watcher = InotifyWatcher(str(tmp_path))
+    try:
+        (tmp_path / "a.metadata").write_text("{}")
+        time.sleep(0.2)
+        assert str(tmp_path / "a.metadata") in watcher.changes(timeout=2)
+        # converting a document reads its files, that is no change
+        (tmp_path / "a.metadata").read_text()
+        assert watcher.changes(timeout=0.5) == set()
+    finally:
+        watcher.close()
+
+
+@pytest.mark.parametrize("notebook", ["markdown_tags_document"], indirect=True)
+def test_watch_converts_documents_synced_during_the_first_pass(notebook, tmp_path, monkeypatch):
+    in_dir = tmp_path / "in"
+    with zipfile.ZipFile(notebook.rmn_source) as rmn:
+        rmn.extractall(in_dir)
+    converted = []
+
+    def convert_document(self, metadata_path, output_dir, summary):
+        converted.append(metadata_path.stem)
+        if len(converted) == 1:
+            # a sync writes the document again while it is converted the first time
+            content_path = metadata_path.with_suffix(".content")
+            content_path.write_text(content_path.read_text() + " ")
+        else:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(remarks.Session, "convert_document", convert_document)
+    # stops watching if the change is never seen
+    timer = threading.Timer(10, _thread.interrupt_main)
+    timer.start()
+    try:
+        with remarks.Session() as session:
+            session.run(str(in_dir), str(tmp_path / "out"), watch=True, watch_debounce=0.2)
+    finally:
+        timer.cancel()
+
+    document = next(in_dir.glob("*.metadata")).stem
+    assert converted == [document, document]
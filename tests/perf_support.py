@@ -0,0 +1,104 @@
+import gc
+import json
+import os
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import remarks
+
+PERF_BASELINE_PATH = "tests/perf_baseline.json"
+PERF_OUTPUT_DIR = "tests/out/perf"
+
+# Stages that finish in a few milliseconds are dominated by noise, a regression
+# has to exceed the relative tolerance *and* these absolute margins to count.
+MIN_TIME_REGRESSION_SECONDS = 0.05
+MIN_MEMORY_REGRESSION_BYTES = 1024 * 1024
+
+
+@dataclass
+class PerfMeasurement:
+    """The best-of-n timings of a remarks run, and the peak memory of a traced run"""
+
+    stage_timings: Dict[str, float] = field(default_factory=dict)
+    """Seconds per pipeline stage, see `remarks.RunSummary.stage_timings`"""
+
+    peak_memory: Dict[str, int] = field(default_factory=dict)
+    """Peak traced memory in bytes per pipeline stage, and for the run as a whole under "total\""""
+
+    def to_json(self) -> dict:
+        return {
+            "stage_timings": {k: round(v, 4) for k, v in sorted(self.stage_timings.items())},
+            "peak_memory": dict(sorted(self.peak_memory.items())),
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "PerfMeasurement":
+        return cls(stage_timings=data["stage_timings"], peak_memory=data["peak_memory"])
+
+
+def measure_remarks(input_path: str, runs: int, renderer: str = remarks.Renderer.SVG) -> PerfMeasurement:
+    """Run remarks `runs` times on `input_path`, and once more for its memory.
+
+    Timings keep the fastest run for every stage, the least disturbed by the rest of the machine. They are taken
+    without tracemalloc, which slows down every allocation. Memory is traced in a run of its own."""
+    os.makedirs(PERF_OUTPUT_DIR, exist_ok=True)
+    measurement = PerfMeasurement()
+
+    for _ in range(runs):
+        summary = remarks.run_remarks(input_path, PERF_OUTPUT_DIR, renderer=renderer)
+        for stage, duration in summary.stage_timings.items():
+            measurement.stage_timings[stage] = min(duration, measurement.stage_timings.get(stage, duration))
+
+    # what earlier runs left for the garbage collector would count towards this one otherwise
+    gc.collect()
+    tracemalloc.start()
+    try:
+        summary = remarks.run_remarks(input_path, PERF_OUTPUT_DIR, renderer=renderer)
+        _, total_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # every stage resets the tracemalloc peak, the run as a whole peaked at the highest of them
+    total_peak = max([total_peak, *summary.stage_peak_memory.values()])
+    measurement.peak_memory = {**summary.stage_peak_memory, "total": total_peak}
+
+    return measurement
+
+
+def load_perf_baseline() -> Dict[str, dict]:
+    if not os.path.exists(PERF_BASELINE_PATH):
+        return {}
+    with open(PERF_BASELINE_PATH) as f:
+        return json.load(f)
+
+
+def save_perf_baseline(name: str, measurement: PerfMeasurement):
+    baseline = load_perf_baseline()
+    baseline[name] = measurement.to_json()
+    with open(PERF_BASELINE_PATH, "w") as f:
+        json.dump(dict(sorted(baseline.items())), f, indent=2)
+        f.write("\n")
+
+
+def find_regressions(baseline: PerfMeasurement, current: PerfMeasurement, tolerance: float) -> List[str]:
+    """Compare `current` against `baseline`, describe every stage that became slower or hungrier than
+    `tolerance` allows. A tolerance of 0.25 accepts up to 25% more time or memory."""
+    regressions = []
+
+    for stage, expected in baseline.stage_timings.items():
+        actual = current.stage_timings.get(stage)
+        if actual is None:
+            continue
+        if actual > expected * (1 + tolerance) and actual - expected > MIN_TIME_REGRESSION_SECONDS:
+            regressions.append(f"stage '{stage}' took {actual:.3f}s, baseline is {expected:.3f}s")
+
+    for stage, expected in baseline.peak_memory.items():
+        actual = current.peak_memory.get(stage)
+        if actual is None:
+            continue
+        if actual > expected * (1 + tolerance) and actual - expected > MIN_MEMORY_REGRESSION_BYTES:
+            regressions.append(
+                f"stage '{stage}' peaked at {actual / 2 ** 20:.1f}MiB, baseline is {expected / 2 ** 20:.1f}MiB"
+            )
+
+    return regressions